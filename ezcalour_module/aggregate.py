@@ -0,0 +1,261 @@
+'''Merging of samples / features by group using a sparse group indicator matrix
+
+The samples (or features) are grouped by a metadata field value, and the groups are
+described by a sparse (groups x samples) indicator matrix, built once per experiment and
+field (and cached on the experiment). The group sums / means are then a single sparse
+matrix product (instead of a slice and reduce per group), and the 'random' method picks a
+random member of every group in one vectorized step. The data stays sparse.
+
+Out-of-core experiments are merged streaming over the sample chunks (see outofcore.py),
+and the result is an in-memory experiment.
+
+The result is the same as calour aggregate_by_metadata / collapse_taxonomy: the groups are
+in the order of their first member, the metadata of the first member of each group is kept,
+and the '_calour_merge_number' / '_calour_merge_ids' fields hold the number and ids of the
+group members. For collapse_taxonomy_levels, the lineages are split once for all the levels.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from ezcalour_module.taxonomy import RANKS
+from ezcalour_module.experiment import subset_experiment, subset_data, format_call
+
+logger = getLogger(__name__)
+
+MERGE_METHODS = ['mean', 'random', 'sum']
+
+
+class GroupIndicator:
+    '''The groups of the samples / features with the same value'''
+    def __init__(self, values):
+        '''
+        Parameters
+        ----------
+        values : pandas.Series or numpy.ndarray
+            the value of each sample / feature. Missing values are one group
+        '''
+        self.codes, self.groups = pd.factorize(values, use_na_sentinel=False)
+        self.size = len(self.codes)
+        self.num_groups = len(self.groups)
+        self.counts = np.bincount(self.codes, minlength=self.num_groups)
+        # the members of each group (in their original order) are order[starts[i]:starts[i] + counts[i]]
+        self.order = np.argsort(self.codes, kind='mergesort')
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]]).astype(np.int64)
+        self.first = self.order[self.starts]
+        self._matrix = {}
+
+    def matrix(self, method='sum'):
+        '''Get the (groups x members) indicator matrix (rows divided by the group size for 'mean')'''
+        if method not in self._matrix:
+            if method == 'sum':
+                weights = np.ones(self.size)
+            elif method == 'mean':
+                weights = 1 / self.counts[self.codes]
+            else:
+                raise ValueError('Unknown aggregation method %s' % method)
+            self._matrix[method] = scipy.sparse.csr_matrix((weights, (self.codes, np.arange(self.size))), shape=(self.num_groups, self.size))
+        return self._matrix[method]
+
+    def random_members(self, random_seed=None):
+        '''Get one random member of each group'''
+        rand = np.random.RandomState(random_seed)
+        return np.lexsort((rand.random_sample(self.size), self.codes))[self.starts]
+
+    def member_ids(self, ids):
+        '''Get the ';' joined ids of the members of each group'''
+        ids = np.asarray(ids).astype(str)[self.order]
+        return np.array([';'.join(ids[start:start + count]) for start, count in zip(self.starts, self.counts)], dtype=object)
+
+
+def _axis(axis):
+    if axis in (0, 's'):
+        return 's'
+    if axis in (1, 'f'):
+        return 'f'
+    raise ValueError('Unknown axis %s' % axis)
+
+
+def _cache(exp):
+    '''Get the indicator cache of the experiment (derived experiments have new metadata tables, so they get a new cache)'''
+    cached = getattr(exp, '_ezcalour_groups', None)
+    if cached is None or cached[0] is not exp.sample_metadata or cached[1] is not exp.feature_metadata:
+        cached = (exp.sample_metadata, exp.feature_metadata, {})
+        exp._ezcalour_groups = cached
+    return cached[2]
+
+
+def get_groups(exp, field, axis='s'):
+    '''Get the GroupIndicator of a sample / feature metadata field (built once and cached on the experiment)'''
+    axis = _axis(axis)
+    cache = _cache(exp)
+    key = (axis, field)
+    if key not in cache:
+        md = exp.sample_metadata if axis == 's' else exp.feature_metadata
+        cache[key] = GroupIndicator(md[field].values)
+    return cache[key]
+
+
+def _product(exp, matrix, axis):
+    '''Get matrix @ data (axis 's') or data @ matrix.T (axis 'f')'''
+    if getattr(exp, 'out_of_core', False):
+        if axis == 's':
+            matrix = matrix.tocsc()
+            res = scipy.sparse.csr_matrix((matrix.shape[0], exp.shape[1]))
+            for view_idx, block in exp.iter_samples():
+                res = res + matrix[:, view_idx].dot(block)
+            return scipy.sparse.csr_matrix(res)
+        blocks = []
+        order = []
+        for view_idx, block in exp.iter_samples():
+            blocks.append(scipy.sparse.csr_matrix(block.dot(matrix.T)))
+            order.append(view_idx)
+        if len(blocks) == 0:
+            return scipy.sparse.csr_matrix((exp.shape[0], matrix.shape[0]))
+        return scipy.sparse.vstack(blocks, format='csr')[np.argsort(np.concatenate(order))]
+    if axis == 's':
+        res = matrix.dot(exp.data)
+    else:
+        res = matrix.dot(exp.data.T).T
+    if scipy.sparse.issparse(res):
+        return scipy.sparse.csr_matrix(res)
+    return np.ascontiguousarray(res)
+
+
+def _rows(exp, positions, axis):
+    '''Get the data of the samples (axis 's') or features (axis 'f') at the positions'''
+    sample_pos, feature_pos = (positions, None) if axis == 's' else (None, positions)
+    if getattr(exp, 'out_of_core', False):
+        sub = exp.subset(sample_pos=sample_pos, feature_pos=feature_pos)
+        if getattr(sub, 'out_of_core', False):
+            sub = sub.to_experiment()
+        return sub.data
+    return subset_data(exp.data, sample_pos, feature_pos)
+
+
+def aggregate(exp, groups, method='mean', axis='s', random_seed=None, call=None):
+    '''Merge the samples / features of each group
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    groups : GroupIndicator
+        the groups (see get_groups)
+    method : str, optional
+        'mean', 'sum' or 'random' (the data of a random member of the group)
+    axis : 0, 1, 's' or 'f', optional
+        merge the samples ('s') or the features ('f')
+    random_seed : int or None, optional
+        for the 'random' method
+    call : str or None, optional
+        the call history entry
+
+    Returns
+    -------
+    calour.Experiment
+        with one sample / feature per group (with the metadata of its first member)
+    '''
+    axis = _axis(axis)
+    if method == 'random':
+        data = _rows(exp, groups.random_members(random_seed), axis)
+    elif method in ('mean', 'sum'):
+        data = _product(exp, groups.matrix(method), axis)
+    else:
+        raise ValueError('Unknown merge method %s. Available methods are %s' % (method, MERGE_METHODS))
+    if axis == 's':
+        newexp = subset_experiment(exp, sample_pos=groups.first, data=data, call=call)
+        md, ids = newexp.sample_metadata, exp.sample_metadata.index
+    else:
+        newexp = subset_experiment(exp, feature_pos=groups.first, data=data, call=call)
+        md, ids = newexp.feature_metadata, exp.feature_metadata.index
+    md['_calour_merge_number'] = groups.counts
+    md['_calour_merge_ids'] = groups.member_ids(ids)
+    logger.info('merged %d %s into %d groups' % (groups.size, 'samples' if axis == 's' else 'features', groups.num_groups))
+    return newexp
+
+
+def aggregate_by_metadata(exp, field, method='mean', axis='s', random_seed=None):
+    '''Merge the samples / features with the same metadata field value (see aggregate)'''
+    axis = _axis(axis)
+    call = format_call('aggregate_by_metadata', field=field, method=method, axis=axis)
+    return aggregate(exp, get_groups(exp, field, axis), method=method, axis=axis, random_seed=random_seed, call=call)
+
+
+def level_num(level):
+    '''Get the taxonomy level number (0=kingdom ... 6=species) of a level name, its first letter or number'''
+    if isinstance(level, (int, np.integer)) and 0 <= level < len(RANKS):
+        return int(level)
+    for idx, crank in enumerate(RANKS):
+        if level in (crank, crank[0]):
+            return idx
+    raise ValueError('Unsupported taxonomy level %s. Please use one of %s' % (level, RANKS))
+
+
+def _taxonomy_groups(exp, level):
+    '''Get the GroupIndicator of the taxonomy up to the level (cached on the experiment)
+
+    The unique lineages are split once for all the levels
+    '''
+    cache = _cache(exp)
+    if ('f', 'taxonomy', level) not in cache:
+        if ('f', 'taxonomy', 'lineages') not in cache:
+            codes, uniques = pd.factorize(exp.feature_metadata['taxonomy'].values, use_na_sentinel=False)
+            cache[('f', 'taxonomy', 'lineages')] = (codes, [str(x).split(';') for x in uniques])
+        codes, lineages = cache[('f', 'taxonomy', 'lineages')]
+        # as calour collapse_taxonomy - missing levels are 'other'
+        names = np.array([';'.join((x + ['other'] * (level + 1 - len(x)))[:level + 1]) for x in lineages], dtype=object)
+        cache[('f', 'taxonomy', level)] = GroupIndicator(names[codes])
+    return cache[('f', 'taxonomy', level)]
+
+
+def collapse_taxonomy(exp, level='genus'):
+    '''Sum the features with the same taxonomy up to the level (as calour collapse_taxonomy)
+
+    Parameters
+    ----------
+    exp : calour.AmpliconExperiment
+    level : str or int, optional
+        the taxonomy level name ('genus' or 'g' etc.) or number (0=kingdom ... 6=species)
+
+    Returns
+    -------
+    calour.AmpliconExperiment
+        with the collapsed taxonomy in the 'taxonomy' and '_calour_tax_group' feature fields
+    '''
+    level = level_num(level)
+    groups = _taxonomy_groups(exp, level)
+    newexp = aggregate(exp, groups, method='sum', axis='f', call=format_call('collapse_taxonomy', level=RANKS[level]))
+    tax = np.asarray(groups.groups, dtype=object)
+    newexp.feature_metadata['_calour_tax_group'] = tax
+    newexp.feature_metadata['taxonomy'] = tax
+    return newexp
+
+
+def collapse_taxonomy_levels(exp, levels=None):
+    '''Collapse the taxonomy at several levels (the lineages are split once)
+
+    Parameters
+    ----------
+    exp : calour.AmpliconExperiment
+    levels : list of (str or int) or None, optional
+        None for all the levels (kingdom to species)
+
+    Returns
+    -------
+    list of calour.AmpliconExperiment
+        the collapsed experiment for each level
+    '''
+    if levels is None:
+        levels = RANKS
+    return [collapse_taxonomy(exp, clevel) for clevel in levels]
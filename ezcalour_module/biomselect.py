@@ -0,0 +1,339 @@
+'''Read only the selected samples and features of an HDF5 biom table
+
+The sample predicates (a metadata query on the mapping file, minimal reads per sample)
+and feature predicates (minimal total reads, a list of feature ids) are evaluated before
+reading the table: the per-sample and per-feature read sums are computed from the HDF5
+matrix values only (the indices are not read), and then only the rows of the selected
+samples (or of the selected features, whichever has less non-zero values) are read from
+the biom sample (or observation) compressed matrix.
+
+The load time and peak memory are therefore proportional to the selection and not to
+the table size. The result is the same as reading the whole table with calour and then
+filtering (the _calour_original_abundance field is the read count of each sample in the
+whole table).
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from ezcalour_module import metadata
+from ezcalour_module.query import MetadataIndex
+from ezcalour_module.experiment import subset_experiment, format_call
+
+logger = getLogger(__name__)
+
+# number of matrix values read in each block when computing the row sums
+SUM_BLOCK_SIZE = 2 ** 22
+# rows closer than this are read as one slice (and the rows between them discarded)
+MERGE_GAP = 16
+
+
+def is_hdf5_biom(table_file):
+    '''Check if the file is an HDF5 (biom 2.x) table'''
+    import h5py
+
+    try:
+        return h5py.is_hdf5(table_file)
+    except (OSError, TypeError):
+        return False
+
+
+def _decode(values):
+    return [x.decode('utf-8') if isinstance(x, bytes) else str(x) for x in values]
+
+
+def row_sums(group, block_size=SUM_BLOCK_SIZE):
+    '''Get the sum of each row of a biom compressed matrix group ('sample' or 'observation'), reading the values in blocks
+
+    Parameters
+    ----------
+    group : h5py.Group
+        the biom 'sample' (rows are samples) or 'observation' (rows are features) group
+    block_size : int, optional
+        number of values to read at a time
+
+    Returns
+    -------
+    numpy.ndarray
+    '''
+    indptr = group['matrix/indptr'][:]
+    values = group['matrix/data']
+    sums = np.zeros(len(indptr) - 1)
+    start_row = 0
+    while start_row < len(sums):
+        # the rows whose values fit in the block (at least one row)
+        end_row = max(np.searchsorted(indptr, indptr[start_row] + block_size, side='right') - 1, start_row + 1)
+        end_row = min(end_row, len(sums))
+        cvalues = values[indptr[start_row]:indptr[end_row]]
+        csum = np.concatenate([[0], np.cumsum(cvalues, dtype=np.float64)])
+        cptr = indptr[start_row:end_row + 1] - indptr[start_row]
+        sums[start_row:end_row] = csum[cptr[1:]] - csum[cptr[:-1]]
+        start_row = end_row
+    return sums
+
+
+def _runs(positions, merge_gap=MERGE_GAP):
+    '''Group sorted row positions into (start, end) slices, merging slices closer than merge_gap'''
+    if len(positions) == 0:
+        return []
+    breaks = np.where(np.diff(positions) > merge_gap)[0]
+    starts = np.concatenate([[positions[0]], positions[breaks + 1]])
+    ends = np.concatenate([positions[breaks], [positions[-1]]]) + 1
+    return list(zip(starts, ends))
+
+
+def read_rows(group, rows, columns):
+    '''Read the selected rows (and columns) of a biom compressed matrix group
+
+    Parameters
+    ----------
+    group : h5py.Group
+        the biom 'sample' or 'observation' group
+    rows : numpy.ndarray of int
+        the sorted row positions to read
+    columns : numpy.ndarray of bool
+        the columns to keep
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        (len(rows) x sum(columns))
+    '''
+    indptr = group['matrix/indptr']
+    values_ds = group['matrix/data']
+    indices_ds = group['matrix/indices']
+    # the new position of each kept column
+    column_map = np.cumsum(columns) - 1
+    row_mask = np.zeros(indptr.shape[0] - 1, dtype=bool)
+    row_mask[rows] = True
+    all_values = []
+    all_indices = []
+    all_counts = []
+    for start, end in _runs(np.asarray(rows)):
+        cptr = indptr[start:end + 1]
+        cvalues = values_ds[cptr[0]:cptr[-1]]
+        cindices = indices_ds[cptr[0]:cptr[-1]]
+        row_pos = np.repeat(np.arange(start, end), np.diff(cptr))
+        wanted = row_mask[start:end]
+        keep = wanted[row_pos - start] & columns[cindices]
+        all_values.append(cvalues[keep])
+        all_indices.append(column_map[cindices[keep]])
+        all_counts.append(np.bincount(row_pos[keep] - start, minlength=end - start)[wanted])
+    if len(all_counts) == 0:
+        return scipy.sparse.csr_matrix((0, int(np.sum(columns))))
+    counts = np.concatenate(all_counts)
+    new_indptr = np.concatenate([[0], np.cumsum(counts)])
+    return scipy.sparse.csr_matrix((np.concatenate(all_values), np.concatenate(all_indices), new_indptr),
+                                   shape=(len(counts), int(np.sum(columns))))
+
+
+def _feature_metadata(fl, feature_pos, feature_ids):
+    '''Read the biom observation metadata of the selected features (taxonomy lists are joined by ;)'''
+    feature_md = pd.DataFrame(index=feature_ids)
+    if 'observation/metadata' not in fl:
+        return feature_md
+    for cname, cds in fl['observation/metadata'].items():
+        if not hasattr(cds, 'shape') or len(cds.shape) == 0 or cds.shape[0] != fl['observation/ids'].shape[0]:
+            continue
+        cvalues = cds[:][feature_pos]
+        if cvalues.ndim == 2:
+            feature_md[cname] = [';'.join(_decode(x)) for x in cvalues]
+        else:
+            feature_md[cname] = _decode(cvalues) if cvalues.dtype.kind in 'OSU' else cvalues
+    return feature_md
+
+
+def select(table_file, map_file=None, sample_query=None, min_sample_reads=None, min_feature_reads=None, feature_ids=None):
+    '''Read the selected samples and features of an HDF5 biom table (see module documentation)
+
+    Parameters
+    ----------
+    table_file : str
+        the HDF5 biom table
+    map_file : str or None, optional
+        the mapping file
+    sample_query : str or None, optional
+        keep the samples matching the metadata query (see query.py). None to not filter
+    min_sample_reads : float or None, optional
+        keep the samples with at least min_sample_reads reads (in the whole table)
+    min_feature_reads : float or None, optional
+        keep the features with at least min_feature_reads total reads in the selected samples
+    feature_ids : list of str or None, optional
+        keep only these features. None to not filter
+
+    Returns
+    -------
+    data : scipy.sparse.csr_matrix
+        samples in rows, features in columns
+    sample_md : pandas.DataFrame
+        the mapping file metadata of the selected samples (including the '_calour_original_abundance' field)
+    feature_md : pandas.DataFrame
+        the biom metadata of the selected features
+    '''
+    import h5py
+
+    with h5py.File(table_file, 'r') as fl:
+        all_sample_ids = _decode(fl['sample/ids'][:])
+        all_feature_ids = _decode(fl['observation/ids'][:])
+        num_samples, num_features = len(all_sample_ids), len(all_feature_ids)
+        sample_reads = row_sums(fl['sample'])
+        all_md = metadata.read_mapping(all_sample_ids, map_file)
+
+        # the sample predicates
+        smask = np.ones(num_samples, dtype=bool)
+        if min_sample_reads is not None:
+            smask &= sample_reads >= min_sample_reads
+        if sample_query:
+            smask &= MetadataIndex(all_md).query(sample_query)
+        all_selected = smask.all()
+
+        # the feature predicates that do not depend on the selected samples
+        fmask = np.ones(num_features, dtype=bool)
+        if feature_ids is not None:
+            fmask &= np.isin(all_feature_ids, list(feature_ids))
+        if min_feature_reads is not None and all_selected:
+            fmask &= row_sums(fl['observation']) >= min_feature_reads
+        sample_pos = np.where(smask)[0]
+        feature_pos = np.where(fmask)[0]
+        logger.debug('selected %d of %d samples, %d of %d features before reading' % (len(sample_pos), num_samples, len(feature_pos), num_features))
+
+        # read along the axis with less values to read
+        sample_nnz = np.diff(fl['sample/matrix/indptr'][:])[sample_pos].sum()
+        feature_nnz = np.diff(fl['observation/matrix/indptr'][:])[feature_pos].sum()
+        if sample_nnz <= feature_nnz:
+            data = read_rows(fl['sample'], sample_pos, fmask)
+        else:
+            data = read_rows(fl['observation'], feature_pos, smask).T.tocsr()
+        if min_feature_reads is not None and not all_selected:
+            keep = np.asarray(data.sum(axis=0)).ravel() >= min_feature_reads
+            feature_pos = feature_pos[keep]
+            data = data[:, keep]
+        feature_md = _feature_metadata(fl, feature_pos, [all_feature_ids[x] for x in feature_pos])
+
+    sample_md = all_md.iloc[sample_pos].copy()
+    sample_md['_calour_original_abundance'] = sample_reads[sample_pos]
+    logger.info('read %d of %d samples, %d of %d features from %s' % (data.shape[0], num_samples, data.shape[1], num_features, table_file))
+    return data, sample_md, feature_md
+
+
+def read_amplicon(table_file, map_file=None, sample_query=None, min_reads=None, min_feature_reads=None, feature_ids=None, normalize=10000):
+    '''Read the selected samples and features of an HDF5 biom table into a calour AmpliconExperiment
+
+    Parameters
+    ----------
+    table_file : str
+        the HDF5 biom table
+    map_file : str or None, optional
+        the mapping file
+    sample_query : str or None, optional
+        keep the samples matching the metadata query (see query.py)
+    min_reads : int or None, optional
+        keep the samples with at least min_reads reads (as calour read_amplicon min_reads)
+    min_feature_reads : float or None, optional
+        keep the features with at least min_feature_reads total reads in the selected samples
+    feature_ids : list of str or None, optional
+        keep only these features
+    normalize : int or None, optional
+        number of reads to normalize each sample to (after the selection). None to skip normalization
+
+    Returns
+    -------
+    calour.AmpliconExperiment
+    '''
+    import calour as ca
+    from calour.util import get_data_md5, get_file_md5
+
+    data, sample_md, feature_md = select(table_file, map_file, sample_query=sample_query, min_sample_reads=min_reads,
+                                         min_feature_reads=min_feature_reads, feature_ids=feature_ids)
+    sample_md['_sample_id'] = sample_md.index.values
+    feature_md['_feature_id'] = feature_md.index.values
+    info = {'data_file': table_file,
+            'data_md5': get_data_md5(data),
+            'sample_metadata_file': map_file,
+            'sample_metadata_md5': get_file_md5(map_file)}
+    exp = ca.AmpliconExperiment(data, sample_md, feature_md, info=info, description=os.path.basename(table_file), sparse=True)
+    if normalize is not None:
+        exp.normalize(total=normalize, inplace=True)
+    exp._call_history = [format_call('read_amplicon_selected', table_file=table_file, map_file=map_file, sample_query=sample_query,
+                                     min_reads=min_reads, min_feature_reads=min_feature_reads,
+                                     num_feature_ids=None if feature_ids is None else len(feature_ids), normalize=normalize)]
+    return exp
+
+
+def has_selection(sample_query=None, min_feature_reads=None, feature_ids=None):
+    '''True if any selection (besides the calour min_reads) is requested'''
+    return bool(sample_query) or min_feature_reads is not None or feature_ids is not None
+
+
+def select_experiment(exp, sample_query=None, min_feature_reads=None, feature_ids=None):
+    '''Apply the selection to an experiment already in memory (for tables that are not HDF5 biom)
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+        the experiment (not normalized, so min_feature_reads is on the reads)
+    sample_query, min_feature_reads, feature_ids :
+        see select
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    sample_pos = None
+    if sample_query:
+        sample_pos = np.where(MetadataIndex(exp.sample_metadata).query(sample_query))[0]
+    fmask = np.ones(exp.shape[1], dtype=bool)
+    if feature_ids is not None:
+        fmask &= exp.feature_metadata.index.isin(list(feature_ids))
+    if min_feature_reads is not None:
+        data = exp.data if sample_pos is None else exp.data[sample_pos]
+        fmask &= np.asarray(data.sum(axis=0)).ravel() >= min_feature_reads
+    return subset_experiment(exp, sample_pos=sample_pos, feature_pos=np.where(fmask)[0],
+                             call=format_call('select', sample_query=sample_query, min_feature_reads=min_feature_reads,
+                                              num_feature_ids=None if feature_ids is None else len(feature_ids)))
+
+
+def read_selected(table_file, map_file=None, normalize=10000, min_reads=None, sample_query=None, min_feature_reads=None, feature_ids=None):
+    '''Read the selected samples and features of a table
+
+    HDF5 biom tables are read using select (only the selected slices are read). Other tables
+    are read whole using calour and the selection is applied in memory, with the same result
+
+    Parameters
+    ----------
+    see read_amplicon
+
+    Returns
+    -------
+    calour.AmpliconExperiment
+    '''
+    if is_hdf5_biom(table_file):
+        return read_amplicon(table_file, map_file, sample_query=sample_query, min_reads=min_reads,
+                             min_feature_reads=min_feature_reads, feature_ids=feature_ids, normalize=normalize)
+    import calour as ca
+
+    logger.debug('%s is not an HDF5 biom table. applying the selection after reading' % table_file)
+    exp = ca.read_amplicon(table_file, sample_metadata_file=map_file, min_reads=min_reads, normalize=None,
+                           sample_metadata_kwargs=metadata.read_kwargs(map_file))
+    exp = select_experiment(exp, sample_query=sample_query, min_feature_reads=min_feature_reads, feature_ids=feature_ids)
+    if normalize is not None:
+        exp.normalize(total=normalize, inplace=True)
+    return exp
+
+
+def read_id_list(fname):
+    '''Read a feature id list file (one id per line, or the first column of a tab separated file)'''
+    with open(fname) as fl:
+        return [line.split('\t')[0].strip() for line in fl if line.strip() and not line.startswith('#')]
@@ -0,0 +1,333 @@
+'''Scalable (approximate) clustering order for large experiments
+
+The exact calour clustering computes all the pairwise distances (O(n^2) memory) and
+does not scale beyond ~30k features. Here the rows (features or samples) are transformed
+as in the exact clustering - features are log transformed and standardized (as calour
+cluster_features), samples are used as is (as calour cluster_data) - and ordered using one of:
+
+'landmark' : hierarchical clustering of a random sample of landmark rows, followed by
+    assignment of all other rows to the closest landmark (the distances are computed in
+    chunks that fit in a memory budget, on a thread pool - the sparse products and numpy
+    array operations release the GIL). Within each landmark group, rows are ordered by
+    their position between the previous and next landmarks.
+'embedding' : order by the 1-D embedding on the leading principal component
+    (computed by power iteration on the sparse data).
+
+The standardized data is never densified - distances are computed from the sparse dot
+products using the per-row means and standard deviations.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import time
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
+
+from ezcalour_module.experiment import subset_experiment, format_call
+
+logger = getLogger(__name__)
+
+# use the scalable clustering by default for more rows than this
+SCALABLE_MIN_ROWS = 20000
+
+CLUSTER_METHODS = ['landmark', 'embedding']
+# 'standardize' - log transform and standardize the rows (as calour cluster_features), None - use the data as is (as calour cluster_data)
+TRANSFORMS = ['standardize', None]
+
+
+class StandardizedRows:
+    '''The (log transformed, standardized) rows of a matrix, kept as sparse (log) data + row mean/std'''
+    def __init__(self, data, n=1, transform='standardize'):
+        '''
+        Parameters
+        ----------
+        data : numpy.ndarray or scipy.sparse matrix
+            the rows to cluster (rows x columns)
+        n : float, optional
+            values smaller than n are set to n before the log2 transform (as calour log_n)
+        transform : str or None, optional
+            'standardize' to log transform and standardize the rows, None to use the data as is
+        '''
+        if transform not in TRANSFORMS:
+            raise ValueError('Unknown transform %s. Available transforms are %s' % (transform, TRANSFORMS))
+        data = scipy.sparse.csr_matrix(data, dtype=float, copy=True)
+        self.data = data
+        self.num_cols = data.shape[1]
+        if transform is None:
+            self.mean = np.zeros(data.shape[0])
+            self.std = np.ones(data.shape[0])
+            self.sqnorm = np.asarray(data.multiply(data).sum(axis=1)).ravel()
+            return
+        # log2(max(x, n)) - for n=1 zeros stay zeros so the matrix stays sparse
+        data.data = np.log2(np.maximum(data.data, n)) - np.log2(n)
+        data.eliminate_zeros()
+        self.mean = np.asarray(data.mean(axis=1)).ravel()
+        sqmean = np.asarray(data.multiply(data).mean(axis=1)).ravel()
+        std = np.sqrt(np.maximum(sqmean - self.mean ** 2, 0))
+        std[std == 0] = 1
+        self.std = std
+        # squared norm of each standardized row
+        self.sqnorm = (sqmean - self.mean ** 2) * self.num_cols / std ** 2
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def sqdist(self, rows, other_rows):
+        '''Get the squared euclidean distances between two sets of (standardized) rows
+
+        Parameters
+        ----------
+        rows, other_rows : numpy.ndarray of int
+            the row positions
+
+        Returns
+        -------
+        numpy.ndarray
+            len(rows) x len(other_rows) squared distances
+        '''
+        a = self.data[rows]
+        b = self.data[other_rows]
+        # in place on the dense product (no other rows x other_rows temporaries)
+        dist = np.asarray((a @ b.T).todense())
+        dist -= self.num_cols * self.mean[rows][:, None] * self.mean[other_rows][None, :]
+        dist /= self.std[rows][:, None]
+        dist /= self.std[other_rows][None, :]
+        dist *= -2
+        dist += self.sqnorm[rows][:, None]
+        dist += self.sqnorm[other_rows][None, :]
+        return np.maximum(dist, 0, out=dist)
+
+    def project(self, vec):
+        '''Get the standardized rows multiplied by vec (num_cols)'''
+        return (self.data @ vec - self.mean * np.sum(vec)) / self.std
+
+    def project_t(self, vec):
+        '''Get the transposed standardized rows multiplied by vec (num_rows)'''
+        scaled = vec / self.std
+        return self.data.T @ scaled - np.sum(scaled * self.mean)
+
+
+def _chunks(num_rows, chunk_size):
+    return [np.arange(start, min(start + chunk_size, num_rows)) for start in range(0, num_rows, chunk_size)]
+
+
+def landmark_order(rows, num_landmarks=2000, memory_budget=256 * 2 ** 20, linkage_method='single', n_jobs=None, random_seed=None):
+    '''Get the approximate clustering order using landmark linkage and assignment
+
+    Parameters
+    ----------
+    rows : StandardizedRows
+    num_landmarks : int, optional
+        number of rows to use for the hierarchical clustering
+    memory_budget : int, optional
+        maximal number of bytes to use for each distance chunk
+    linkage_method : str, optional
+        the scipy linkage method for the landmark clustering
+    n_jobs : int or None, optional
+        number of threads. None to use the number of CPUs
+    random_seed : int or None, optional
+
+    Returns
+    -------
+    numpy.ndarray of int
+        the new row order
+    '''
+    num_rows = len(rows)
+    rand = np.random.RandomState(random_seed)
+    num_landmarks = min(num_landmarks, num_rows)
+    landmarks = np.sort(rand.choice(num_rows, num_landmarks, replace=False))
+    if num_landmarks < 2:
+        return np.arange(num_rows)
+
+    # cluster the landmarks
+    ldist = np.sqrt(rows.sqdist(landmarks, landmarks))
+    np.fill_diagonal(ldist, 0)
+    ldist = (ldist + ldist.T) / 2
+    link = hierarchy.linkage(squareform(ldist, checks=False), method=linkage_method)
+    leaf_order = hierarchy.leaves_list(link)
+    landmarks = landmarks[leaf_order]
+    del ldist
+
+    # assign all rows to the closest landmark, in chunks
+    chunk_size = max(1, int(memory_budget / (8 * 3 * num_landmarks)))
+    group = np.zeros(num_rows, dtype=np.int64)
+    key = np.zeros(num_rows)
+
+    def _assign(chunk):
+        dist = np.sqrt(rows.sqdist(chunk, landmarks))
+        cgroup = np.argmin(dist, axis=1)
+        idx = np.arange(len(chunk))
+        prev_dist = dist[idx, np.maximum(cgroup - 1, 0)]
+        next_dist = dist[idx, np.minimum(cgroup + 1, num_landmarks - 1)]
+        # rows closer to the previous landmark go first in the group
+        group[chunk] = cgroup
+        key[chunk] = prev_dist - next_dist
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(_assign, _chunks(num_rows, chunk_size)))
+    return np.lexsort((key, group))
+
+
+def embedding_order(rows, num_iterations=30, random_seed=None):
+    '''Get the order of the rows on the leading principal component
+
+    Parameters
+    ----------
+    rows : StandardizedRows
+    num_iterations : int, optional
+        number of power iterations
+    random_seed : int or None, optional
+
+    Returns
+    -------
+    numpy.ndarray of int
+        the new row order
+    '''
+    rand = np.random.RandomState(random_seed)
+    vec = rand.normal(size=rows.num_cols)
+    for citer in range(num_iterations):
+        vec = rows.project_t(rows.project(vec))
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            break
+        vec = vec / norm
+    return np.argsort(rows.project(vec), kind='mergesort')
+
+
+def cluster_order(data, method='landmark', transform='standardize', **kwargs):
+    '''Get the approximate clustering order of the rows of data
+
+    Parameters
+    ----------
+    data : numpy.ndarray or scipy.sparse matrix
+        the rows to cluster
+    method : str, optional
+        'landmark' or 'embedding' (see module documentation)
+    transform : str or None, optional
+        'standardize' to log transform and standardize the rows, None to use the data as is
+    **kwargs :
+        passed to landmark_order / embedding_order
+
+    Returns
+    -------
+    numpy.ndarray of int
+        the new row order
+    '''
+    rows = StandardizedRows(data, transform=transform)
+    if method == 'landmark':
+        return landmark_order(rows, **kwargs)
+    if method == 'embedding':
+        return embedding_order(rows, **kwargs)
+    raise ValueError('Unknown clustering method %s. Available methods are %s' % (method, CLUSTER_METHODS))
+
+
+def cluster_scalable(exp, axis='f', method='landmark', transform='auto', **kwargs):
+    '''Cluster the features or samples of the experiment using the scalable clustering
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    axis : str, optional
+        'f' to cluster the features, 's' to cluster the samples
+    method : str, optional
+        'landmark' or 'embedding' (see module documentation)
+    transform : str or None, optional
+        'standardize' to log transform and standardize the rows, None to use the data as is, or
+        'auto' to transform as the exact clustering: 'standardize' for features (as calour
+        cluster_features) and None for samples (as calour cluster_data)
+    **kwargs :
+        passed to landmark_order / embedding_order
+
+    Returns
+    -------
+    calour.Experiment
+        with the features / samples reordered
+    '''
+    if transform == 'auto':
+        transform = 'standardize' if axis == 'f' else None
+    data = exp.data
+    if axis == 'f':
+        data = scipy.sparse.csr_matrix(data).T
+    order = cluster_order(data, method=method, transform=transform, **kwargs)
+    call = format_call('cluster_scalable', axis=axis, method=method, transform=transform, **kwargs)
+    if axis == 'f':
+        return subset_experiment(exp, feature_pos=order, call=call)
+    return subset_experiment(exp, sample_pos=order, call=call)
+
+
+def _mean_neighbor_distance(rows, order):
+    '''Mean distance between consecutive rows in the order (lower is a smoother heatmap)'''
+    total = 0
+    for chunk in _chunks(len(order) - 1, 10000):
+        a = order[chunk]
+        b = order[chunk + 1]
+        for ca, cb in zip(a, b):
+            total += np.sqrt(rows.sqdist(np.array([ca]), np.array([cb]))[0, 0])
+    return total / max(len(order) - 1, 1)
+
+
+def benchmark(num_features=100000, num_samples=500, density=0.05, num_compare=3000, random_seed=2020):
+    '''Benchmark the scalable clustering on random data
+
+    Times the landmark and embedding methods on num_features features, and compares the
+    ordering quality (mean distance between neighboring features) with the exact
+    hierarchical clustering on a subset of num_compare features
+
+    Parameters
+    ----------
+    num_features, num_samples : int, optional
+        the size of the benchmark data
+    density : float, optional
+        the fraction of non-zero values
+    num_compare : int, optional
+        number of features to compare with the exact clustering
+    random_seed : int, optional
+
+    Returns
+    -------
+    dict
+        the timing (seconds) and neighbor distances for each method
+    '''
+    rand = np.random.RandomState(random_seed)
+    # features belong to groups with similar sample patterns, so there is a structure to find
+    num_groups = 50
+    profiles = rand.exponential(size=(num_groups, num_samples)) * 100
+    groups = rand.randint(num_groups, size=num_features)
+    data = scipy.sparse.random(num_features, num_samples, density=density, format='csr', random_state=rand)
+    data.data = rand.poisson(profiles[groups[data.nonzero()[0]], data.nonzero()[1]]).astype(float) + 1
+    results = {}
+    for cmethod in CLUSTER_METHODS:
+        start = time.time()
+        cluster_order(data, method=cmethod, random_seed=random_seed)
+        results['%s_seconds' % cmethod] = time.time() - start
+
+    sub = data[:num_compare]
+    rows = StandardizedRows(sub)
+    dist = np.sqrt(rows.sqdist(np.arange(num_compare), np.arange(num_compare)))
+    np.fill_diagonal(dist, 0)
+    exact = hierarchy.leaves_list(hierarchy.single(squareform((dist + dist.T) / 2, checks=False)))
+    del dist
+    results['exact_neighbor_distance'] = _mean_neighbor_distance(rows, exact)
+    results['random_neighbor_distance'] = _mean_neighbor_distance(rows, rand.permutation(num_compare))
+    for cmethod in CLUSTER_METHODS:
+        results['%s_neighbor_distance' % cmethod] = _mean_neighbor_distance(rows, cluster_order(sub, method=cmethod, random_seed=random_seed))
+    return results
+
+
+if __name__ == '__main__':
+    for k, v in benchmark().items():
+        print('%s: %f' % (k, v))
@@ -0,0 +1,776 @@
+'''The EZCalour actions without the GUI
+
+The compute part of each GUI action (sample_*, feature_*, analysis_*), the loaders,
+primer trimming and the config file reading. Does not import Qt, and calour (and other
+heavy modules) are only imported when first used, so this module imports fast and can be
+used from scripts, Jupyter or batch jobs:
+
+    from ezcalour_module import core
+    exp = core.read_amplicon('table.biom', 'map.txt')
+    exp = core.sample_filter_query(exp, 'body_site in (gut, oral) and age > 30')
+    exp = core.analysis_diff_abundance(exp, 'treatment', ['a'])
+
+Each action returning a new experiment sets its _studyname to the name parameter
+(or a name derived from the parameters if name is None or empty), as in the GUI.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import re
+import json
+from logging import getLogger
+from collections import defaultdict
+
+import numpy as np
+
+from ezcalour_module import metadata
+from ezcalour_module import query
+from ezcalour_module import taxonomy
+from ezcalour_module import aggregate
+from ezcalour_module import native
+from ezcalour_module import biomselect
+from ezcalour_module import stats
+from ezcalour_module.experiment import format_call
+
+logger = getLogger(__name__)
+
+DEFAULT_PRIMERS = {'515F': 'GTGCCAGC[AC]GCCGCGGTAA', '384F': 'CCTACGGG[ACGT][CGT]GC[AT][CG]CAG', '27F': 'AGAGTTTGATC[AC]TGGCTCAG'}
+
+DIFF_ABUNDANCE_METHODS = ['rankmean', 'mean', 'binary']
+
+FEATURE_CLUSTER_METHODS = ['auto', 'exact', 'scalable landmark', 'scalable embedding']
+
+BETA_DIVERSITY_METHODS = ['braycurtis', 'jaccard', 'euclidean']
+
+MERGE_METHODS = aggregate.MERGE_METHODS
+
+TAXONOMY_LEVELS = taxonomy.RANKS
+
+
+def _named(newexp, name, default):
+    '''Set the experiment _studyname to name (or default if name is empty) and return it'''
+    if newexp is not None:
+        newexp._studyname = name if name else default
+    return newexp
+
+
+######################
+# loading
+######################
+
+
+def read_amplicon(table_file, map_file=None, normalize=10000, min_reads=1000, name=None, sample_query=None, min_feature_reads=None, feature_ids=None):
+    '''Read an amplicon biom table
+
+    Parameters
+    ----------
+    table_file : str
+        the biom table
+    map_file : str or None, optional
+        the mapping file
+    normalize : int or None, optional
+        number of reads to normalize each sample to. None to skip normalization
+    min_reads : int or None, optional
+        remove samples with less than min_reads reads
+    name : str or None, optional
+        the experiment name. None to use the table file name
+    sample_query : str or None, optional
+        read only the samples matching the metadata query (see query.py)
+    min_feature_reads : float or None, optional
+        read only the features with at least min_feature_reads total reads in the selected samples
+    feature_ids : list of str or None, optional
+        read only these features
+
+    Returns
+    -------
+    calour.AmpliconExperiment
+    '''
+    if biomselect.has_selection(sample_query, min_feature_reads, feature_ids):
+        expdat = biomselect.read_selected(table_file, map_file, normalize=normalize, min_reads=min_reads, sample_query=sample_query,
+                                          min_feature_reads=min_feature_reads, feature_ids=feature_ids)
+        return _named(expdat, name, os.path.basename(os.path.normpath(table_file)))
+    import calour as ca
+    expdat = ca.read_amplicon(table_file, sample_metadata_file=map_file, min_reads=min_reads, normalize=normalize,
+                              sample_metadata_kwargs=metadata.read_kwargs(map_file))
+    return _named(expdat, name, os.path.basename(os.path.normpath(table_file)))
+
+
+def read_qiime2(table_file, map_file=None, rep_seq_file=None, taxonomy_file=None, normalize=10000, min_reads=1000, name=None):
+    '''Read a qiime2 table artifact (.qza), with optional representative sequences and taxonomy artifacts
+
+    Returns
+    -------
+    calour.AmpliconExperiment
+    '''
+    import calour as ca
+    expdat = ca.read_qiime2(table_file, sample_metadata_file=map_file, rep_seq_file=rep_seq_file, taxonomy_file=taxonomy_file,
+                            min_reads=min_reads, normalize=normalize, sample_metadata_kwargs=metadata.read_kwargs(map_file))
+    return _named(expdat, name, os.path.basename(os.path.normpath(table_file)))
+
+
+def read_ms(table_file, map_file=None, gnps_file=None, normalize=None, name=None, streaming=True, sparse=False, dtype='float64'):
+    '''Read an MZMine2 metabolomics table, with an optional GNPS bucket file
+
+    Parameters
+    ----------
+    streaming : bool, optional
+        True to read the table in chunks (bounded memory, see textread). False to use calour.read_ms
+    sparse : bool, optional
+        True to store the data as a sparse matrix (streaming only)
+    dtype : str, optional
+        the data type ('float64' or 'float32' to halve the memory) (streaming only)
+
+    Returns
+    -------
+    calour.MS1Experiment
+    '''
+    if streaming:
+        from ezcalour_module import textread
+        expdat = textread.read_ms(table_file, map_file, gnps_file=gnps_file, normalize=normalize, sparse=sparse, dtype=dtype)
+    else:
+        import calour as ca
+        expdat = ca.read_ms(table_file, map_file, gnps_file=gnps_file, normalize=normalize,
+                            sample_metadata_kwargs=metadata.read_kwargs(map_file))
+    return _named(expdat, name, os.path.basename(os.path.normpath(table_file)))
+
+
+def read_generic(table_file, map_file=None, normalize=None, name=None, streaming=True, sparse=False, dtype='float64'):
+    '''Read a generic tab separated table (features are rows, samples are columns)
+
+    Parameters
+    ----------
+    streaming : bool, optional
+        True to read the table in chunks (bounded memory, see textread). False to use calour.read
+    sparse : bool, optional
+        True to store the data as a sparse matrix (streaming only)
+    dtype : str, optional
+        the data type ('float64' or 'float32' to halve the memory) (streaming only)
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    if streaming:
+        from ezcalour_module import textread
+        expdat = textread.read_generic(table_file, map_file, normalize=normalize, sparse=sparse, dtype=dtype)
+    else:
+        import calour as ca
+        expdat = ca.read(table_file, map_file, normalize=normalize, data_file_type='tsv',
+                         sample_metadata_kwargs=metadata.read_kwargs(map_file))
+    return _named(expdat, name, os.path.basename(os.path.normpath(table_file)))
+
+
+def read_native(table_dir, name=None):
+    '''Read an EZCalour native experiment directory (.ezc)
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    if table_dir is None or not native.is_native(table_dir):
+        raise ValueError('%s is not an EZCalour native experiment directory' % table_dir)
+    return _named(native.read_native(table_dir), name, os.path.basename(os.path.normpath(table_dir)))
+
+
+def read_out_of_core(table_file, map_file=None, normalize=10000, min_reads=1000, cache_mb=512, name=None):
+    '''Open an HDF5 biom table larger than the memory as an out-of-core experiment (see outofcore.py)
+
+    Parameters
+    ----------
+    cache_mb : int, optional
+        the maximal size (MB) of the in-memory cache of the table chunks
+
+    Returns
+    -------
+    outofcore.OutOfCoreExperiment
+    '''
+    from ezcalour_module import outofcore
+
+    expdat = outofcore.read_out_of_core(table_file, map_file, normalize=normalize, min_reads=min_reads, cache_bytes=cache_mb * 2 ** 20)
+    return _named(expdat, name, os.path.basename(os.path.normpath(table_file)))
+
+
+def read_biom(tablefname, mapfname=None, normalize=10000, min_reads=None):
+    '''Read an amplicon biom table. Returns None (and logs a warning) if the load failed'''
+    try:
+        logger.debug('loading biom table %s map file %s using calour' % (tablefname, mapfname))
+        expdat = read_amplicon(tablefname, mapfname, normalize=normalize, min_reads=min_reads)
+    except Exception as e:
+        logger.warning('Load for amplicon biom table %s map %s failed:\n%s' % (tablefname, mapfname, e))
+        return None
+    return expdat
+
+
+def unzip_qza(filename, mapfname):
+    '''Read the biom table from a qiime2 table artifact without qiime2. Returns None if failed'''
+    import zipfile
+    import tempfile
+
+    if not zipfile.is_zipfile(filename):
+        logger.warning('%s is not a valid zip file' % filename)
+        return None
+    fl = zipfile.ZipFile(filename)
+    biom_name = None
+    for fname in fl.namelist():
+        if fname.endswith('data/feature-table.biom'):
+            biom_name = fname
+            break
+    if biom_name is None:
+        logger.warning('No biom table in qza file %s' % filename)
+        return None
+    with tempfile.TemporaryDirectory() as tempdir:
+        logger.debug('extracting from qza zip')
+        oname = fl.extract(biom_name, tempdir)
+        expdat = read_biom(oname, mapfname)
+    return expdat
+
+
+######################
+# primers
+######################
+
+
+def trim_primer(seqs, primers=DEFAULT_PRIMERS):
+    '''Trim a known set of primers from sequences
+
+    Parameters
+    ----------
+    seqs: list of str
+        the sequences to find the primer in
+    primers: list of str, optional
+        the primers to search for
+
+    Returns
+    -------
+    mseqs: list of str
+        the trimmed sequences. sequences that did not match the primer are left unchanged
+    mpos: list of int
+        positions of the sequences that match the primer out of the list of sequences
+    max_primer: str
+        name ofthe primer identified the most
+    max_primer_seq: str
+        sequence of this primer
+    '''
+    mseqs = []
+    mpos = []
+    primer_count = defaultdict(int)
+    for idx, cseq in enumerate(seqs):
+        cseq = cseq.upper()
+        foundit = False
+        for cprimer_name, cprimer in primers.items():
+            match = re.search(cprimer, cseq)
+            if match is None:
+                continue
+            foundit = True
+            primer_count[cprimer_name] += 1
+            break
+        if foundit:
+            cseq = cseq[match.end():]
+            mpos.append(idx)
+        mseqs.append(cseq)
+    if len(primer_count) > 0:
+        max_primer = max(primer_count, key=lambda k: primer_count[k])
+        max_primer_seq = primers[max_primer]
+    else:
+        max_primer = 'NA'
+        max_primer_seq = 'NA'
+    return mseqs, mpos, max_primer, max_primer_seq
+
+
+def detect_primer(exp, num_test_seqs=200):
+    '''Test if one of the dbbact primers is still attached to the experiment sequences
+
+    Parameters
+    ----------
+    exp : calour.AmpliconExperiment
+    num_test_seqs : int, optional
+        number of random sequences to test
+
+    Returns
+    -------
+    (str, str) or None
+        the primer name and sequence if more than 1/4 of the tested sequences contain it, otherwise None
+    '''
+    tseqs = exp.feature_metadata.index.values[np.random.randint(len(exp.feature_metadata), size=num_test_seqs)]
+    mseqs, mpos, max_primer, max_primer_seq = trim_primer(tseqs)
+    if len(mpos) > num_test_seqs / 4:
+        return max_primer, max_primer_seq
+    return None
+
+
+def trim_experiment_primers(exp):
+    '''Trim the primers from the experiment feature ids (in place)
+
+    The original feature ids are kept in the '_orig_feature_id' feature metadata field
+
+    Parameters
+    ----------
+    exp : calour.AmpliconExperiment
+    '''
+    mseqs, mpos, max_primer, max_primer_seq = trim_primer(exp.feature_metadata.index.values)
+    exp.feature_metadata['_orig_feature_id'] = exp.feature_metadata['_feature_id']
+    exp.feature_metadata['_feature_id'] = mseqs
+    exp.feature_metadata.set_index('_feature_id', drop=False, inplace=True)
+
+
+######################
+# sample actions
+######################
+
+
+def sample_sort(exp, field, name=None):
+    '''Sort the samples by a metadata field'''
+    return _named(exp.sort_by_metadata(field, axis=0), name, '%s-sort-%s' % (exp._studyname, field))
+
+
+def sample_merge(exp, field, method='mean', random_seed=None, name=None):
+    '''Merge samples with the same metadata field value (see MERGE_METHODS and aggregate.py)'''
+    newexp = aggregate.aggregate_by_metadata(exp, field, method=method, axis='s', random_seed=random_seed)
+    metadata.keep_categoricals(newexp, exp)
+    return _named(newexp, name, '%s-merge-%s' % (exp._studyname, field))
+
+
+def sample_cluster(exp, name=None):
+    '''Cluster the samples (using the scalable clustering for large experiments)'''
+    from ezcalour_module import clustering
+
+    # the exact clustering needs all pairwise distances, so use the scalable clustering for large experiments
+    if exp.shape[0] > clustering.SCALABLE_MIN_ROWS:
+        logger.info('%d samples - using scalable clustering' % exp.shape[0])
+        newexp = clustering.cluster_scalable(exp, axis='s')
+    else:
+        newexp = exp.cluster_data(axis='s')
+    return _named(newexp, name, exp._studyname + '-cluster-samples')
+
+
+def sample_filter(exp, field, values, negate=False, name=None):
+    '''Keep the samples with a field value in values'''
+    newexp = exp.filter_samples(field, values, negate=negate)
+    metadata.keep_categoricals(newexp, exp)
+    if negate:
+        default = '%s-%s-not-%s' % (exp._studyname, field, values)
+    else:
+        default = '%s-%s-%s' % (exp._studyname, field, values)
+    return _named(newexp, name, default)
+
+
+def sample_filter_query(exp, query_str, name=None):
+    '''Keep the samples matching the metadata query (see query.py)'''
+    return _named(query.filter_query(exp, query_str), name, '%s-%s' % (exp._studyname, query_str))
+
+
+def sample_normalize(exp, total=10000, name=None):
+    '''Normalize each sample to total reads'''
+    return _named(exp.normalize(total), name, '%s-normalize' % exp._studyname)
+
+
+def sample_join_fields(exp, field1, field2, name=None):
+    '''Add a metadata field joining the values of two fields'''
+    newexp = exp.join_metadata_fields(field1=field1, field2=field2)
+    metadata.keep_categoricals(newexp, exp)
+    # the joined field is categorical if the source fields are
+    new_fields = [ccol for ccol in newexp.sample_metadata.columns if ccol not in exp.sample_metadata.columns]
+    metadata.categorize(newexp.sample_metadata, columns=new_fields)
+    return _named(newexp, name, '%s-join-%s-%s' % (exp._studyname, field1, field2))
+
+
+def sample_filter_by_original_reads(exp, min_reads, name=None):
+    '''Keep samples with at least min_reads original reads'''
+    newexp = stats.filter_by_stat(exp, 'original_reads', min_reads, format_call('filter_orig_reads', min_reads=min_reads))
+    return _named(newexp, name, '%s-min-%d' % (exp._studyname, min_reads))
+
+
+######################
+# feature actions
+######################
+
+
+def feature_filter_min_reads(exp, min_reads, name=None):
+    '''Keep features with at least min_reads total reads'''
+    newexp = stats.filter_by_stat(exp, 'sum', min_reads, format_call('filter_abundance', cutoff=min_reads))
+    return _named(newexp, name, '%s-minreads-%d' % (exp._studyname, min_reads))
+
+
+def feature_filter_taxonomy(exp, values, negate=False, exact=False, rank=None, name=None):
+    '''Keep features matching the taxonomy values (see taxonomy.filter_taxonomy)'''
+    newexp = taxonomy.filter_taxonomy(exp, values, negate=negate, substring=not exact, rank=rank)
+    return _named(newexp, name, '%s-tax-%s' % (exp._studyname, values))
+
+
+def feature_cluster(exp, min_reads=10, method='auto', name=None):
+    '''Cluster the features with at least min_reads total reads
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    min_reads : int, optional
+    method : str, optional
+        'exact' for the calour clustering, 'scalable landmark' / 'scalable embedding' for the
+        scalable clustering (see clustering.py), or 'auto' to select by the number of features
+    name : str or None, optional
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    from ezcalour_module import clustering
+
+    if method == 'auto':
+        method = 'scalable landmark' if exp.shape[1] > clustering.SCALABLE_MIN_ROWS else 'exact'
+    if method == 'exact':
+        newexp = exp.cluster_features(cutoff=min_reads)
+    else:
+        newexp = exp.filter_abundance(cutoff=min_reads)
+        newexp = clustering.cluster_scalable(newexp, axis='f', method=method.split()[-1])
+    return _named(newexp, name, '%s-cluster-features-min-%d' % (exp._studyname, min_reads))
+
+
+def feature_filter_fasta(exp, fasta_file, negate=False, name=None):
+    '''Keep the features appearing in the fasta file'''
+    newexp = exp.filter_by_fasta(fp=fasta_file, negate=negate)
+    return _named(newexp, name, '%s-cluster-fasta-%s' % (exp._studyname, fasta_file))
+
+
+def feature_filter_prevalence(exp, fraction, name=None):
+    '''Keep features present in at least fraction of the samples'''
+    newexp = stats.filter_by_stat(exp, 'prevalence', fraction, format_call('filter_prevalence', fraction=fraction))
+    return _named(newexp, name, '%s-minreads-%f' % (exp._studyname, fraction))
+
+
+def feature_filter_mean(exp, cutoff, name=None):
+    '''Keep features with mean frequency of at least cutoff'''
+    newexp = stats.filter_by_stat(exp, 'relative_mean', cutoff, format_call('filter_mean_abundance', cutoff=cutoff))
+    return _named(newexp, name, '%s-minreads-%f' % (exp._studyname, cutoff))
+
+
+def feature_sort_abundance(exp, field=None, value=None, name=None):
+    '''Sort the features by abundance (in the samples with field=value, or all samples if field is None)'''
+    if field is None:
+        sample_mask = None
+    else:
+        sample_mask = exp.sample_metadata[field].isin([value]).values
+    newexp = stats.sort_by_mean(exp, sample_mask, call=format_call('sort_abundance', field=field, value=value))
+    return _named(newexp, name, '%s-sort-abundance' % exp._studyname)
+
+
+def check_amplicon(exp):
+    '''Raise ValueError if exp is not an AmpliconExperiment'''
+    import calour as ca
+
+    # out of core experiments keep the name of the calour class they are read into
+    if not isinstance(exp, ca.AmpliconExperiment) and getattr(exp, 'exp_class', None) != 'AmpliconExperiment':
+        raise ValueError("Can only collapse taxonomy for AmpliconExperiment (select in load)\nCurrent exp type is %s" % type(exp))
+
+
+def feature_collapse_taxonomy(exp, level, name=None):
+    '''Collapse the features to the taxonomy level (i.e. 'genus')'''
+    check_amplicon(exp)
+    return _named(aggregate.collapse_taxonomy(exp, level), name, '%s-collapse-taxonomy-%s' % (exp._studyname, level))
+
+
+def feature_collapse_taxonomy_levels(exp, levels=None, name=None):
+    '''Collapse the features at each of the taxonomy levels (all levels if levels is None)
+
+    Returns
+    -------
+    list of calour.AmpliconExperiment
+        named '<name>-<level>' (or '<study name>-collapse-taxonomy-<level>' if name is empty)
+    '''
+    check_amplicon(exp)
+    if levels is None:
+        levels = TAXONOMY_LEVELS
+    newexps = aggregate.collapse_taxonomy_levels(exp, levels)
+    return [_named(cexp, '%s-%s' % (name, clevel) if name else None, '%s-collapse-taxonomy-%s' % (exp._studyname, clevel))
+            for cexp, clevel in zip(newexps, levels)]
+
+
+def feature_filter_pipeline(exp, steps, name=None):
+    '''Run a list of (step name, params) filter / normalize steps in one pass (see pipeline.py)'''
+    from ezcalour_module.pipeline import run_pipeline
+
+    newexp = run_pipeline(exp, steps)
+    return _named(newexp, name, '%s-pipeline-%s' % (exp._studyname, '-'.join([cstep[0] for cstep in steps])))
+
+
+######################
+# analysis actions
+######################
+
+
+def analysis_diff_abundance(exp, field, val1, val2=None, alpha=0.1, method='rankmean', random_seed=2020, name=None):
+    '''Differential abundance test between two groups of samples
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    field : str
+        the field defining the groups
+    val1 : list of str
+        the field values of group 1
+    val2 : list of str or None, optional
+        the field values of group 2. None (or empty) to use all samples not in group 1
+    alpha : float, optional
+        the FDR level
+    method : str, optional
+        'rankmean', 'mean' or 'binary'
+    random_seed : int or None, optional
+        None to not set the random seed
+    name : str or None, optional
+
+    Returns
+    -------
+    calour.Experiment or None
+        the significant features (None if none found)
+    '''
+    transforms = {'rankmean': 'rankdata', 'mean': None, 'binary': 'binarydata'}
+    if method not in transforms:
+        raise ValueError('Unknown method %s. Available methods are %s' % (method, DIFF_ABUNDANCE_METHODS))
+    # if no value supplied for group2, make it None so will use all other samples
+    if val2 == '' or val2 == [''] or val2 == []:
+        val2 = None
+    from ezcalour_module import permtest
+
+    newexp = permtest.diff_abundance(exp, field=field, val1=val1, val2=val2, alpha=alpha, transform=transforms[method], random_seed=random_seed)
+    return _named(newexp, name, '%s-diff-%s' % (exp._studyname, field))
+
+
+def analysis_correlation(exp, field, method='spearman', nonzero=False, alpha=0.1, random_seed=2020, name=None):
+    '''Features correlated with a metadata field
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    field : str
+    method : str, optional
+        'spearman' or 'pearson'
+    nonzero : bool, optional
+        True to correlate each feature only on the samples where it is non-zero
+    alpha : float, optional
+        the FDR level
+    random_seed : int or None, optional
+        None to not set the random seed
+    name : str or None, optional
+
+    Returns
+    -------
+    calour.Experiment or None
+        the significant features (None if none found)
+    '''
+    from ezcalour_module import permtest
+
+    newexp = permtest.correlation(exp, field=field, method=method, nonzero=nonzero, alpha=alpha, random_seed=random_seed)
+    return _named(newexp, name, '%s-correlation-%s' % (exp._studyname, field))
+
+
+def clear_test_cache():
+    '''Remove the cached permutation test results (kept for re-running diff abundance / correlation with another FDR level)
+
+    Returns
+    -------
+    int
+        the number of bytes freed
+    '''
+    from ezcalour_module import permtest
+
+    return permtest.clear_cache()
+
+
+def analysis_beta_diversity(exp, method='braycurtis', num_axes=3, random_seed=2020, name=None):
+    '''PCoA of the beta diversity distances between the samples
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    method : str, optional
+        the distance method (see BETA_DIVERSITY_METHODS)
+    num_axes : int, optional
+        number of PCoA axes to add as sample metadata fields ('<method>_PC1', '<method>_PC2'...)
+    random_seed : int or None, optional
+    name : str or None, optional
+
+    Returns
+    -------
+    calour.Experiment
+        with the sample coordinates in the sample metadata (see ordination.beta_diversity)
+    '''
+    from ezcalour_module import ordination
+
+    newexp = ordination.beta_diversity(exp, method=method, num_axes=num_axes, random_seed=random_seed)
+    return _named(newexp, name, '%s-pcoa-%s' % (exp._studyname, method))
+
+
+def plot_ordination(exp, field=None):
+    '''Get the PC1 / PC2 scatter plot figure of an analysis_beta_diversity result experiment'''
+    from ezcalour_module import ordination
+
+    return ordination.plot_ordination(exp, field=field)
+
+
+def analysis_dbbact_wordcloud(exp):
+    '''Get the dbBact wordcloud figure of the experiment features'''
+    import calour as ca
+
+    db = ca.database._get_database_class('dbbact')
+    return db.draw_wordcloud(exp)
+
+
+def enrichment_group_names(exp):
+    '''Get the names of the two groups of a diff. abundance / correlation result experiment
+
+    Returns
+    -------
+    (str, str)
+        the group names ('Group1' / 'Group2' if not available)
+    '''
+    if '_calour_stat' not in exp.feature_metadata.columns:
+        raise ValueError('Enrichment only works on diff. abundance/correlation result experiments')
+    names = []
+    for cmask, cdefault in [(exp.feature_metadata['_calour_stat'] > 0, 'Group1'), (exp.feature_metadata['_calour_stat'] < 0, 'Group2')]:
+        cnames = exp.feature_metadata['_calour_direction'][cmask]
+        names.append(cnames.values[0] if len(cnames) > 0 else cdefault)
+    return tuple(names)
+
+
+def analysis_dbbact_enrichment(exp, min_exps=0, show_legend=True):
+    '''Plot the dbBact term enrichment of a diff. abundance / correlation result experiment
+
+    Returns
+    -------
+    (matplotlib.axes.Axes, calour.Experiment)
+        the enrichment bar plot and the enriched terms experiment
+    '''
+    if '_calour_stat' not in exp.feature_metadata.columns:
+        raise ValueError('Enrichment only works on diff. abundance/correlation result experiments')
+    return exp.plot_diff_abundance_enrichment(ignore_exp=True, min_exps=min_exps, show_legend=show_legend)
+
+
+######################
+# config file
+######################
+
+
+def get_config_file():
+    '''Get the ezcalour config file location
+
+    If the environment EZCALOUR_CONFIG_FILE is set, take the config file from it
+    otherwise return EZCALOUR_PACKAGE_LOCATION/ezcalour_module/ezcalour.config
+
+    Returns
+    -------
+    config_file_name : str
+        the full path to the calour config file
+    '''
+    if 'EZCALOUR_CONFIG_FILE' in os.environ:
+        config_file_name = os.environ['EZCALOUR_CONFIG_FILE']
+        logger.debug('Using calour config file %s from EZCALOUR_CONFIG_FILE variable' % config_file_name)
+    else:
+        from ezcalour_module.util import get_res_file_name
+        config_file_name = get_res_file_name('ezcalour.config')
+    return config_file_name
+
+######################
+# json comments functions modified from:
+# https://pypi.python.org/pypi/jsoncomment/0.2.3
+######################
+
+
+def comment_json_loads(custom_json_string, *args, **kwargs):
+    lines = custom_json_string.splitlines()
+    standard_json = json_preprocess(lines)
+    return json.loads(standard_json, *args, **kwargs)
+
+
+def comment_json_load(custom_json_file, *args, **kwargs):
+    return comment_json_loads(custom_json_file.read(), *args, **kwargs)
+
+
+def json_preprocess(lines):
+    # Comments
+    COMMENT_PREFIX = ("#", ";")
+    MULTILINE_START = "/*"
+    MULTILINE_END = "*/"
+
+    # Data strings
+    LONG_STRING = '"""'
+
+    standard_json = ""
+    is_multiline = False
+    keep_trail_space = 0
+
+    for line in lines:
+
+        # 0 if there is no trailing space
+        # 1 otherwise
+        keep_trail_space = int(line.endswith(" "))
+
+        # Remove all whitespace on both sides
+        line = line.strip()
+
+        # Skip blank lines
+        if len(line) == 0:
+            continue
+
+        # Skip single line comments
+        if line.startswith(COMMENT_PREFIX):
+            continue
+
+        # Mark the start of a multiline comment
+        # Not skipping, to identify single line comments using
+        #   multiline comment tokens, like
+        #   /***** Comment *****/
+        if line.startswith(MULTILINE_START):
+            is_multiline = True
+
+        # Skip a line of multiline comments
+        if is_multiline:
+            # Mark the end of a multiline comment
+            if line.endswith(MULTILINE_END):
+                is_multiline = False
+            continue
+
+        # Replace the multi line data token to the JSON valid one
+        if LONG_STRING in line:
+            line = line.replace(LONG_STRING, '"')
+
+        standard_json += line + " " * keep_trail_space
+
+    # Removing non-standard trailing commas
+    standard_json = standard_json.replace(",]", "]")
+    standard_json = standard_json.replace(",}", "}")
+
+    return standard_json
+
+
+def get_config_values(section=None, config_file_name=None):
+    '''Read the config json file and return the dict associated with section
+
+    Parameters
+    ----------
+    section : str or None
+        The config file section to read. if None return all file
+        Note: the config file is a json dict file, each section is a key
+        If section is not found, return empty dict {}
+    config_file_name: str or None
+        name of json config file to use
+        None to load the default ezcalour config file
+    '''
+    if config_file_name is None:
+        config_file_name = get_config_file()
+    try:
+        with open(config_file_name) as f:
+            conf = dict(comment_json_load(f))
+        if section is None:
+            return conf
+        if section not in conf:
+            return {}
+        return conf[section]
+    except:
+        logger.warn('Failed reading ezcalour config file %s section %s' % (config_file_name, section))
+        return {}
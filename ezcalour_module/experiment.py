@@ -0,0 +1,137 @@
+'''Helper functions for creating new calour experiments without going through Qt
+
+These work directly on the experiment data matrix (dense or scipy.sparse csr) and
+metadata so a derived experiment is created with a single copy of the data.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from logging import getLogger
+
+import numpy as np
+import scipy.sparse
+
+logger = getLogger(__name__)
+
+
+def format_call(name, **kwargs):
+    '''Get the call history string for a function call
+
+    Parameters
+    ----------
+    name : str
+        the function name
+    **kwargs :
+        the function parameters
+
+    Returns
+    -------
+    str
+        of the form name(param1=value1, param2=value2...)
+    '''
+    return '%s(%s)' % (name, ', '.join(['%s=%r' % (k, v) for k, v in kwargs.items()]))
+
+
+def subset_data(data, sample_pos=None, feature_pos=None):
+    '''Get the data matrix subset for the sample and feature positions
+
+    For a csr matrix, the column subset is done on the index arrays (no intermediate matrix)
+
+    Parameters
+    ----------
+    data : numpy.ndarray or scipy.sparse.csr_matrix
+        the data matrix (samples x features)
+    sample_pos : numpy.ndarray of int or None, optional
+        the rows to keep (in the new order). None to keep all
+    feature_pos : numpy.ndarray of int or None, optional
+        the columns to keep (in the new order). None to keep all
+
+    Returns
+    -------
+    numpy.ndarray or scipy.sparse.csr_matrix
+        the new data matrix (always a copy)
+    '''
+    if not scipy.sparse.issparse(data):
+        if sample_pos is None:
+            sample_pos = np.arange(data.shape[0])
+        if feature_pos is None:
+            feature_pos = np.arange(data.shape[1])
+        return data[np.ix_(sample_pos, feature_pos)]
+
+    data = scipy.sparse.csr_matrix(data)
+    if sample_pos is None:
+        rows = data.copy()
+    else:
+        rows = data[sample_pos]
+    if feature_pos is None:
+        return rows
+    # the new position of each old feature (-1 for removed features)
+    newpos = np.full(data.shape[1], -1, dtype=np.int64)
+    newpos[feature_pos] = np.arange(len(feature_pos))
+    if len(np.unique(feature_pos)) != len(feature_pos) or np.any(np.diff(feature_pos) < 0):
+        # reordering or duplicating features - use the standard scipy column indexing
+        return rows[:, feature_pos]
+    keep = newpos[rows.indices] >= 0
+    row_ids = np.repeat(np.arange(rows.shape[0]), np.diff(rows.indptr))
+    row_counts = np.bincount(row_ids[keep], minlength=rows.shape[0])
+    indptr = np.concatenate([[0], np.cumsum(row_counts)])
+    return scipy.sparse.csr_matrix((rows.data[keep], newpos[rows.indices[keep]], indptr), shape=(rows.shape[0], len(feature_pos)))
+
+
+def subset_experiment(exp, sample_pos=None, feature_pos=None, data=None, call=None):
+    '''Create a new experiment with a subset of the samples and features
+
+    The new experiment shares all the attributes of exp (databases, normalization, study name etc.)
+    except the data, metadata, info and call history which are copied
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+        the experiment to subset
+    sample_pos : numpy.ndarray of int or None, optional
+        the sample positions to keep (in the new order). None to keep all
+    feature_pos : numpy.ndarray of int or None, optional
+        the feature positions to keep (in the new order). None to keep all
+    data : numpy.ndarray or scipy.sparse.csr_matrix or None, optional
+        the data of the new experiment (if already computed). None to subset exp.data
+    call : str or list of str or None, optional
+        the call history entries to add to the new experiment
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    if getattr(exp, 'out_of_core', False):
+        if data is not None:
+            # the data was computed from the table on disk, so the result is in memory
+            return exp.with_data(data, sample_pos=sample_pos, feature_pos=feature_pos, call=call)
+        # a new view of the table on disk (see outofcore.py)
+        return exp.subset(sample_pos=sample_pos, feature_pos=feature_pos, call=call)
+    if data is None:
+        data = subset_data(exp.data, sample_pos, feature_pos)
+    newexp = exp.__class__.__new__(exp.__class__)
+    newexp.__dict__.update(exp.__dict__)
+    # the shared memory segments belong to exp (see sharedmem.py)
+    newexp.__dict__.pop('_ezcalour_shared', None)
+    newexp.data = data
+    if sample_pos is None:
+        newexp.sample_metadata = exp.sample_metadata.copy()
+    else:
+        newexp.sample_metadata = exp.sample_metadata.iloc[sample_pos].copy()
+    if feature_pos is None:
+        newexp.feature_metadata = exp.feature_metadata.copy()
+    else:
+        newexp.feature_metadata = exp.feature_metadata.iloc[feature_pos].copy()
+    newexp.info = dict(exp.info)
+    newexp._call_history = list(getattr(exp, '_call_history', []))
+    if call is not None:
+        if isinstance(call, str):
+            call = [call]
+        newexp._call_history.extend(call)
+    return newexp
@@ -0,0 +1,339 @@
+'''Chunked, compressed export of experiments
+
+Writes the biom table (streamed in blocks into a compressed HDF5 biom file), the
+metadata, the sequences fasta (optionally gzipped) and the command history
+concurrently. Does not depend on Qt so it can be used from the command line or a
+background thread in the GUI.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import datetime
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse
+
+from ezcalour_module import __version__
+from ezcalour_module import native
+
+logger = getLogger(__name__)
+
+COMPRESSION_TYPES = ['gzip', 'zstd', 'lzf', 'none']
+
+# number of rows (samples or features) written to the HDF5 file in each block
+BLOCK_ROWS = 4096
+
+
+def _hdf5_filter(compression='gzip', level=4):
+    '''Get the h5py dataset compression keyword arguments
+
+    Parameters
+    ----------
+    compression : str, optional
+        'gzip', 'zstd' (needs the hdf5plugin package), 'lzf' or 'none'
+    level : int, optional
+        the compression level (for gzip 0-9, for zstd 1-22)
+
+    Returns
+    -------
+    dict
+        keyword arguments for h5py create_dataset
+    '''
+    if compression is None or compression == 'none':
+        return {}
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': level}
+    if compression == 'lzf':
+        return {'compression': 'lzf'}
+    if compression == 'zstd':
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ValueError('zstd compression requires the hdf5plugin package (pip install hdf5plugin)')
+        return dict(hdf5plugin.Zstd(clevel=level))
+    raise ValueError('Unknown compression %s. Available options are %s' % (compression, COMPRESSION_TYPES))
+
+
+def _line_blocks(data, axis):
+    '''Get the number of non-zeros in each row (axis=0) or column (axis=1) of the data, and a function returning the sparse blocks of lines
+
+    Only one block of lines is converted at a time, and the data/indices of a csr matrix rows (or csc matrix columns) are used without a copy
+
+    Parameters
+    ----------
+    data : numpy.ndarray or scipy.sparse.csr_matrix or scipy.sparse.csc_matrix
+    axis : int
+        0 for rows, 1 for columns
+
+    Returns
+    -------
+    line_nnz : numpy.ndarray of int
+        the number of non-zeros in each line
+    get_block : function
+        get_block(start, end) returns the (data, indices) of the lines start to end (as in a csr matrix with the lines as rows)
+    '''
+    native_format = 'csr' if axis == 0 else 'csc'
+    if scipy.sparse.issparse(data) and data.format == native_format:
+        def get_block(start, end):
+            pstart, pend = data.indptr[start], data.indptr[end]
+            return data.data[pstart:pend], data.indices[pstart:pend]
+        return np.diff(data.indptr), get_block
+    if scipy.sparse.issparse(data):
+        def get_block(start, end):
+            block = data[start:end] if axis == 0 else data[:, start:end]
+            block = block.asformat(native_format)
+            return block.data, block.indices
+        return np.bincount(data.indices, minlength=data.shape[axis]), get_block
+
+    def get_block(start, end):
+        if axis == 0:
+            block = scipy.sparse.csr_matrix(data[start:end])
+        else:
+            block = scipy.sparse.csc_matrix(data[:, start:end])
+        return block.data, block.indices
+    return np.count_nonzero(data, axis=1 - axis), get_block
+
+
+def _write_group(grp, line_nnz, get_block, ids, filter_args, progress=None, progress_name=None):
+    '''Write a matrix (rows are the group ids) into a biom hdf5 group, streaming in row blocks (see _line_blocks)'''
+    num_rows = len(line_nnz)
+    indptr = np.concatenate([[0], np.cumsum(line_nnz)])
+    nnz = int(indptr[-1])
+    grp.create_dataset('ids', data=np.array([str(x).encode() for x in ids], dtype=object), dtype=_string_dtype())
+    mgrp = grp.create_group('matrix')
+    if nnz > 0:
+        dsargs = dict(chunks=(min(nnz, 1 << 16),), **filter_args)
+    else:
+        # hdf5 does not allow chunking/compression of empty datasets
+        dsargs = {}
+    dsdata = mgrp.create_dataset('data', shape=(nnz,), dtype=np.float64, **dsargs)
+    dsindices = mgrp.create_dataset('indices', shape=(nnz,), dtype=np.int32, **dsargs)
+    mgrp.create_dataset('indptr', data=indptr.astype(np.int32), **filter_args)
+    for start in range(0, num_rows, BLOCK_ROWS):
+        end = min(start + BLOCK_ROWS, num_rows)
+        pstart = indptr[start]
+        pend = indptr[end]
+        bdata, bindices = get_block(start, end)
+        if len(bdata) != pend - pstart:
+            raise ValueError('block %d-%d of %s has %d values instead of %d' % (start, end, progress_name, len(bdata), pend - pstart))
+        if pend > pstart:
+            dsdata[pstart:pend] = bdata
+            dsindices[pstart:pend] = bindices
+        if progress is not None:
+            progress(progress_name, end / max(num_rows, 1))
+    grp.create_group('metadata')
+    grp.create_group('group-metadata')
+
+
+def _string_dtype():
+    import h5py
+    return h5py.special_dtype(vlen=bytes)
+
+
+def save_biom_hdf5(exp, fname, compression='gzip', level=4, progress=None):
+    '''Save the experiment data as an HDF5 (biom 2.1) file, streaming the matrix in blocks
+
+    Only one block of samples (or features) is converted at a time, so no full copy of the data is made
+    (except for sparse data that is not in csr or csc format)
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    fname : str
+        the output biom file name
+    compression : str, optional
+        'gzip', 'zstd', 'lzf' or 'none'
+    level : int, optional
+        the compression level
+    progress : function or None, optional
+        called with (name, fraction done) while writing
+    '''
+    import h5py
+
+    filter_args = _hdf5_filter(compression, level)
+    data = exp.data
+    if scipy.sparse.issparse(data) and data.format not in ('csr', 'csc'):
+        data = data.tocsr()
+    # the observation group rows are our columns (features)
+    sample_nnz, sample_blocks = _line_blocks(data, axis=0)
+    feature_nnz, feature_blocks = _line_blocks(data, axis=1)
+
+    with h5py.File(fname, 'w') as fl:
+        fl.attrs['id'] = exp.info.get('data_file', 'ezcalour export')
+        fl.attrs['type'] = 'OTU table'
+        fl.attrs['format-url'] = 'http://biom-format.org'
+        fl.attrs['format-version'] = (2, 1)
+        fl.attrs['generated-by'] = 'EZCalour %s' % __version__
+        fl.attrs['creation-date'] = datetime.datetime.now().isoformat()
+        fl.attrs['shape'] = (data.shape[1], data.shape[0])
+        fl.attrs['nnz'] = int(np.sum(sample_nnz))
+        _write_group(fl.create_group('observation'), feature_nnz, feature_blocks, exp.feature_metadata.index, filter_args, progress, 'biom features')
+        if 'taxonomy' in exp.feature_metadata.columns:
+            taxonomy = [[clevel.strip().encode() for clevel in str(ctax).split(';')] for ctax in exp.feature_metadata['taxonomy']]
+            max_levels = max([len(x) for x in taxonomy] + [1])
+            taxonomy = [x + [b''] * (max_levels - len(x)) for x in taxonomy]
+            fl['observation/metadata'].create_dataset('taxonomy', data=np.array(taxonomy, dtype=object), dtype=_string_dtype(), **filter_args)
+        _write_group(fl.create_group('sample'), sample_nnz, sample_blocks, exp.sample_metadata.index, filter_args, progress, 'biom samples')
+    logger.debug('saved biom table %s' % fname)
+
+
+def verify_biom_hdf5(exp, fname):
+    '''Check that the biom file (read using the biom package) has the experiment ids, data and taxonomy
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    fname : str
+        the biom file written by save_biom_hdf5
+
+    Raises
+    ------
+    ValueError
+        if the file is different from the experiment
+    '''
+    import biom
+
+    table = biom.load_table(fname)
+    if list(table.ids(axis='sample')) != [str(x) for x in exp.sample_metadata.index]:
+        raise ValueError('sample ids in %s are different from the experiment' % fname)
+    if list(table.ids(axis='observation')) != [str(x) for x in exp.feature_metadata.index]:
+        raise ValueError('feature ids in %s are different from the experiment' % fname)
+    data = scipy.sparse.csr_matrix(exp.data)
+    diff = scipy.sparse.csr_matrix(table.matrix_data.T) - data
+    if diff.nnz > 0 and np.abs(diff.data).max() > 0:
+        raise ValueError('data in %s is different from the experiment (%d values differ)' % (fname, np.sum(diff.data != 0)))
+    if 'taxonomy' in exp.feature_metadata.columns:
+        taxonomy = [';'.join([x for x in cmd['taxonomy'] if x != '']) for cmd in table.metadata(axis='observation')]
+        expected = [';'.join([x.strip() for x in str(ctax).split(';') if x.strip() != '']) for ctax in exp.feature_metadata['taxonomy']]
+        if taxonomy != expected:
+            raise ValueError('taxonomy in %s is different from the experiment' % fname)
+    logger.debug('verified biom table %s' % fname)
+
+
+def save_fasta(exp, fname, compress=False, progress=None):
+    '''Save the feature ids (sequences) as a fasta file
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    fname : str
+        the output fasta file name
+    compress : bool, optional
+        True to write a gzipped fasta file
+    progress : function or None, optional
+        called with (name, fraction done) while writing
+    '''
+    seqs = exp.feature_metadata.index.values
+    num_seqs = len(seqs)
+    opener = gzip.open if compress else open
+    with opener(fname, 'wt') as fl:
+        for idx, cseq in enumerate(seqs):
+            fl.write('>%s\n%s\n' % (cseq, cseq))
+            if progress is not None and idx % 10000 == 0:
+                progress('fasta', idx / max(num_seqs, 1))
+    if progress is not None:
+        progress('fasta', 1)
+    logger.debug('saved fasta file %s' % fname)
+
+
+def save_command_history(exp, fname):
+    '''Save the command history of the experiment to file filename
+
+    Parameters
+    ----------
+    exp: calour.Experiment
+        the experiment to save the history of
+    fname: str
+        name of the text filename to write to
+    '''
+    logger.debug('saving commands')
+    data_file = exp.info.get('data_file', 'NA')
+    map_file = exp.info.get('sample_metadata_file', 'NA')
+    with open(fname, 'w') as fl:
+        fl.write('Command history for biom table %s, sample metadata file %s\n' % (data_file, map_file))
+        for ccommand in exp._call_history:
+            fl.write('%s\n' % ccommand)
+    logger.info('saved commands to file %s' % fname)
+
+
+def _save_metadata(exp, prefix):
+    exp.sample_metadata.to_csv('%s_sample.txt' % prefix, sep='\t')
+    exp.feature_metadata.to_csv('%s_feature.txt' % prefix, sep='\t')
+
+
+def export_experiment(exp, prefix, fmt='hdf5', compression='gzip', level=4, fasta=True, compress_fasta=False, history=True, progress=None,
+                      verify=False):
+    '''Save the experiment table, metadata, fasta and command history concurrently
+
+    Output files are prefix.biom, prefix_sample.txt, prefix_feature.txt, prefix.fasta(.gz) and prefix.history.txt
+    (or the prefix.ezc directory instead of the biom and metadata files for the native format)
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    prefix : str
+        the output file names prefix
+    fmt : str, optional
+        'hdf5' to write a chunked, compressed biom file. 'json' or 'txt' to save using calour (not chunked).
+        'native' to save in the EZCalour memory mapped format (see native.py)
+    compression : str, optional
+        'gzip', 'zstd', 'lzf' or 'none' (only for hdf5 format)
+    level : int, optional
+        the compression level
+    fasta : bool, optional
+        True to save the feature sequences fasta file
+    compress_fasta : bool, optional
+        True to gzip the fasta file
+    history : bool, optional
+        True to save the command history
+    progress : function or None, optional
+        called with (name, fraction done) while writing
+    verify : bool, optional
+        True to read back the hdf5 biom file and check it has the experiment ids, data and taxonomy (see verify_biom_hdf5)
+
+    Returns
+    -------
+    list of str
+        the names of the files written
+    '''
+    jobs = []
+    files = []
+    if fmt == 'native':
+        jobs.append((native.save_native, (exp, prefix + native.NATIVE_EXTENSION)))
+        files.append(prefix + native.NATIVE_EXTENSION)
+    elif fmt == 'hdf5':
+        jobs.append((save_biom_hdf5, (exp, prefix + '.biom', compression, level, progress)))
+    else:
+        jobs.append((exp.save_biom, (prefix + '.biom', fmt)))
+    if fmt != 'native':
+        files.append(prefix + '.biom')
+        jobs.append((_save_metadata, (exp, prefix)))
+        files.extend([prefix + '_sample.txt', prefix + '_feature.txt'])
+    if fasta:
+        fasta_name = prefix + '.fasta'
+        if compress_fasta:
+            fasta_name += '.gz'
+        jobs.append((save_fasta, (exp, fasta_name, compress_fasta, progress)))
+        files.append(fasta_name)
+    if history:
+        jobs.append((save_command_history, (exp, prefix + '.history.txt')))
+        files.append(prefix + '.history.txt')
+
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [executor.submit(cfunc, *cargs) for cfunc, cargs in jobs]
+        # raise the first error (if any)
+        for cfuture in futures:
+            cfuture.result()
+    if verify and fmt == 'hdf5':
+        verify_biom_hdf5(exp, prefix + '.biom')
+    logger.info('saved experiment to files %s' % files)
+    return files
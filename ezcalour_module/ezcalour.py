@@ -18,8 +18,6 @@ if __name__ == '__main__':
 import inspect
 import os
 import sys
-import re
-from collections import defaultdict
 
 
 # change the app directory so will work in macOS X application
@@ -37,11 +35,12 @@ os.chdir(get_script_dir())
 
 
 import sys
+import threading
 from logging import getLogger, basicConfig
 from logging.config import fileConfig
 import argparse
 import traceback
-import json
+from concurrent.futures import ThreadPoolExecutor
 
 from PyQt5 import QtWidgets, QtCore, uic, QtGui
 from PyQt5.QtWidgets import (QHBoxLayout, QVBoxLayout,
@@ -50,6 +49,7 @@ from PyQt5.QtWidgets import (QHBoxLayout, QVBoxLayout,
                              QDialog, QDialogButtonBox, QApplication, QListWidget)
 import matplotlib
 import numpy as np
+import pandas as pd
 # we need this because of the skbio import that probably imports pyplot?
 # must have it before importing calour (Since it imports skbio)
 matplotlib.use("Qt5Agg")
@@ -57,6 +57,21 @@ matplotlib.use("Qt5Agg")
 import calour as ca
 from ezcalour_module.util import get_ui_file_name, get_res_file_name
 from ezcalour_module import __version__
+from ezcalour_module import core
+from ezcalour_module import preview
+from ezcalour_module import jobs
+from ezcalour_module import loaders
+from ezcalour_module import biomselect
+from ezcalour_module import export
+from ezcalour_module import figures
+from ezcalour_module import query
+from ezcalour_module import taxonomy
+from ezcalour_module import stats
+from ezcalour_module import sharedmem
+from ezcalour_module import seqids
+from ezcalour_module import server
+from ezcalour_module.watch import FolderWatcher, table_hash
+from ezcalour_module.history import ExperimentHistory
 
 logger = getLogger(__name__)
 # set the logger output according to log.cfg
@@ -74,14 +89,26 @@ except:
 class AppWindow(QtWidgets.QMainWindow):
     # the experiments loaded for analysis
     _explist = {}
+    # the seqids.memory_usage of all the loaded experiments (None if the list changed since it was measured)
+    _ids_usage = None
 
-    def __init__(self, load_exp=None):
+    # interval (ms) for checking background jobs and the watched folder
+    BACKGROUND_POLL_INTERVAL = 200
+    WATCH_POLL_INTERVAL = 2000
+
+    def __init__(self, load_exp=None, merge_load=False, watch_dir=None, watch_map=None, load_kwargs=None):
         '''Start the gui and load data if supplied
 
         Parameters
         ----------
         load_exp : list of (table_file_name, map_file_name, study_name) or None (optional)
             load the experiments in the list upon startup
+        merge_load : bool, optional
+            True to merge all the experiments in load_exp into one experiment
+        watch_dir : str or None, optional
+            if not None, start watching this folder for new tables
+        watch_map : str or None, optional
+            the mapping file to use for watched tables without a matching mapping file
         '''
         super().__init__()
         # load the gui
@@ -103,27 +130,379 @@ class AppWindow(QtWidgets.QMainWindow):
             self.actions[caction] = {}
 
         # Add 'sample' buttons
-        sample_buttons = ['Sort', 'Filter', 'Cluster', 'Join fields', 'Filter by original reads', 'Normalize', 'Merge']
+        sample_buttons = ['Sort', 'Filter', 'Filter query', 'Cluster', 'Join fields', 'Filter by original reads', 'Normalize', 'Merge']
         self.add_buttons('sample', sample_buttons)
 
-        feature_buttons = ['Cluster', 'Filter min reads', 'Filter taxonomy', 'Filter fasta', 'Filter prevalence', 'Filter mean', 'Sort abundance', 'Collapse taxonomy']
+        feature_buttons = ['Cluster', 'Filter min reads', 'Filter taxonomy', 'Filter fasta', 'Filter prevalence', 'Filter mean', 'Sort abundance', 'Collapse taxonomy', 'Filter pipeline']
         self.add_buttons('feature', feature_buttons)
 
-        analysis_buttons = ['Diff. abundance', 'Correlation', 'dbBact Enrichment', 'dbBact wordcloud']
+        analysis_buttons = ['Diff. abundance', 'Correlation', 'Beta diversity', 'dbBact Enrichment', 'dbBact wordcloud']
         self.add_buttons('analysis', analysis_buttons)
 
+        # background jobs (running in the job queue process pool or the thread pool)
+        self._job_queue = jobs.JobQueue(max_workers=core.get_config_values('jobs').get('max_workers'))
+        self._thread_pool = None
+        self._bg_jobs = []
+        # the priority of new queued jobs, and the job to run the next action on (see JobsWindow)
+        self._job_priority = 0
+        self._queue_after = None
+        self._jobs_window = None
+        # progress (fraction done) reported by background jobs, by name. Set from the job threads, so guarded by _progress_lock
+        self._progress = {}
+        self._progress_lock = threading.Lock()
+        self._bg_timer = QtCore.QTimer(self)
+        self._bg_timer.timeout.connect(self._check_background_jobs)
+
+        # watch folder
+        self._watcher = None
+        self._watch_timer = QtCore.QTimer(self)
+        self._watch_timer.timeout.connect(self._poll_watch_folder)
+        self.actionWatch = self.mainToolBar.addAction('Watch folder')
+        self.actionWatch.setCheckable(True)
+        self.actionWatch.toggled.connect(self.watch_toggled)
+
+        # undo/redo history (keyed by id() of the current experiment of each history)
+        self._history = {}
+        # the experiment the current action was started on (to replace it when history is on)
+        self._history_parent = None
+        self.actionHistory = self.mainToolBar.addAction('Replace with undo')
+        self.actionHistory.setCheckable(True)
+        self.actionHistory.setToolTip('Replace the selected experiment with the action result (keeping an undo history) instead of adding a new experiment')
+        self.actionUndo = self.mainToolBar.addAction('Undo')
+        self.actionUndo.setShortcut(QtGui.QKeySequence.Undo)
+        self.actionUndo.triggered.connect(self.undo)
+        self.actionRedo = self.mainToolBar.addAction('Redo')
+        self.actionRedo.setShortcut(QtGui.QKeySequence.Redo)
+        self.actionRedo.triggered.connect(self.redo)
+
+        # job queue
+        self.actionQueue = self.mainToolBar.addAction('Queue actions')
+        self.actionQueue.setCheckable(True)
+        self.actionQueue.setToolTip('Add the actions to the job queue (running in the background) instead of running them now')
+        self.actionJobs = self.mainToolBar.addAction('Jobs')
+        self.actionJobs.triggered.connect(self.show_jobs)
+
         # load experiments supplied
         if load_exp is not None:
-            for cdata in load_exp:
-                study_name = cdata[2]
+            if load_kwargs is None:
+                load_kwargs = {'normalize': 10000, 'min_reads': None}
+            tables = [(cdata[0], cdata[1]) for cdata in load_exp]
+            if merge_load:
+                exp = loaders.read_and_merge(tables, **load_kwargs)
+                study_name = load_exp[0][2]
                 if study_name is None:
-                    study_name = cdata[0]
-                exp = ca.read_amplicon(cdata[0], cdata[1], normalize=10000, min_reads=None)
+                    study_name = 'merged-%d-tables' % len(tables)
                 exp._studyname = study_name
                 self.addexp(exp)
+            else:
+                exps = loaders.read_tables(tables, **load_kwargs)
+                for cdata, exp in zip(load_exp, exps):
+                    study_name = cdata[2]
+                    if study_name is None:
+                        study_name = cdata[0]
+                    exp._studyname = study_name
+                    self.addexp(exp)
+        if watch_dir is not None:
+            self.start_watch(watch_dir, map_file=watch_map)
         self.setWindowTitle('EZCalour version %s' % __version__)
         self.show()
 
+    def run_in_background(self, func, args=(), kwargs=None, callback=None, name=None, use_threads=False, priority=0, depends_on=(), description=''):
+        '''Run a function in the background (job queue process pool) without blocking the GUI
+
+        Parameters
+        ----------
+        func : function
+            the function to run. Must be picklable (a module level function in a Qt-free module)
+        args : tuple, optional
+            positional arguments for func
+        kwargs : dict or None, optional
+            keyword arguments for func
+        callback : function or None, optional
+            called (in the GUI thread) with the function result when done
+        name : str or None, optional
+            name of the job (for log and error messages)
+        use_threads : bool, optional
+            True to run in a thread instead of a process (for I/O bound jobs, to avoid copying the experiment to another process)
+        priority : int, optional
+            the job queue priority (higher priority jobs start first). Not used for thread jobs
+        depends_on : list of int, optional
+            ids of jobs in the job queue that must finish before this job starts. Not used for thread jobs
+        description : str, optional
+            the job description shown in the jobs window (i.e. the experiment name)
+
+        Returns
+        -------
+        jobs.Job or None
+            the queued job (None for thread jobs)
+        '''
+        if kwargs is None:
+            kwargs = {}
+        if name is None:
+            name = func.__name__
+        job = None
+        if use_threads:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor()
+            future = self._thread_pool.submit(func, *args, **kwargs)
+            self._bg_jobs.append((future, callback, name))
+        else:
+            job = self._job_queue.submit(func, args, kwargs, name=name, priority=priority, depends_on=depends_on, callback=callback, description=description)
+        logger.debug('started background job %s' % name)
+        if not self._bg_timer.isActive():
+            self._bg_timer.start(self.BACKGROUND_POLL_INTERVAL)
+        self._update_status()
+        return job
+
+    def _check_background_jobs(self):
+        '''Call the callbacks of the finished background jobs'''
+        for job in self._job_queue.poll():
+            if job.status == jobs.DONE:
+                logger.debug('job %r done' % job)
+                if job.callback is not None:
+                    job.callback(job.result)
+            elif job.status == jobs.FAILED:
+                msg = 'Job %s failed:\n%s' % (job.name, job.error.splitlines()[0])
+                logger.warn(msg)
+                self.statusBar.showMessage(msg, 10000)
+            elif job.status == jobs.CANCELLED:
+                logger.info('job %r cancelled' % job)
+                self.statusBar.showMessage('Job %s cancelled' % job.name, 10000)
+        running = []
+        for future, callback, name in self._bg_jobs:
+            if not future.done():
+                running.append((future, callback, name))
+                continue
+            try:
+                res = future.result()
+            except Exception as e:
+                msg = 'Background job %s failed:\n%s' % (name, e)
+                logger.warn(msg)
+                self.statusBar.showMessage(msg, 10000)
+                continue
+            logger.debug('background job %s done' % name)
+            if callback is not None:
+                callback(res)
+        self._bg_jobs = running
+        if len(self._bg_jobs) == 0 and len(self._job_queue.pending) == 0:
+            self._bg_timer.stop()
+        self._update_status()
+
+    def _update_status(self):
+        num_jobs = len(self._bg_jobs) + len(self._job_queue.pending)
+        if num_jobs > 0:
+            msg = '%d background jobs running' % num_jobs
+            with self._progress_lock:
+                progress = dict(self._progress)
+            if len(progress) > 0:
+                msg += ' (%s)' % ', '.join(['%s %d%%' % (k, 100 * v) for k, v in progress.items()])
+            self.statusBar.showMessage(msg)
+        else:
+            with self._progress_lock:
+                self._progress.clear()
+            self.statusBar.clearMessage()
+
+    def _set_progress(self, name, fraction):
+        '''Progress callback for background thread jobs (shown in the status bar by the background timer)'''
+        with self._progress_lock:
+            self._progress[name] = fraction
+
+    def watch_toggled(self, checked):
+        if not checked:
+            self.stop_watch()
+            return
+        if self._watcher is not None:
+            return
+        res = dialog([{'type': 'label', 'label': 'Watch a folder and load new or changed tables'},
+                      {'type': 'dirname', 'label': 'Folder'},
+                      {'type': 'label', 'label': 'Mapping file to use for tables without a matching <table>_map.txt'},
+                      {'type': 'filename', 'label': 'Mapping file'},
+                      {'type': 'int', 'label': 'Wait for unchanged file (seconds)', 'default': 5, 'max': 3600}], title='Watch folder')
+        if res is None or res['Folder'] is None:
+            self.actionWatch.setChecked(False)
+            return
+        self.start_watch(res['Folder'], map_file=res['Mapping file'], debounce=res['Wait for unchanged file (seconds)'])
+
+    def start_watch(self, folder, map_file=None, debounce=5):
+        '''Start watching a folder for new tables
+
+        New tables are read in the background and added to the experiment list
+
+        Parameters
+        ----------
+        folder : str
+            the folder to watch
+        map_file : str or None, optional
+            the mapping file to use for tables without a matching mapping file
+        debounce : float, optional
+            number of seconds a file should not change before it is read
+        '''
+        logger.info('watching folder %s' % folder)
+        self._watcher = FolderWatcher(folder, map_file=map_file, debounce=debounce)
+        self._watch_timer.start(self.WATCH_POLL_INTERVAL)
+        self.actionWatch.blockSignals(True)
+        self.actionWatch.setChecked(True)
+        self.actionWatch.blockSignals(False)
+        self.actionWatch.setToolTip('Watching %s' % folder)
+
+    def stop_watch(self):
+        '''Stop watching the folder'''
+        if self._watcher is not None:
+            logger.info('stopped watching folder %s' % self._watcher.folder)
+        self._watch_timer.stop()
+        self._watcher = None
+        self.actionWatch.setToolTip('Watch folder')
+
+    def _poll_watch_folder(self):
+        if self._watcher is None:
+            return
+        for ctable, cmap in self._watcher.poll():
+            # hashing a large table is slow, so it is done in a thread and not in the GUI timer
+            self.run_in_background(table_hash, (ctable, cmap), callback=lambda chash, ctable=ctable, cmap=cmap: self._load_watched_table(chash, ctable, cmap),
+                                   name='hash %s' % ctable, use_threads=True)
+
+    def _load_watched_table(self, chash, table_file, map_file):
+        if self._watcher is None or not self._watcher.is_new(chash):
+            return
+        logger.info('new table %s (map %s) in watched folder' % (table_file, map_file))
+        self.run_in_background(loaders.read_table, (table_file, map_file), callback=lambda exp: self._add_watched_exp(exp, table_file), name='load %s' % table_file)
+
+    def _add_watched_exp(self, expdat, table_file):
+        expdat._studyname = os.path.basename(table_file)
+        self.addexp(expdat)
+
+    def run_preview(self, func, expdat, kwargs, field=None):
+        '''Run a core action on a stratified subsample, show the result and offer to run the full action in the background
+
+        Parameters
+        ----------
+        func : function
+            the core action (called as func(expdat, **kwargs))
+        expdat : Experiment
+        kwargs : dict
+            the action parameters
+        field : str or None, optional
+            the sample metadata field to stratify the subsample by
+        '''
+        # adding the preview result changes the selection
+        selected = self.get_selected_exps()
+        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+        try:
+            res = preview.run_preview(func, expdat, kwargs, field=field, random_seed=kwargs.get('random_seed'))
+        finally:
+            QtWidgets.QApplication.restoreOverrideCursor()
+        # the preview is a new experiment (not an undo step of the selected experiment)
+        self._history_parent = None
+        if res.complete:
+            # the preview covered all the samples of the experiment - run the other selected experiments
+            self._add_background_result(res.result)
+            others = [x for x in selected if x is not expdat]
+            if len(others) > 0:
+                self.run_on_experiments(func, others, kwargs)
+            return
+        question = 'Run the full analysis in the background?'
+        if len(selected) > 1:
+            question = 'Run the full analysis on the %d selected experiments in the background?' % len(selected)
+        if res.result is not None:
+            res.result._studyname = res.result._studyname + '-preview'
+            self.addexp(res.result)
+            msg = '%s\nResult added as %s\n\n%s' % (res, res.result._studyname, question)
+        else:
+            msg = '%s\nNo significant features found in the preview\n\n%s' % (res, question)
+        answer = QtWidgets.QMessageBox.question(self, 'Preview', msg, QtWidgets.QMessageBox.Yes, QtWidgets.QMessageBox.No)
+        if answer == QtWidgets.QMessageBox.Yes:
+            if len(selected) > 1:
+                self.run_on_experiments(func, selected, kwargs)
+                return
+            self.run_in_background(func, args=(expdat,), kwargs=kwargs, callback=self._add_background_result, name=func.__name__)
+
+    def run_action(self, func, expdat, kwargs, none_msg=None):
+        '''Run a core action on the experiment and add the result, or add it to the job queue if queueing is on
+
+        Parameters
+        ----------
+        func : function
+            the core action (called as func(expdat, **kwargs))
+        expdat : Experiment
+        kwargs : dict
+            the action parameters
+        none_msg : str or None, optional
+            the message to show if the action returns None (i.e. no significant features)
+        '''
+        selected = self.get_selected_exps()
+        if len(selected) > 1 and self._queue_after is None and any([x is expdat for x in selected]):
+            # the dialog was shown once (for the first selected experiment) - run it on all the selected experiments
+            self.run_on_experiments(func, selected, kwargs)
+            return
+        if self.actionQueue.isChecked() or self._queue_after is not None:
+            self.queue_action(func, expdat, kwargs)
+            return
+        newexp = func(expdat, **kwargs)
+        if newexp is None:
+            QtWidgets.QMessageBox.information(self, 'No result', none_msg if none_msg is not None else 'No result')
+            return
+        if isinstance(newexp, list):
+            # i.e. collapse at all taxonomy levels - new experiments (not undo steps)
+            self._history_parent = None
+            for cexp in newexp:
+                self._add_to_list(cexp)
+            return
+        self.addexp(newexp)
+
+    def run_on_experiments(self, func, exps, kwargs):
+        '''Run a core action on each of the experiments in parallel in the job queue, and add the results
+
+        If the action has a new name, each result is named '<experiment name>-<new name>'
+        (otherwise the default name of the action, derived from the experiment name)
+
+        Parameters
+        ----------
+        func : function
+            the core action (called as func(expdat, **kwargs))
+        exps : list of Experiment
+        kwargs : dict
+            the action parameters (the same for all the experiments)
+        '''
+        self._history_parent = None
+        for cexp in exps:
+            ckwargs = dict(kwargs)
+            if ckwargs.get('name'):
+                ckwargs['name'] = '%s-%s' % (cexp._studyname, ckwargs['name'])
+            self.run_in_background(func, args=(cexp,), kwargs=ckwargs, callback=self._add_background_result, name=func.__name__,
+                                   priority=self._job_priority, description=cexp._studyname)
+        self.statusBar.showMessage('Running %s on %d experiments' % (func.__name__, len(exps)), 5000)
+
+    def queue_action(self, func, expdat, kwargs):
+        '''Add a core action to the job queue. If a job was chosen using 'Then...' in the jobs window, the action runs on its result'''
+        if self._queue_after is not None:
+            after = self._queue_after
+            self._queue_after = None
+            arg = jobs.JobResult(after.id)
+            description = 'result of job %d' % after.id
+        else:
+            arg = expdat
+            description = expdat._studyname
+        self._history_parent = None
+        job = self.run_in_background(func, args=(arg,), kwargs=kwargs, callback=self._add_background_result, name=func.__name__,
+                                     priority=self._job_priority, description=description)
+        self.statusBar.showMessage('Queued job %d: %s on %s' % (job.id, job.name, description), 5000)
+
+    def show_jobs(self):
+        '''Show the job queue window'''
+        if self._jobs_window is None:
+            self._jobs_window = JobsWindow(self)
+        self._jobs_window.show()
+        self._jobs_window.raise_()
+
+    def _add_background_result(self, newexp):
+        '''Add the result of a background action (None if no significant features were found)'''
+        if newexp is None:
+            self.statusBar.showMessage('No significant features found', 10000)
+            return
+        self._history_parent = None
+        for cexp in (newexp if isinstance(newexp, list) else [newexp]):
+            self.addexp(cexp)
+
     def add_buttons(self, group, button_list):
         '''Add buttons to the specified divider list and link to functions
 
@@ -158,8 +537,18 @@ class AppWindow(QtWidgets.QMainWindow):
             logger.warn('experiment not found. name=%s' % cname)
             return None
         expdat = self._explist[cname]
+        self._history_parent = expdat
         return expdat
 
+    def get_selected_exps(self):
+        '''Get all the selected experiments in wExperiments (selected items not in the experiment list are skipped)
+
+        Returns
+        -------
+        list of Experiment
+        '''
+        return [self._explist[str(x.text())] for x in self.wExperiments.selectedItems() if str(x.text()) in self._explist]
+
     def plot(self):
         # global x
         '''
@@ -186,7 +575,10 @@ class AppWindow(QtWidgets.QMainWindow):
             newexp = expdat.sort_samples(field)
         else:
             newexp = expdat
-        xargs = get_config_values('plot')
+        if getattr(newexp, 'out_of_core', False):
+            # only a heatmap sized sample of an out of core experiment is read for plotting
+            newexp = figures.downsample(newexp, field=field)
+        xargs = core.get_config_values('plot')
         if res['show taxonomy']:
             feature_field = 'taxonomy'
         else:
@@ -206,31 +598,21 @@ class AppWindow(QtWidgets.QMainWindow):
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-sort-%s' % (expdat._studyname, res['field'])
-        newexp = expdat.sort_by_metadata(res['field'], axis=0)
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        self.run_action(core.sample_sort, expdat, {'field': res['field'], 'name': res['new name']})
 
     def sample_merge(self):
         expdat = self.get_exp_from_selection()
         res = dialog([{'type': 'label', 'label': 'Merge samples based on similar field values'},
                       {'type': 'field', 'label': 'Field'},
-                      {'type': 'combo', 'label': 'Method', 'items': ['mean', 'random', 'sum']},
+                      {'type': 'combo', 'label': 'Method', 'items': core.MERGE_METHODS},
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-merge-%s' % (expdat._studyname, res['field'])
-        newexp = expdat.aggregate_by_metadata(field=res['field'], method=res['Method'], axis='s')
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        self.run_action(core.sample_merge, expdat, {'field': res['field'], 'method': res['Method'], 'name': res['new name']})
 
     def sample_cluster(self):
         expdat = self.get_exp_from_selection()
-        newexp = expdat.cluster_data(axis=1)
-        newexp._studyname = newexp._studyname + '-cluster-samples'
-        self.addexp(newexp)
+        self.run_action(core.sample_cluster, expdat, {})
 
     def sample_filter(self):
         expdat = self.get_exp_from_selection()
@@ -242,15 +624,22 @@ class AppWindow(QtWidgets.QMainWindow):
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            if res['negate']:
-                res['new name'] = '%s-%s-not-%s' % (expdat._studyname, res['field'], res['value'])
-            else:
-                res['new name'] = '%s-%s-%s' % (expdat._studyname, res['field'], res['value'])
+        self.run_action(core.sample_filter, expdat, {'field': res['field'], 'values': res['value'], 'negate': res['negate'], 'name': res['new name']})
 
-        newexp = expdat.filter_samples(res['field'], res['value'], negate=res['negate'])
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+    def sample_filter_query(self):
+        expdat = self.get_exp_from_selection()
+        num_samples = expdat.shape[0]
+
+        def preview(text):
+            return '%d of %d samples match' % (np.sum(query.query_mask(expdat, text)), num_samples)
+
+        res = dialog([{'type': 'label', 'label': 'Filter samples using a query'},
+                      {'type': 'label', 'label': 'i.e.: body_site in (gut, oral) and age > 30 and not antibiotics'},
+                      {'type': 'string', 'label': 'Query', 'preview': preview},
+                      {'type': 'string', 'label': 'new name'}], expdat=expdat)
+        if res is None:
+            return
+        self.run_action(core.sample_filter_query, expdat, {'query_str': res['Query'], 'name': res['new name']})
 
     def sample_normalize(self):
         expdat = self.get_exp_from_selection()
@@ -259,11 +648,7 @@ class AppWindow(QtWidgets.QMainWindow):
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-normalize' % (expdat._studyname)
-        newexp = expdat.normalize(res['Reads per sample'])
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        self.run_action(core.sample_normalize, expdat, {'total': res['Reads per sample'], 'name': res['new name']})
 
     def sample_join_fields(self):
         expdat = self.get_exp_from_selection()
@@ -273,67 +658,67 @@ class AppWindow(QtWidgets.QMainWindow):
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-join-%s-%s' % (expdat._studyname, res['Field1'], res['Field2'])
-        newexp = expdat.join_metadata_fields(field1=res['Field1'], field2=res['Field2'])
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        self.run_action(core.sample_join_fields, expdat, {'field1': res['Field1'], 'field2': res['Field2'], 'name': res['new name']})
 
     def sample_filter_by_original_reads(self):
         expdat = self.get_exp_from_selection()
+        expstats = stats.get_stats(expdat)
         res = dialog([{'type': 'label', 'label': 'Filter Original Reads'},
-                      {'type': 'int', 'label': 'Orig Reads', 'max': 100000, 'default': 10000},
+                      {'type': 'int', 'label': 'Orig Reads', 'max': 100000, 'default': 10000,
+                       'preview': lambda value: expstats.preview('original_reads', value)},
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-min-%d' % (expdat._studyname, res['Orig Reads'])
-        newexp = expdat.filter_orig_reads(min_reads=res['Orig Reads'])
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        self.run_action(core.sample_filter_by_original_reads, expdat, {'min_reads': res['Orig Reads'], 'name': res['new name']})
 
     def feature_filter_min_reads(self):
         expdat = self.get_exp_from_selection()
+        expstats = stats.get_stats(expdat)
         res = dialog([{'type': 'label', 'label': 'Filter minimal reads per feature'},
-                      {'type': 'int', 'label': 'min reads', 'max': 50000, 'default': 10},
+                      {'type': 'int', 'label': 'min reads', 'max': 50000, 'default': 10,
+                       'preview': lambda value: expstats.preview('sum', value)},
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-minreads-%d' % (expdat._studyname, res['min reads'])
-        newexp = expdat.filter_abundance(cutoff=res['min reads'])
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        self.run_action(core.feature_filter_min_reads, expdat, {'min_reads': res['min reads'], 'name': res['new name']})
 
     def feature_filter_taxonomy(self):
         expdat = self.get_exp_from_selection()
         if not isinstance(expdat, ca.AmpliconExperiment):
             logger.warn('Experiment in not an amplicon experiment (it is %s) - cannot filter' % type(expdat))
+        tax_index = taxonomy.get_index(expdat)
+        num_features = expdat.shape[1]
+
+        def preview(text):
+            if text == '':
+                return ''
+            return '%d of %d features contain, %d exact match' % (np.sum(tax_index.query(text)), num_features, np.sum(tax_index.query(text, exact=True)))
+
         res = dialog([{'type': 'label', 'label': 'Filter Taxonomy'},
-                      {'type': 'string', 'label': 'Taxonomy'},
+                      {'type': 'string', 'label': 'Taxonomy', 'completions': tax_index.names(), 'preview': preview},
+                      {'type': 'combo', 'label': 'Rank', 'items': ['any'] + taxonomy.RANKS},
                       {'type': 'bool', 'label': 'Exact'},
                       {'type': 'bool', 'label': 'Negate'},
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-tax-%s' % (expdat._studyname, res['Taxonomy'])
-        newexp = expdat.filter_taxonomy(res['Taxonomy'], negate=res['Negate'], substring=not(res['Exact']))
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        rank = None if res['Rank'] == 'any' else res['Rank']
+        self.run_action(core.feature_filter_taxonomy, expdat, {'values': res['Taxonomy'], 'negate': res['Negate'], 'exact': res['Exact'], 'rank': rank, 'name': res['new name']})
 
     def feature_cluster(self):
         expdat = self.get_exp_from_selection()
         res = dialog([{'type': 'label', 'label': 'Cluster Features'},
                       {'type': 'int', 'label': 'min reads', 'max': 50000, 'default': 10},
+                      {'type': 'combo', 'label': 'Method', 'items': core.FEATURE_CLUSTER_METHODS},
+                      {'type': 'bool', 'label': 'preview', 'default': False},
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-cluster-features-min-%d' % (expdat._studyname, res['min reads'])
-        newexp = expdat.cluster_features(cutoff=res['min reads'])
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        kwargs = {'min_reads': res['min reads'], 'method': res['Method'], 'name': res['new name']}
+        if res['preview']:
+            self.run_preview(core.feature_cluster, expdat, kwargs)
+            return
+        self.run_action(core.feature_cluster, expdat, kwargs)
 
     def feature_filter_fasta(self):
         expdat = self.get_exp_from_selection()
@@ -343,39 +728,31 @@ class AppWindow(QtWidgets.QMainWindow):
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-cluster-fasta-%s' % (expdat._studyname, res['Fasta File'])
-        newexp = expdat.filter_by_fasta(fp=res['Fasta File'], negate=res['Negate'])
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        self.run_action(core.feature_filter_fasta, expdat, {'fasta_file': res['Fasta File'], 'negate': res['Negate'], 'name': res['new name']})
 
     def feature_filter_prevalence(self):
         expdat = self.get_exp_from_selection()
+        expstats = stats.get_stats(expdat)
         res = dialog([{'type': 'label', 'label': 'Filter minimal prevalence per feature'},
                       {'type': 'label', 'label': '(fraction of samples where feature is present)'},
-                      {'type': 'float', 'label': 'min fraction', 'max': 1, 'default': 0.5},
+                      {'type': 'float', 'label': 'min fraction', 'max': 1, 'default': 0.5,
+                       'preview': lambda value: expstats.preview('prevalence', value)},
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-minreads-%f' % (expdat._studyname, res['min fraction'])
-        newexp = expdat.filter_prevalence(fraction=res['min fraction'])
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        self.run_action(core.feature_filter_prevalence, expdat, {'fraction': res['min fraction'], 'name': res['new name']})
 
     def feature_filter_mean(self):
         expdat = self.get_exp_from_selection()
+        expstats = stats.get_stats(expdat)
         res = dialog([{'type': 'label', 'label': 'Filter by minimal mean per feature'},
                       {'type': 'label', 'label': '(mean frequency in all samples)'},
-                      {'type': 'float', 'label': 'mean', 'max': 1, 'default': 0.01},
+                      {'type': 'float', 'label': 'mean', 'max': 1, 'default': 0.01,
+                       'preview': lambda value: expstats.preview('relative_mean', value)},
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-minreads-%f' % (expdat._studyname, res['mean'])
-        newexp = expdat.filter_mean_abundance(cutoff=res['mean'])
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        self.run_action(core.feature_filter_mean, expdat, {'cutoff': res['mean'], 'name': res['new name']})
 
     def feature_sort_abundance(self):
         expdat = self.get_exp_from_selection()
@@ -385,31 +762,51 @@ class AppWindow(QtWidgets.QMainWindow):
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-sort-abundance' % expdat._studyname
-        # newexp = expdat.sort_abundance(field=res['field'], value=res['value'])
-        if res['field'] is None:
-            subset = None
-        else:
-            subset = {res['field']: [res['value']]}
-        newexp = expdat.sort_abundance(subgroup=subset)
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        self.run_action(core.feature_sort_abundance, expdat, {'field': res['field'], 'value': res['value'], 'name': res['new name']})
 
     def feature_collapse_taxonomy(self):
         expdat = self.get_exp_from_selection()
-        if not isinstance(expdat, ca.AmpliconExperiment):
-            raise ValueError("Can only collapse taxonomy for AmpliconExperiment (select in load)\nCurrent exp type is %s" % type(expdat))
+        core.check_amplicon(expdat)
         res = dialog([{'type': 'label', 'label': 'Collapse features by taxonomy'},
-                      {'type': 'combo', 'label': 'level', 'items': ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']},
+                      {'type': 'combo', 'label': 'level', 'items': core.TAXONOMY_LEVELS + ['all levels']},
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-collapse-taxonomy-%s' % (expdat._studyname, res['level'])
-        newexp = expdat.collapse_taxonomy(level=res['level'])
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        if res['level'] == 'all levels':
+            self.run_action(core.feature_collapse_taxonomy_levels, expdat, {'name': res['new name']})
+            return
+        self.run_action(core.feature_collapse_taxonomy, expdat, {'level': res['level'], 'name': res['new name']})
+
+    def feature_filter_pipeline(self):
+        expdat = self.get_exp_from_selection()
+        res = dialog([{'type': 'label', 'label': 'Filter pipeline (all selected steps are done in one pass)'},
+                      {'type': 'bool', 'label': 'Filter by original reads', 'default': True},
+                      {'type': 'int', 'label': 'Orig Reads', 'max': 100000, 'default': 10000},
+                      {'type': 'bool', 'label': 'Filter min reads', 'default': True},
+                      {'type': 'int', 'label': 'min reads', 'max': 50000, 'default': 10},
+                      {'type': 'bool', 'label': 'Filter prevalence', 'default': False},
+                      {'type': 'float', 'label': 'min fraction', 'max': 1, 'default': 0.5},
+                      {'type': 'bool', 'label': 'Filter mean', 'default': False},
+                      {'type': 'float', 'label': 'mean', 'max': 1, 'default': 0.01},
+                      {'type': 'bool', 'label': 'Normalize', 'default': False},
+                      {'type': 'int', 'label': 'Reads per sample', 'default': 10000, 'max': 100000},
+                      {'type': 'string', 'label': 'new name'}], expdat=expdat)
+        if res is None:
+            return
+        steps = []
+        if res['Filter by original reads']:
+            steps.append(('filter_orig_reads', {'min_reads': res['Orig Reads']}))
+        if res['Filter min reads']:
+            steps.append(('filter_abundance', {'cutoff': res['min reads']}))
+        if res['Filter prevalence']:
+            steps.append(('filter_prevalence', {'fraction': res['min fraction']}))
+        if res['Filter mean']:
+            steps.append(('filter_mean_abundance', {'cutoff': res['mean']}))
+        if res['Normalize']:
+            steps.append(('normalize', {'total': res['Reads per sample']}))
+        if len(steps) == 0:
+            return
+        self.run_action(core.feature_filter_pipeline, expdat, {'steps': steps, 'name': res['new name']})
 
     def analysis_diff_abundance(self):
         expdat = self.get_exp_from_selection()
@@ -420,36 +817,20 @@ class AppWindow(QtWidgets.QMainWindow):
                       # {'type': 'value', 'label': 'Value group 2'},
                       {'type': 'value_multi_select', 'label': 'Value group 2'},
                       {'type': 'float', 'label': 'FDR level', 'default': 0.1, 'max': 1},
-                      {'type': 'combo', 'label': 'Method', 'items': ['rankmean', 'mean', 'binary']},
+                      {'type': 'combo', 'label': 'Method', 'items': core.DIFF_ABUNDANCE_METHODS},
                       {'type': 'bool', 'label': 'Use random seed', 'default': True},
                       {'type': 'int', 'label': 'random seed', 'default': 2020, 'max': 9999999},
+                      {'type': 'bool', 'label': 'preview', 'default': False},
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-diff-%s' % (expdat._studyname, res['field'])
-        if res['Method'] == 'rankmean':
-            method = 'meandiff'
-            transform = 'rankdata'
-        elif res['Method'] == 'mean':
-            method = 'meandiff'
-            transform = None
-        elif res['Method'] == 'binary':
-            method = 'meandiff'
-            transform = 'binarydata'
-        # if no value supplied for group2, make it None instead of '' so will use all other samples...
-        if res['Value group 2'] == '' or res['Value group 2'] == ['']:
-            print('pita')
-            res['Value group 2'] = None
-        kwa = {}
-        if res['Use random seed']:
-            kwa['random_seed'] = res['random seed']
-        newexp = expdat.diff_abundance(field=res['field'], val1=res['Value group 1'], val2=res['Value group 2'], alpha=res['FDR level'], method=method, transform=transform, **kwa)
-        if newexp is None:
-                QtWidgets.QMessageBox.information(self, "No enriched annotations found", "No enriched annotations found")
-                return
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        random_seed = res['random seed'] if res['Use random seed'] else None
+        kwargs = {'field': res['field'], 'val1': res['Value group 1'], 'val2': res['Value group 2'], 'alpha': res['FDR level'],
+                  'method': res['Method'], 'random_seed': random_seed, 'name': res['new name']}
+        if res['preview']:
+            self.run_preview(core.analysis_diff_abundance, expdat, kwargs, field=res['field'])
+            return
+        self.run_action(core.analysis_diff_abundance, expdat, kwargs, none_msg='No enriched annotations found')
 
     def analysis_correlation(self):
         expdat = self.get_exp_from_selection()
@@ -457,29 +838,47 @@ class AppWindow(QtWidgets.QMainWindow):
                       {'type': 'field', 'label': 'Field', 'withnone': True},
                       {'type': 'combo', 'label': 'Method', 'items': ['spearman', 'pearson']},
                       {'type': 'bool', 'label': 'ignore zeros'},
+                      {'type': 'float', 'label': 'FDR level', 'default': 0.1, 'max': 1},
                       {'type': 'bool', 'label': 'Use random seed', 'default': True},
                       {'type': 'int', 'label': 'random seed', 'default': 2020, 'max': 9999999},
+                      {'type': 'bool', 'label': 'preview', 'default': False},
                       {'type': 'string', 'label': 'new name'}], expdat=expdat)
         if res is None:
             return
-        if res['new name'] == '':
-            res['new name'] = '%s-correlation-%s' % (expdat._studyname, res['field'])
-        kwa = {}
-        if res['Use random seed']:
-            kwa['random_seed'] = res['random seed']
-        newexp = expdat.correlation(field=res['field'], method=res['Method'], nonzero=res['ignore zeros'], **kwa)
-        if newexp is None:
-                QtWidgets.QMessageBox.information(self, "No enriched terms found", "No enriched annotations found")
-                return
-        newexp._studyname = res['new name']
-        self.addexp(newexp)
+        random_seed = res['random seed'] if res['Use random seed'] else None
+        kwargs = {'field': res['field'], 'method': res['Method'], 'nonzero': res['ignore zeros'], 'alpha': res['FDR level'],
+                  'random_seed': random_seed, 'name': res['new name']}
+        if res['preview']:
+            self.run_preview(core.analysis_correlation, expdat, kwargs, field=res['field'])
+            return
+        self.run_action(core.analysis_correlation, expdat, kwargs, none_msg='No enriched annotations found')
+
+    def analysis_beta_diversity(self):
+        expdat = self.get_exp_from_selection()
+        res = dialog([{'type': 'label', 'label': 'Beta diversity / PCoA'},
+                      {'type': 'combo', 'label': 'Distance', 'items': core.BETA_DIVERSITY_METHODS},
+                      {'type': 'int', 'label': 'number of axes', 'default': 3, 'max': 20},
+                      {'type': 'bool', 'label': 'Use random seed', 'default': True},
+                      {'type': 'int', 'label': 'random seed', 'default': 2020, 'max': 9999999},
+                      {'type': 'bool', 'label': 'show plot', 'default': True},
+                      {'type': 'field', 'label': 'Color by field', 'withnone': True},
+                      {'type': 'string', 'label': 'new name'}], expdat=expdat)
+        if res is None:
+            return
+        random_seed = res['random seed'] if res['Use random seed'] else None
+        kwargs = {'method': res['Distance'], 'num_axes': max(res['number of axes'], 2), 'random_seed': random_seed, 'name': res['new name']}
+        if res['show plot'] and not self.actionQueue.isChecked() and self._queue_after is None and len(self.get_selected_exps()) == 1:
+            newexp = core.analysis_beta_diversity(expdat, **kwargs)
+            self.addexp(newexp)
+            core.plot_ordination(newexp, field=res['field']).show()
+            return
+        self.run_action(core.analysis_beta_diversity, expdat, kwargs)
 
     def analysis_dbbact_wordcloud(self):
         expdat = self.get_exp_from_selection()
 
         # plot the bar graph
-        db = ca.database._get_database_class('dbbact')
-        f = db.draw_wordcloud(expdat)
+        f = core.analysis_dbbact_wordcloud(expdat)
         f.show()
 
     def analysis_dbbact_enrichment(self):
@@ -487,16 +886,7 @@ class AppWindow(QtWidgets.QMainWindow):
         if '_calour_stat' not in expdat.feature_metadata.columns:
             QtWidgets.QMessageBox.warning(self, "Problem", "Enrichment plot only works on\ndiff. abundance/correlation\nresult experiments")
             return
-        names1 = expdat.feature_metadata['_calour_direction'][expdat.feature_metadata['_calour_stat'] > 0]
-        names2 = expdat.feature_metadata['_calour_direction'][expdat.feature_metadata['_calour_stat'] < 0]
-        if len(names1) > 0:
-            names1 = names1.values[0]
-        else:
-            names1 = 'Group1'
-        if len(names2) > 0:
-            names2 = names2.values[0]
-        else:
-            names2 = 'Group2'
+        names1, names2 = core.enrichment_group_names(expdat)
 
         res = dialog([{'type': 'label', 'label': 'Differential abundance enrichment'},
                       {'type': 'label', 'label': 'Group1: %s' % names1},
@@ -508,7 +898,7 @@ class AppWindow(QtWidgets.QMainWindow):
             return
 
         # plot the bar graph
-        ax, newexp = expdat.plot_diff_abundance_enrichment(ignore_exp=True, min_exps=res['min. experiments'], show_legend=res['show legend'])
+        ax, newexp = core.analysis_dbbact_enrichment(expdat, min_exps=res['min. experiments'], show_legend=res['show legend'])
         ax.get_figure().show()
 
     def add_action_button(self, group, name, function):
@@ -534,6 +924,10 @@ class AppWindow(QtWidgets.QMainWindow):
         menuinfo.triggered.connect(self.expinfo)
         menusavecommands = self.listMenu.addAction("Save commands")
         menusavecommands.triggered.connect(self.menuSaveCommands)
+        menuexportfigures = self.listMenu.addAction("Export figures")
+        menuexportfigures.triggered.connect(self.menuExportFigures)
+        menuclearcache = self.listMenu.addAction("Clear test cache")
+        menuclearcache.triggered.connect(self.menuClearTestCache)
         parentPosition = self.wExperiments.mapToGlobal(QtCore.QPoint(0, 0))
         self.listMenu.move(parentPosition + QPos)
         self.listMenu.show()
@@ -548,6 +942,14 @@ class AppWindow(QtWidgets.QMainWindow):
         commands.append('data file: %s' % data_file)
         commands.append('map file: %s' % map_file)
         commands.append('%r' % expdat)
+        ids = seqids.memory_usage([expdat])
+        commands.append('feature ids: %.1f MB (up to %.1f MB saved by sharing the id strings)' % (ids['used'] / 2 ** 20, ids['saved'] / 2 ** 20))
+        if self._ids_usage is None:
+            # measuring all the ids is slow, so it is done once until the experiment list changes
+            self._ids_usage = seqids.memory_usage(self._explist.values())
+        ids = self._ids_usage
+        commands.append('feature ids of all %d experiments: %.1f MB (up to %.1f MB saved by sharing the id strings)'
+                        % (len(self._explist), ids['used'] / 2 ** 20, ids['saved'] / 2 ** 20))
         commands.append('------------')
         for x in expdat._call_history:
             commands.append(str(x))
@@ -558,9 +960,12 @@ class AppWindow(QtWidgets.QMainWindow):
         expdat = self.get_exp_from_selection()
         val, ok = QtWidgets.QInputDialog.getText(self, 'Rename experiment', 'old name=%s' % expdat._studyname)
         if ok:
+            history = self._history.get(id(expdat))
             self.removeexp(expdat)
             expdat._studyname = val
-            self.addexp(expdat)
+            self._add_to_list(expdat)
+            if history is not None:
+                self._history[id(expdat)] = history
 
     def menuRemove(self):
         if len(self.wExperiments.selectedItems()) > 1:
@@ -575,8 +980,11 @@ class AppWindow(QtWidgets.QMainWindow):
     def menuSave(self):
         expdat = self.get_exp_from_selection()
         res = dialog([{'type': 'label', 'label': 'Save experiment'},
-                      {'type': 'combo', 'label': 'Format', 'items': ['hdf5', 'json', 'txt']},
+                      {'type': 'combo', 'label': 'Format', 'items': ['hdf5', 'json', 'txt', 'native']},
+                      {'type': 'combo', 'label': 'Compression (hdf5)', 'items': export.COMPRESSION_TYPES},
+                      {'type': 'int', 'label': 'Compression level', 'default': 4, 'max': 22},
                       {'type': 'bool', 'label': 'Fasta', 'default': True},
+                      {'type': 'bool', 'label': 'gzip fasta', 'default': False},
                       {'type': 'bool', 'label': 'Command history', 'default': True}],
                      expdat=expdat)
         if res is None:
@@ -586,14 +994,56 @@ class AppWindow(QtWidgets.QMainWindow):
         if fname == '':
             return
         logger.debug('saving')
-        expdat.save(fname, fmt=res['Format'])
-        logger.info('saved experiment to file %s (.biom, _sample_metadata.txt and _feature_metadata.txt)' % fname)
-        if res['Fasta']:
-            expdat.save_fasta(fname + '.fasta')
-            logger.info('saved experiment sequences to %s.fasta' % fname)
-        if res['Command history']:
-            self._save_command_history(expdat, fname + '.history.txt')
-            logger.info('saved command history table to file %s.history.txt' % fname)
+        self.run_in_background(export.export_experiment, (expdat, fname),
+                               kwargs={'fmt': res['Format'], 'compression': res['Compression (hdf5)'], 'level': res['Compression level'],
+                                       'fasta': res['Fasta'], 'compress_fasta': res['gzip fasta'], 'history': res['Command history'],
+                                       'progress': self._set_progress},
+                               callback=lambda files: self.statusBar.showMessage('saved %s' % ', '.join(files), 10000),
+                               name='save %s' % fname, use_threads=True)
+
+    def menuExportFigures(self):
+        '''Save the heatmaps of the selected experiments (for each selected sort field) in the background'''
+        exps = [self._explist[str(x.text())] for x in self.wExperiments.selectedItems() if str(x.text()) in self._explist]
+        if len(exps) == 0:
+            return
+        fields = []
+        for cexp in exps:
+            fields.extend([x for x in cexp.sample_metadata.columns if x not in fields])
+        res = dialog([{'type': 'label', 'label': 'Export heatmaps of %d experiments' % len(exps)},
+                      {'type': 'select', 'label': 'sort fields', 'items': fields},
+                      {'type': 'bool', 'label': 'unsorted', 'default': False},
+                      {'type': 'bool', 'label': 'png', 'default': True},
+                      {'type': 'bool', 'label': 'pdf', 'default': False},
+                      {'type': 'bool', 'label': 'svg', 'default': False},
+                      {'type': 'bool', 'label': 'show taxonomy', 'default': False},
+                      {'type': 'int', 'label': 'max samples', 'default': figures.MAX_SAMPLES, 'max': 100000},
+                      {'type': 'int', 'label': 'max features', 'default': figures.MAX_FEATURES, 'max': 100000},
+                      {'type': 'dirname', 'label': 'Output folder'}], expdat=exps[0])
+        if res is None:
+            return
+        formats = [x for x in figures.FIGURE_FORMATS if res[x]]
+        sort_fields = list(res['sort fields'])
+        if res['unsorted']:
+            sort_fields.append(None)
+        if res['Output folder'] is None or len(formats) == 0 or len(sort_fields) == 0:
+            QtWidgets.QMessageBox.warning(self, 'Export figures', 'Select an output folder, at least one format and at least one field')
+            return
+        os.makedirs(res['Output folder'], exist_ok=True)
+        kwargs = {'feature_field': 'taxonomy' if res['show taxonomy'] else None, 'plot_kwargs': core.get_config_values('plot'),
+                  'max_samples': res['max samples'], 'max_features': res['max features']}
+        for cexp in exps:
+            for cfield in sort_fields:
+                if cfield is not None and cfield not in cexp.sample_metadata.columns:
+                    continue
+                cfiles = [figures.figure_file_name(res['Output folder'], cexp._studyname, cfield, x) for x in formats]
+                self.run_in_background(figures.render_figure, (cexp, cfiles, cfield), kwargs=kwargs,
+                                       callback=lambda files: self.statusBar.showMessage('saved %s' % ', '.join(files), 10000),
+                                       name='figure', priority=self._job_priority, description='%s %s' % (cexp._studyname, cfield))
+
+    def menuClearTestCache(self):
+        '''Remove the cached diff. abundance / correlation permutation results (used when re-running with another FDR level)'''
+        freed = core.clear_test_cache()
+        self.statusBar.showMessage('cleared %.1f MB of cached test results' % (freed / 2 ** 20), 5000)
 
     def menuSaveCommands(self):
         expdat = self.get_exp_from_selection()
@@ -601,36 +1051,79 @@ class AppWindow(QtWidgets.QMainWindow):
         fname = str(fname)
         if fname == '':
             return
-        self._save_command_history(expdat, fname)
+        export.save_command_history(expdat, fname)
+
+    def addexp(self, expdat):
+        '''Add a new experiment to the list of experiments
 
-    def _save_command_history(self, expdat, fname):
-        '''Save the command history of the experiment to file filename
+        If 'Replace with undo' is on and the experiment is the result of an action on the
+        selected experiment, replace the selected experiment and store the step in its undo history
 
         Parameters
         ----------
-        expdat: calour.Experiment
-            the experiment to save the history of
-        fname: str
-            name of the text filename to write to
+        expdat : Experiment
+            the experiment to add (note it needs also the _studyname field)
         '''
-        logger.debug('saving commands')
-        data_file = expdat.info.get('data_file', 'NA')
-        map_file = expdat.info.get('sample_metadata_file', 'NA')
-        with open(fname, 'w') as fl:
-            fl.write('Command history for biom table %s, sample metadata file %s\n' % (data_file, map_file))
-            for ccommand in expdat._call_history:
-                fl.write('%s\n' % ccommand)
-        logger.info('saved commands to file %s' % fname)
+        parent = self._history_parent
+        self._history_parent = None
+        if self.actionHistory.isChecked() and parent is not None and parent is not expdat and self._is_derived(parent, expdat):
+            self._replace_with_history(parent, expdat)
+            return
+        self._add_to_list(expdat)
+
+    def _is_derived(self, parent, expdat):
+        '''Check if expdat is the result of an action on parent (based on the call history)'''
+        if parent._displayname not in self._explist:
+            return False
+        parent_history = getattr(parent, '_call_history', [])
+        exp_history = getattr(expdat, '_call_history', [])
+        return len(exp_history) > len(parent_history) and exp_history[:len(parent_history)] == parent_history
+
+    def _replace_with_history(self, parent, expdat):
+        '''Replace the parent experiment in the list with expdat, and store the step in the undo history'''
+        history = self._history.pop(id(parent), None)
+        if history is None:
+            history = ExperimentHistory(parent)
+        history.push(parent, expdat)
+        self.removeexp(parent)
+        self._add_to_list(expdat)
+        self._history[id(expdat)] = history
+        logger.debug('undo history for %s has %d steps (%d bytes)' % (expdat._studyname, len(history), history.nbytes))
+
+    def undo(self):
+        '''Replace the selected experiment with the previous experiment in its undo history'''
+        self._history_step(undo=True)
+
+    def redo(self):
+        '''Replace the selected experiment with the next experiment in its undo history'''
+        self._history_step(undo=False)
+
+    def _history_step(self, undo=True):
+        if len(self.wExperiments.selectedItems()) == 0:
+            return
+        expdat = self.get_exp_from_selection()
+        self._history_parent = None
+        history = self._history.get(id(expdat))
+        if history is None or (undo and not history.can_undo()) or (not undo and not history.can_redo()):
+            self.statusBar.showMessage('Nothing to %s for %s' % ('undo' if undo else 'redo', expdat._studyname), 5000)
+            return
+        if undo:
+            newexp = history.undo(expdat)
+        else:
+            newexp = history.redo(expdat)
+        self._history.pop(id(expdat))
+        self.removeexp(expdat)
+        self._add_to_list(newexp)
+        self._history[id(newexp)] = history
 
-    def addexp(self, expdat):
-        '''Add a new experiment to the list of experiments
+    def _add_to_list(self, expdat):
+        '''Add the experiment to the experiment list widget (with a unique name)
 
         Parameters
         ----------
         expdat : Experiment
             the experiment to add (note it needs also the _studyname field)
         '''
-
         # make sure the experiment is not already in the list
         # if so, give a new unique name
         expname = expdat._studyname
@@ -640,9 +1133,12 @@ class AppWindow(QtWidgets.QMainWindow):
             expname = expdat._studyname + '(' + str(cnum) + ')'
             cnum += 1
         expdat._studyname = expname
+        # store each feature id (sequence) string once across all the experiments
+        seqids.intern_experiment(expdat)
         expdname = '%s (%s-S, %s-F)' % (expname, expdat.shape[0], expdat.shape[1])
         expdat._displayname = expdname
         self._explist[expdname] = expdat
+        self._ids_usage = None
         self.wExperiments.addItem(expdname)
         self.wExperiments.clearSelection()
         self.wExperiments.setCurrentRow(self.wExperiments.count() - 1)
@@ -654,19 +1150,36 @@ class AppWindow(QtWidgets.QMainWindow):
         """
         expdname = exp._displayname
         del self._explist[expdname]
+        self._ids_usage = None
+        self._history.pop(id(exp), None)
+        # free the shared memory copy of the data used to send it to the workers
+        sharedmem.release(exp)
+        # rebuilt only when most of the pool strings belong to removed experiments
+        seqids.rebuild_pool(self._explist.values())
         items = self.wExperiments.findItems(expdname, QtCore.Qt.MatchExactly)
         for item in items:
             self.wExperiments.takeItem(self.wExperiments.row(item))
 
     def load(self):
-        ftype = choose_dlg([['Amplicon', '(*.biom)'], ['Qiime2', '(*.qza) including taxonomy, rep_seqs'], ['Metabolomics', '(MZMine2)'], ['Generic table', 'Tab separated text file']], title='Load - Choose data type')
+        ftype = choose_dlg([['Amplicon', '(*.biom)'], ['Qiime2', '(*.qza) including taxonomy, rep_seqs'], ['Metabolomics', '(MZMine2)'], ['Generic table', 'Tab separated text file'],
+                            ['Multiple tables', 'Folder of (*.biom/*.qza) tables, merged into one experiment'],
+                            ['EZCalour native', '(*.ezc) memory mapped EZCalour experiment'],
+                            ['Out of core', '(*.biom) HDF5 biom table larger than memory, read in chunks from disk']], title='Load - Choose data type')
         if ftype is None:
             return
+        if ftype == 'Multiple tables':
+            self.load_multiple()
+            return
         try:
             if ftype == 'Amplicon':
                 res = dialog([{'type': 'filename', 'label': 'Table file (.biom)'},
                               {'type': 'filename', 'label': 'Mapping file', 'default': 'map.txt'},
                               {'type': 'bool', 'label': 'Normalize', 'default': True},
+                              {'type': 'label', 'label': 'Optional selection (HDF5 biom tables read only the selected samples/features)'},
+                              {'type': 'string', 'label': 'Sample query'},
+                              {'type': 'int', 'label': 'Min sample reads', 'default': 1000, 'max': 1000000},
+                              {'type': 'int', 'label': 'Min feature reads', 'default': 0, 'max': 1000000},
+                              {'type': 'filename', 'label': 'Feature ids file'},
                               {'type': 'string', 'label': 'new name'}], title='load %s' % ftype)
                 if res is None:
                     return
@@ -675,7 +1188,10 @@ class AppWindow(QtWidgets.QMainWindow):
                     normalize = 10000
                 else:
                     normalize = None
-                expdat = ca.read_amplicon(table_name, sample_metadata_file=res['Mapping file'], min_reads=1000, normalize=normalize)
+                feature_ids = biomselect.read_id_list(res['Feature ids file']) if res['Feature ids file'] else None
+                expdat = core.read_amplicon(table_name, res['Mapping file'], normalize=normalize, min_reads=res['Min sample reads'] or None,
+                                            name=res['new name'], sample_query=res['Sample query'] or None,
+                                            min_feature_reads=res['Min feature reads'] or None, feature_ids=feature_ids)
 
             if ftype == 'Qiime2':
                 res = dialog([{'type': 'filename', 'label': 'Table file (.qza)'},
@@ -693,49 +1209,65 @@ class AppWindow(QtWidgets.QMainWindow):
                     normalize = 10000
                 else:
                     normalize = None
-                expdat = ca.read_qiime2(table_name, sample_metadata_file=res['Mapping file'], rep_seq_file=res['RepSeqs file'], taxonomy_file=res['Taxonomy file'], min_reads=1000, normalize=normalize)
+                expdat = core.read_qiime2(table_name, res['Mapping file'], rep_seq_file=res['RepSeqs file'], taxonomy_file=res['Taxonomy file'],
+                                          normalize=normalize, min_reads=1000, name=res['new name'])
 
             if ftype == 'Metabolomics':
                 res = dialog([{'type': 'filename', 'label': 'Table file (mzmine2)'},
                               {'type': 'filename', 'label': 'Mapping file', 'default': 'map.txt'},
                               {'type': 'label', 'label': 'Optional GNPS bucket file (tab separated)'},
                               {'type': 'filename', 'label': 'GNPS file'},
+                              {'type': 'bool', 'label': 'sparse', 'default': False},
+                              {'type': 'bool', 'label': 'float32 (half memory)', 'default': False},
                               {'type': 'string', 'label': 'new name'}], title='load %s' % ftype)
                 if res is None:
                     return
                 table_name = res['Table file (mzmine2)']
-                expdat = ca.read_ms(table_name, res['Mapping file'], gnps_file=res['GNPS file'], normalize=None)
+                expdat = core.read_ms(table_name, res['Mapping file'], gnps_file=res['GNPS file'], normalize=None, name=res['new name'],
+                                      sparse=res['sparse'], dtype='float32' if res['float32 (half memory)'] else 'float64')
+
+            if ftype == 'EZCalour native':
+                res = dialog([{'type': 'dirname', 'label': 'Experiment directory (.ezc)'},
+                              {'type': 'string', 'label': 'new name'}], title='load %s' % ftype)
+                if res is None:
+                    return
+                expdat = core.read_native(res['Experiment directory (.ezc)'], name=res['new name'])
+
+            if ftype == 'Out of core':
+                res = dialog([{'type': 'label', 'label': 'The table stays on disk. Filter / normalize / sort / diff. abundance / correlation'},
+                              {'type': 'label', 'label': 'read it in chunks, and results small enough are loaded into memory'},
+                              {'type': 'filename', 'label': 'Table file (.biom)'},
+                              {'type': 'filename', 'label': 'Mapping file', 'default': 'map.txt'},
+                              {'type': 'bool', 'label': 'Normalize', 'default': True},
+                              {'type': 'int', 'label': 'Min sample reads', 'default': 1000, 'max': 1000000},
+                              {'type': 'int', 'label': 'Chunk cache (MB)', 'default': 512, 'max': 1000000},
+                              {'type': 'string', 'label': 'new name'}], title='load %s' % ftype)
+                if res is None:
+                    return
+                expdat = core.read_out_of_core(res['Table file (.biom)'], res['Mapping file'], normalize=10000 if res['Normalize'] else None,
+                                               min_reads=res['Min sample reads'] or None, cache_mb=max(1, res['Chunk cache (MB)']), name=res['new name'])
 
             if ftype == 'Generic table':
                 res = dialog([{'type': 'filename', 'label': 'Table file (.txt)'},
                               {'type': 'filename', 'label': 'Mapping file', 'default': 'map.txt'},
+                              {'type': 'bool', 'label': 'sparse', 'default': False},
+                              {'type': 'bool', 'label': 'float32 (half memory)', 'default': False},
                               {'type': 'string', 'label': 'new name'}], title='load %s' % ftype)
                 if res is None:
                     return
                 table_name = res['Table file (.txt)']
-                expdat = ca.read(table_name, res['Mapping file'], normalize=None, data_file_type='tsv')
-
-            expname = res['new name']
-            if expname == '':
-                expname = os.path.basename(table_name)
-            expdat._studyname = expname
+                expdat = core.read_generic(table_name, res['Mapping file'], normalize=None, name=res['new name'],
+                                           sparse=res['sparse'], dtype='float32' if res['float32 (half memory)'] else 'float64')
 
             # for amplicon/qiime2, test if one of the dbbact primers is still attached
             if ftype in ['Amplicon', 'Qiime2']:
-                NUM_TEST_SEQS = 200
-                tseqs = expdat.feature_metadata.index.values[np.random.randint(len(expdat.feature_metadata), size=NUM_TEST_SEQS)]
-                mseqs, mpos, max_primer, max_primer_seq = trim_primer(tseqs)
+                primer = core.detect_primer(expdat)
                 # we have more than 1/4 of the sequences matching the primer - so lets ask to remove it
-                if len(mpos) > NUM_TEST_SEQS / 4:
-                    msg = 'EZCalour identified your reads contain the forward primer %s:\n%s\nThis may prevent identification of sequences in dbBact.\nWould you like to trim the primers?' % (max_primer, max_primer_seq)
+                if primer is not None:
+                    msg = 'EZCalour identified your reads contain the forward primer %s:\n%s\nThis may prevent identification of sequences in dbBact.\nWould you like to trim the primers?' % primer
                     res = QtWidgets.QMessageBox.question(None, "trim primer", msg, QtWidgets.QMessageBox.Yes, QtWidgets.QMessageBox.No)
                     if res == QtWidgets.QMessageBox.Yes:
-                        # ask to remove
-                        mseqs, mpos, max_primer, max_primer_seq = trim_primer(expdat.feature_metadata.index.values)
-                        # expdat = expdat.reorder(mpos, axis='f')
-                        expdat.feature_metadata['_orig_feature_id'] = expdat.feature_metadata['_feature_id']
-                        expdat.feature_metadata['_feature_id'] = mseqs
-                        expdat.feature_metadata.set_index('_feature_id', drop=False, inplace=True)
+                        core.trim_experiment_primers(expdat)
 
             self.addexp(expdat)
 
@@ -745,88 +1277,50 @@ class AppWindow(QtWidgets.QMainWindow):
             QtWidgets.QMessageBox.information(None, "Error enountered", msg)
             return None
 
-
-def trim_primer(seqs, primers={'515F': 'GTGCCAGC[AC]GCCGCGGTAA', '384F': 'CCTACGGG[ACGT][CGT]GC[AT][CG]CAG', '27F': 'AGAGTTTGATC[AC]TGGCTCAG'}):
-    '''Trim a known set of primers from sequences
-
-    Parameters
-    ----------
-    seqs: list of str
-        the sequences to find the primer in
-    primers: list of str, optional
-        the primers to look for. default: V4 (515F), V3 , V1 (27F)
-        NOTE: for degenerate bases, use []. so A[ACGT]T looks for ANT
-
-    Returns
-    -------
-    mseqs: list of str
-        the trimmed sequences. sequences that did not match the primer are left unchanged
-    mpos: list of int
-        positions of the sequences that match the primer out of the list of sequences
-    max_primer: str
-        name ofthe primer identified the most
-    max_primer_seq: str
-        sequence of this primer
-    '''
-    mseqs = []
-    mpos = []
-    primer_count = defaultdict(int)
-    for idx, cseq in enumerate(seqs):
-        cseq = cseq.upper()
-        foundit = False
-        for cprimer_name, cprimer in primers.items():
-            match = re.search(cprimer, cseq)
-            if match is None:
-                continue
-            foundit = True
-            primer_count[cprimer_name] += 1
-            break
-        if foundit:
-            cseq = cseq[match.end():]
-            mpos.append(idx)
-        mseqs.append(cseq)
-    if len(primer_count) > 0:
-        max_primer = max(primer_count, key=lambda k: primer_count[k])
-        max_primer_seq = primers[max_primer]
-    else:
-        max_primer = 'NA'
-        max_primer_seq = 'NA'
-    return mseqs, mpos, max_primer, max_primer_seq
-
-
-def read_biom(tablefname, mapfname=None, normalize=10000, min_reads=None):
-    try:
-        logger.debug('loading biom table %s map file %s using calour' % (tablefname, mapfname))
-        expdat = ca.read_amplicon(tablefname, mapfname, normalize=10000, min_reads=None)
-    except Exception as e:
-        msg = 'Load for amplicon biom table %s map %s failed:\n%s' % (tablefname, mapfname, e)
-        logger.warn(msg)
-        QtWidgets.QMessageBox.information(None, "Error enountered", msg)
-        return None
-    return expdat
-
-
-def unzip_qza(filename, mapfname):
-    import zipfile
-    import tempfile
-
-    if not zipfile.is_zipfile(filename):
-        logger.warning('%s is not a valid zip file' % filename)
-        return None
-    fl = zipfile.ZipFile(filename)
-    biom_name = None
-    for fname in fl.namelist():
-        if fname.endswith('data/feature-table.biom'):
-            biom_name = fname
-            break
-    if biom_name is None:
-        logger.warning('No biom table in qza file %s' % filename)
-        return None
-    with tempfile.TemporaryDirectory() as tempdir:
-        logger.debug('extracting from qza zip')
-        oname = fl.extract(biom_name, tempdir)
-        expdat = read_biom(oname, mapfname)
-    return expdat
+    def load_multiple(self):
+        '''Load all the tables in a folder (in parallel) and optionally merge them into one experiment
+        '''
+        res = dialog([{'type': 'label', 'label': 'Load all tables (.biom/.qza) in a folder'},
+                      {'type': 'dirname', 'label': 'Folder'},
+                      {'type': 'label', 'label': 'Mapping file to use for tables without a matching <table>_map.txt'},
+                      {'type': 'filename', 'label': 'Mapping file'},
+                      {'type': 'bool', 'label': 'Normalize', 'default': True},
+                      {'type': 'bool', 'label': 'Merge', 'default': True},
+                      {'type': 'int', 'label': 'Processes', 'default': os.cpu_count(), 'max': 256},
+                      {'type': 'string', 'label': 'new name'}], title='load multiple tables')
+        if res is None:
+            return
+        if res['Folder'] is None:
+            return
+        table_files = loaders.find_tables(res['Folder'])
+        if len(table_files) == 0:
+            QtWidgets.QMessageBox.information(self, "No tables found", "No .biom/.qza tables found in %s" % res['Folder'])
+            return
+        tables = [(ctable, loaders.find_mapping_file(ctable, default=res['Mapping file'])) for ctable in table_files]
+        if res['Normalize']:
+            normalize = 10000
+        else:
+            normalize = None
+        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+        try:
+            exps = loaders.read_tables(tables, normalize=normalize, min_reads=1000, max_workers=max(1, res['Processes']))
+            if res['Merge']:
+                newexp = loaders.merge_experiments(exps, names=[os.path.basename(ctable) for ctable in table_files])
+                expname = res['new name']
+                if expname == '':
+                    expname = os.path.basename(os.path.normpath(res['Folder']))
+                newexp._studyname = expname
+                self.addexp(newexp)
+            else:
+                for ctable, cexp in zip(table_files, exps):
+                    cexp._studyname = os.path.basename(ctable)
+                    self.addexp(cexp)
+        except Exception as e:
+            msg = 'Load failed:\n%s' % e
+            logger.warn(msg)
+            QtWidgets.QMessageBox.information(None, "Error enountered", msg)
+        finally:
+            QtWidgets.QApplication.restoreOverrideCursor()
 
 
 class LoadWindow(QtWidgets.QDialog):
@@ -883,6 +1377,13 @@ def dialog(items, expdat=None, title=None):
                 'value' : a value input for the field in the field item
                 'bool' : a boolean
                 'label' : a label to display (text in 'label' field)
+                'filename' : a file name (with a file select button)
+                'dirname' : a directory name (with a directory select button)
+            'completions' : list of str (for 'string' items)
+                values to suggest (autocomplete) while typing
+            'preview' : function (for 'string', 'int' and 'float' items)
+                called with the new value whenever it changes. The returned str is shown below the item
+                (i.e. to show how many samples will be kept)
             'default' : the value to initialize the item to
             'label' : str
                 label of the item (also the name in the output dict)
@@ -915,6 +1416,11 @@ def dialog(items, expdat=None, title=None):
                     self.add(widget)
                 elif citem['type'] == 'string':
                     widget = QLineEdit(citem.get('default'))
+                    if 'completions' in citem:
+                        completer = QtWidgets.QCompleter(citem['completions'], widget)
+                        completer.setCaseSensitivity(QtCore.Qt.CaseInsensitive)
+                        completer.setFilterMode(QtCore.Qt.MatchContains)
+                        widget.setCompleter(completer)
                     self.add(widget, label=citem.get('label'), name=citem.get('label'))
                 elif citem['type'] == 'int':
                     widget = QSpinBox()
@@ -960,6 +1466,9 @@ def dialog(items, expdat=None, title=None):
                 elif citem['type'] == 'filename':
                     widget = QLineEdit()
                     self.add(widget, label=citem.get('label'), name=citem.get('label'), addfilebutton=True)
+                elif citem['type'] == 'dirname':
+                    widget = QLineEdit()
+                    self.add(widget, label=citem.get('label'), name=citem.get('label'), adddirbutton=True)
                 elif citem['type'] == 'bool':
                     widget = QCheckBox()
                     if 'default' in citem:
@@ -969,6 +1478,8 @@ def dialog(items, expdat=None, title=None):
                     widget = QLabel('<None>')
                     citem['selected'] = []
                     self.add(widget, label=citem.get('label'), name=citem.get('label'), add_select_button=citem, idx=idx)
+                if 'preview' in citem and citem['type'] in ('string', 'int', 'float'):
+                    self.add_preview(widget, citem)
 
             buttonBox = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
 
@@ -977,7 +1488,7 @@ def dialog(items, expdat=None, title=None):
 
             self.layout.addWidget(buttonBox)
 
-        def add(self, widget, name=None, label=None, addbutton=False, addfilebutton=False, add_select_button=None, idx=None):
+        def add(self, widget, name=None, label=None, addbutton=False, addfilebutton=False, adddirbutton=False, add_select_button=None, idx=None):
             '''Add the widget to the dialog
 
             Parameters
@@ -991,6 +1502,8 @@ def dialog(items, expdat=None, title=None):
                 True to add a button which opens the selection from field dialog
             addfilebutton: bool, optional
                 True to add a file select dialog button
+            adddirbutton: bool, optional
+                True to add a directory select dialog button
             add_select_button: item or None, optional
                 not None to add a button opening a multi select dialog for values from the 'items' field. If 'items' field is None, select from current 'field' values
             '''
@@ -1007,6 +1520,10 @@ def dialog(items, expdat=None, title=None):
                 bwidget = QPushButton(text='...')
                 bwidget.clicked.connect(lambda: self.file_button_click(widget))
                 hlayout.addWidget(bwidget)
+            if adddirbutton:
+                bwidget = QPushButton(text='...')
+                bwidget.clicked.connect(lambda: self.dir_button_click(widget))
+                hlayout.addWidget(bwidget)
             if add_select_button is not None:
                 bwidget = QPushButton(text='...', parent=widget)
                 bwidget.clicked.connect(lambda: self.select_items_click(widget, add_select_button))
@@ -1014,6 +1531,24 @@ def dialog(items, expdat=None, title=None):
             self.layout.addLayout(hlayout)
             self.widgets[name] = widget
 
+        def add_preview(self, widget, item):
+            '''Add a label below the widget showing the result of the item 'preview' function on the widget value'''
+            preview_widget = QLabel('')
+            self.layout.addWidget(preview_widget)
+
+            def update_preview(value):
+                try:
+                    preview_widget.setText(str(item['preview'](value)))
+                except Exception as e:
+                    preview_widget.setText('%s' % e)
+
+            if item['type'] == 'string':
+                widget.textChanged.connect(update_preview)
+                update_preview(str(widget.text()))
+            else:
+                widget.valueChanged.connect(update_preview)
+                update_preview(widget.value())
+
         def field_vals_click(self, widget):
             cfield = str(self.widgets['field'].currentText())
             if cfield not in self._expdat.sample_metadata.columns:
@@ -1028,6 +1563,12 @@ def dialog(items, expdat=None, title=None):
             if fname != '':
                 widget.setText(fname)
 
+        def dir_button_click(self, widget):
+            dname = QtWidgets.QFileDialog.getExistingDirectory(self, 'Select folder')
+            dname = str(dname)
+            if dname != '':
+                widget.setText(dname)
+
         def select_items_click(self, widget, item):
             select_items = item.get('items')
 
@@ -1067,7 +1608,7 @@ def dialog(items, expdat=None, title=None):
                         # convert the value from str to the field dtype
                         cval = _value_to_dtype(cval, self._expdat, self.widgets['field'].currentText())
                     output[cname] = cval
-                elif citem['type'] == 'filename':
+                elif citem['type'] in ('filename', 'dirname'):
                     output[cname] = str(self.widgets[cname].text())
                     if output[cname] == '':
                         output[cname] = None
@@ -1159,6 +1700,125 @@ class SListWindow(QtWidgets.QDialog):
         self.adjustSize()
 
 
+class JobsWindow(QtWidgets.QDialog):
+    # interval (ms) for refreshing the job list
+    REFRESH_INTERVAL = 1000
+    COLUMNS = ['id', 'job', 'experiment', 'priority', 'status', 'attempts', 'time (s)', 'cpu (s)', 'memory (MB)']
+
+    def __init__(self, app_window):
+        '''The job queue window (status, log, resource usage, cancel and retry of the queued jobs)
+
+        Parameters
+        ----------
+        app_window : AppWindow
+            the main window (owning the job queue)
+        '''
+        super().__init__(app_window)
+        self.setWindowTitle('Jobs')
+        self._app = app_window
+        self._queue = app_window._job_queue
+        self.layout = QVBoxLayout(self)
+
+        settings = QHBoxLayout()
+        settings.addWidget(QLabel('Workers'))
+        self.w_workers = QSpinBox()
+        self.w_workers.setRange(1, 256)
+        self.w_workers.setValue(self._queue.max_workers)
+        self.w_workers.valueChanged.connect(self._queue.set_max_workers)
+        settings.addWidget(self.w_workers)
+        settings.addWidget(QLabel('Priority of new jobs'))
+        self.w_priority = QSpinBox()
+        self.w_priority.setRange(-100, 100)
+        self.w_priority.setValue(app_window._job_priority)
+        self.w_priority.valueChanged.connect(self.priority_changed)
+        settings.addWidget(self.w_priority)
+        self.layout.addLayout(settings)
+
+        self.w_table = QtWidgets.QTableWidget(0, len(self.COLUMNS))
+        self.w_table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.w_table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.w_table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.w_table.doubleClicked.connect(self.show_log)
+        self.layout.addWidget(self.w_table)
+
+        buttons = QHBoxLayout()
+        for cname, cfunc in [('Then...', self.then), ('Cancel', self.cancel), ('Retry', self.retry), ('Log', self.show_log), ('Clear finished', self.clear_finished)]:
+            cbutton = QPushButton(cname)
+            cbutton.clicked.connect(cfunc)
+            buttons.addWidget(cbutton)
+        self.layout.addLayout(buttons)
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.timeout.connect(self.refresh)
+        self._timer.start(self.REFRESH_INTERVAL)
+        self.refresh()
+        self.resize(800, 400)
+
+    def priority_changed(self, value):
+        self._app._job_priority = value
+
+    def refresh(self):
+        job_list = list(self._queue.jobs.values())
+        selected = self.selected_job()
+        self.w_table.setRowCount(len(job_list))
+        for row, job in enumerate(job_list):
+            values = [job.id, job.name, job.description, job.priority, job.status, job.attempts, '%.1f' % job.elapsed,
+                      '%.1f' % job.usage.get('cpu', 0), '%.0f' % job.usage.get('max_rss_mb', 0)]
+            for col, cval in enumerate(values):
+                self.w_table.setItem(row, col, QtWidgets.QTableWidgetItem(str(cval)))
+            if selected is not None and job.id == selected.id:
+                self.w_table.selectRow(row)
+
+    def selected_job(self):
+        rows = self.w_table.selectionModel().selectedRows()
+        if len(rows) == 0:
+            return None
+        item = self.w_table.item(rows[0].row(), 0)
+        if item is None:
+            return None
+        return self._queue.jobs.get(int(item.text()))
+
+    def then(self):
+        '''Run the next action (clicked in the main window) on the result of the selected job'''
+        job = self.selected_job()
+        if job is None:
+            return
+        self._app._queue_after = job
+        self._app.statusBar.showMessage('Choose an action to run on the result of job %d (%s)' % (job.id, job.name))
+
+    def cancel(self):
+        job = self.selected_job()
+        if job is not None:
+            self._queue.cancel(job.id)
+            self.refresh()
+
+    def retry(self):
+        job = self.selected_job()
+        if job is None:
+            return
+        try:
+            self._queue.retry(job.id)
+        except ValueError as e:
+            QtWidgets.QMessageBox.information(self, 'Cannot retry', str(e))
+            return
+        self._app._bg_timer.start(self._app.BACKGROUND_POLL_INTERVAL)
+        self.refresh()
+
+    def show_log(self):
+        job = self.selected_job()
+        if job is None:
+            return
+        lines = list(job.log)
+        if job.error is not None:
+            lines.extend(job.error.splitlines())
+        listwin = SListWindow(listdata=lines, listname='Job %d (%s) log' % (job.id, job.name))
+        listwin.exec_()
+
+    def clear_finished(self):
+        self._queue.remove_finished()
+        self.refresh()
+
+
 def choose_dlg(items, title=None):
     class ChooseDialogWindow(QDialog):
         '''A dialog that enables choosing one of several option buttons'''
@@ -1385,8 +2045,12 @@ def _value_to_dtype(val, exp, field):
     any_type
         the value converted to the exp/field data type
     '''
+    dtype = exp.sample_metadata[field].dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        # convert to the type of the categories
+        dtype = dtype.categories.dtype
     svalue = np.array([val])
-    svalue = svalue.astype(exp.sample_metadata[field].dtype)
+    svalue = svalue.astype(dtype)
     svalue = svalue[0]
     return svalue
 
@@ -1405,134 +2069,44 @@ def exception_hook(exception_type, value, traceback_info):
     QtWidgets.QMessageBox.information(None, "Error enountered", msg)
 
 
-def get_config_file():
-    '''Get the ezcalour config file location
-
-    If the environment EZCALOUR_CONFIG_FILE is set, take the config file from it
-    otherwise return EZCALOUR_PACKAGE_LOCATION/ezcalour_module/ezcalour.config
-
-    Returns
-    -------
-    config_file_name : str
-        the full path to the calour config file
-    '''
-    if 'EZCALOUR_CONFIG_FILE' in os.environ:
-        config_file_name = os.environ['EZCALOUR_CONFIG_FILE']
-        logger.debug('Using calour config file %s from EZCALOUR_CONFIG_FILE variable' % config_file_name)
-    else:
-        config_file_name = get_res_file_name('ezcalour.config')
-    return config_file_name
-
-######################
-# json comments functions modified from:
-# https://pypi.python.org/pypi/jsoncomment/0.2.3
-######################
-
-
-def comment_json_loads(custom_json_string, *args, **kwargs):
-    lines = custom_json_string.splitlines()
-    standard_json = json_preprocess(lines)
-    return json.loads(standard_json, *args, **kwargs)
-
-
-def comment_json_load(custom_json_file, *args, **kwargs):
-    return comment_json_loads(custom_json_file.read(), *args, **kwargs)
-
-
-def json_preprocess(lines):
-    # Comments
-    COMMENT_PREFIX = ("#", ";")
-    MULTILINE_START = "/*"
-    MULTILINE_END = "*/"
-
-    # Data strings
-    LONG_STRING = '"""'
-
-    standard_json = ""
-    is_multiline = False
-    keep_trail_space = 0
-
-    for line in lines:
-
-        # 0 if there is no trailing space
-        # 1 otherwise
-        keep_trail_space = int(line.endswith(" "))
-
-        # Remove all whitespace on both sides
-        line = line.strip()
-
-        # Skip blank lines
-        if len(line) == 0:
-            continue
-
-        # Skip single line comments
-        if line.startswith(COMMENT_PREFIX):
-            continue
-
-        # Mark the start of a multiline comment
-        # Not skipping, to identify single line comments using
-        #   multiline comment tokens, like
-        #   /***** Comment *****/
-        if line.startswith(MULTILINE_START):
-            is_multiline = True
-
-        # Skip a line of multiline comments
-        if is_multiline:
-            # Mark the end of a multiline comment
-            if line.endswith(MULTILINE_END):
-                is_multiline = False
-            continue
-
-        # Replace the multi line data token to the JSON valid one
-        if LONG_STRING in line:
-            line = line.replace(LONG_STRING, '"')
-
-        standard_json += line + " " * keep_trail_space
-
-    # Removing non-standard trailing commas
-    standard_json = standard_json.replace(",]", "]")
-    standard_json = standard_json.replace(",}", "}")
-
-    return standard_json
-
-
-def get_config_values(section=None, config_file_name=None):
-    '''Read the config json file and return the dict associated with section
-
-    Parameters
-    ----------
-    section : str or None
-        The config file section to read. if None return all file
-        Note: the config file is a json dict file, each section is a key
-        If section is not found, return empty dict {}
-    config_file_name: str or None
-        name of json config file to use
-        None to load the default ezcalour config file
-    '''
-    if config_file_name is None:
-        config_file_name = get_config_file()
-    try:
-        with open(config_file_name) as f:
-            conf = dict(comment_json_load(f))
-        if section is None:
-            return conf
-        if section not in conf:
-            return {}
-        return conf[section]
-    except:
-        logger.warn('Failed reading ezcalour config file %s section %s' % (config_file_name, section))
-        return {}
-
-
 def main():
     parser = argparse.ArgumentParser(description='GUI for Calour microbiome analysis')
-    parser.add_argument('--table', help='biom table to load on startup', default=None)
-    parser.add_argument('--map', help='mapping file to load on startup', default=None)
-    parser.add_argument('--name', help='loaded study name', default=None)
+    parser.add_argument('--table', help='biom table to load on startup. can be used multiple times to load several tables', action='append', default=None)
+    parser.add_argument('--map', help='mapping file to load on startup (one for each --table, or one for all tables)', action='append', default=None)
+    parser.add_argument('--name', help='loaded study name (one for each --table)', action='append', default=None)
+    parser.add_argument('--merge', help='merge all the tables supplied in --table into one experiment', action='store_true')
+    parser.add_argument('--export', help='save the loaded tables (merged if --merge) to this output prefix and exit without starting the GUI', default=None)
+    parser.add_argument('--export-format', help='export format (native is the EZCalour memory mapped directory format)', choices=['hdf5', 'json', 'txt', 'native'], default='hdf5')
+    parser.add_argument('--export-normalize', help='normalize the exported samples to this number of reads. default is to export the original read counts', default=None, type=int)
+    parser.add_argument('--export-verify', help='read back the exported hdf5 biom table and check it has the same ids, counts and taxonomy', action='store_true')
+    parser.add_argument('--compression', help='export hdf5 compression', choices=export.COMPRESSION_TYPES, default='gzip')
+    parser.add_argument('--compression-level', help='export compression level', default=4, type=int)
+    parser.add_argument('--gzip-fasta', help='gzip the exported fasta file', action='store_true')
+    parser.add_argument('--watch', help='watch this folder and load new or changed tables (the first --map is used for tables without a matching mapping file)', default=None)
+    parser.add_argument('--serve', help='start the local JSON-RPC analysis server instead of the GUI (tables in --table are preloaded)', action='store_true')
+    parser.add_argument('--serve-host', help='server address to listen on (a non-loopback address requires --serve-token)', default='127.0.0.1')
+    parser.add_argument('--serve-token', help='token the server requests must carry (Authorization: Bearer <token>). default is the EZCALOUR_SERVER_TOKEN environment variable, or a random token printed on startup',
+                        default=os.environ.get('EZCALOUR_SERVER_TOKEN'))
+    parser.add_argument('--serve-port', help='server port', default=server.DEFAULT_PORT, type=int)
+    parser.add_argument('--serve-workers', help='number of requests executed concurrently by the server', default=4, type=int)
+    parser.add_argument('--serve-queue', help='number of requests waiting for a worker before the server answers busy', default=16, type=int)
+    parser.add_argument('--serve-timeout', help='server request timeout (seconds)', default=600, type=float)
+    parser.add_argument('--figures', help='save the heatmaps of the loaded tables (merged if --merge) to this folder and exit without starting the GUI', default=None)
+    parser.add_argument('--figure-field', help='sample field to sort the heatmap by (a figure for each). can be used multiple times. default is unsorted', action='append', default=None)
+    parser.add_argument('--figure-format', help='figure format. can be used multiple times', action='append', choices=figures.FIGURE_FORMATS, default=None)
+    parser.add_argument('--figure-workers', help='number of figures rendered in parallel (default is the number of CPUs)', default=None, type=int)
+    parser.add_argument('--figure-max-size', help='downsample heatmaps to at most this number of samples and features', default=figures.MAX_SAMPLES, type=int)
+    parser.add_argument('--sample-query', help='read only the samples matching this metadata query (i.e. "body_site in (gut, oral) and age > 30")', default=None)
+    parser.add_argument('--min-sample-reads', help='read only the samples with at least this number of reads', default=None, type=float)
+    parser.add_argument('--min-feature-reads', help='read only the features with at least this number of total reads in the selected samples', default=None, type=float)
+    parser.add_argument('--feature-ids', help='read only the features listed in this file (one id per line)', default=None)
+    parser.add_argument('--out-of-core', help='open the HDF5 biom tables out of core (the data stays on disk and is read in chunks)', action='store_true')
     parser.add_argument('--log-level', help='debug messages level. use 10 for full debug information, 20 for INFO, 30 for WARNING', default=20, type=int)
     parser.add_argument('--version', help='print version information', action='store_true')
 
     args = parser.parse_args()
+    if args.serve and args.serve_token is None and not server.is_loopback(args.serve_host):
+        parser.error('--serve-host %s is not a loopback address, so it requires --serve-token' % args.serve_host)
 
     if args.version:
         print("EZCalour version %s" % __version__)
@@ -1547,21 +2121,89 @@ def main():
     if args.table is None:
         load_exp = None
     else:
-        load_exp = [(args.table, args.map, args.name)]
+        maps = args.map
+        if maps is None:
+            maps = [None] * len(args.table)
+        elif len(maps) == 1:
+            maps = maps * len(args.table)
+        if len(maps) != len(args.table):
+            raise ValueError('number of --map arguments (%d) does not match number of --table arguments (%d)' % (len(maps), len(args.table)))
+        names = args.name
+        if names is None:
+            names = [None] * len(args.table)
+        names = names + [None] * (len(args.table) - len(names))
+        load_exp = list(zip(args.table, maps, names))
 
     ca.set_log_level(args.log_level)
     logger.setLevel(args.log_level)
 
+    # the read-time sample / feature selection (pushed down into the HDF5 biom reader)
+    selection = {'sample_query': args.sample_query, 'min_feature_reads': args.min_feature_reads,
+                 'feature_ids': biomselect.read_id_list(args.feature_ids) if args.feature_ids is not None else None}
+    load_kwargs = {'normalize': 10000, 'min_reads': args.min_sample_reads, 'selection': selection, 'out_of_core': args.out_of_core}
+
     # ca.set_log_level('INFO')
     # logger.setLevel('INFO')
 
-    logger.info('Using ezcalour configuration file %s' % get_config_file())
+    if args.export is not None:
+        if load_exp is None:
+            raise ValueError('--export requires at least one --table')
+        tables = [(cdata[0], cdata[1]) for cdata in load_exp]
+        # a conversion - keep the original read counts unless asked otherwise
+        load_kwargs['normalize'] = args.export_normalize
+        if len(tables) == 1:
+            exps = loaders.read_tables(tables, **load_kwargs)
+            prefixes = [args.export]
+        elif args.merge:
+            exps = [loaders.read_and_merge(tables, **load_kwargs)]
+            prefixes = [args.export]
+        else:
+            exps = loaders.read_tables(tables, **load_kwargs)
+            prefixes = ['%s_%s' % (args.export, os.path.splitext(os.path.basename(ctable))[0]) for ctable, cmap in tables]
+        for cexp, cprefix in zip(exps, prefixes):
+            export.export_experiment(cexp, cprefix, fmt=args.export_format, compression=args.compression, level=args.compression_level,
+                                     compress_fasta=args.gzip_fasta, verify=args.export_verify)
+        exit(0)
+
+    if args.figures is not None:
+        if load_exp is None:
+            raise ValueError('--figures requires at least one --table')
+        tables = [(cdata[0], cdata[1]) for cdata in load_exp]
+        if args.merge:
+            exps = {load_exp[0][2] or 'merged': loaders.read_and_merge(tables, **load_kwargs)}
+        else:
+            exps = loaders.read_tables(tables, **load_kwargs)
+            exps = {cdata[2] or os.path.splitext(os.path.basename(cdata[0]))[0]: cexp for cdata, cexp in zip(load_exp, exps)}
+        fields = args.figure_field if args.figure_field is not None else [None]
+        formats = args.figure_format if args.figure_format is not None else ['png']
+        files = figures.export_figures(exps, fields, args.figures, formats=formats, max_workers=args.figure_workers,
+                                       max_samples=args.figure_max_size, max_features=args.figure_max_size)
+        logger.info('saved %d figures to %s' % (len(files), args.figures))
+        exit(0)
+
+    if args.serve:
+        rpc_server = server.AnalysisServer(max_workers=args.serve_workers, max_queue=args.serve_queue, timeout=args.serve_timeout, token=args.serve_token)
+        if load_exp is not None:
+            exps = loaders.read_tables([(cdata[0], cdata[1]) for cdata in load_exp], **load_kwargs)
+            for cexp, cdata in zip(exps, load_exp):
+                exp_id = rpc_server.store.add(cexp, name=cdata[2] if cdata[2] is not None else cdata[0])
+                logger.info('loaded %s as experiment id %s' % (cdata[0], exp_id))
+        try:
+            rpc_server.serve(host=args.serve_host, port=args.serve_port)
+        except KeyboardInterrupt:
+            logger.info('server stopped')
+        exit(0)
+
+    logger.info('Using ezcalour configuration file %s' % core.get_config_file())
 
     logger.info('starting Calour GUI')
     app = QtWidgets.QApplication(sys.argv)
     app, app_created = init_qt5()
     sys.excepthook = exception_hook
-    window = AppWindow(load_exp=load_exp)
+    watch_map = None
+    if args.watch is not None and args.map is not None:
+        watch_map = args.map[0]
+    window = AppWindow(load_exp=load_exp, merge_load=args.merge, watch_dir=args.watch, watch_map=watch_map, load_kwargs=load_kwargs)
     # window = AppWindow(load_exp=None)
     window.show()
     sys.exit(app.exec_())
@@ -0,0 +1,187 @@
+'''Headless heatmap figure export
+
+Renders the calour heatmap of an experiment (optionally sorted by a sample field) with the
+ezcalour config file 'plot' settings, using the non-interactive matplotlib Agg backend, and
+saves it as png / pdf / svg. export_figures renders many (experiment, field) figures in a
+process pool (the GUI uses the job queue for the same).
+
+Heatmaps larger than max_samples x max_features are downsampled before plotting, so each
+render takes a bounded time: the samples are subsampled stratified by the sort field (keeping
+their order), and the most abundant features are kept (in their original order).
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import re
+from logging import getLogger
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ezcalour_module import stats
+from ezcalour_module import sharedmem
+from ezcalour_module.preview import _strata, stratified_positions
+from ezcalour_module.experiment import subset_experiment, format_call
+
+logger = getLogger(__name__)
+
+FIGURE_FORMATS = ['png', 'pdf', 'svg']
+# the maximal heatmap size (larger experiments are downsampled)
+MAX_SAMPLES = 2000
+MAX_FEATURES = 2000
+
+
+def downsample(exp, field=None, max_samples=MAX_SAMPLES, max_features=MAX_FEATURES, random_seed=2020):
+    '''Reduce the experiment to at most max_samples x max_features for plotting
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    field : str or None, optional
+        the sample field to stratify the samples by (so all the groups are shown). None for no stratification
+    max_samples, max_features : int, optional
+    random_seed : int, optional
+
+    Returns
+    -------
+    calour.Experiment
+        exp itself if it is not larger than max_samples x max_features (out of core experiments are always read into memory)
+    '''
+    num_samples, num_features = exp.shape
+    if num_samples <= max_samples and num_features <= max_features:
+        return exp.to_experiment() if getattr(exp, 'out_of_core', False) else exp
+    sample_pos = None
+    feature_pos = None
+    if num_samples > max_samples:
+        if field is not None:
+            strata = _strata(exp.sample_metadata[field].values)
+        else:
+            strata = np.zeros(num_samples, dtype=int)
+        sample_pos = stratified_positions(strata, max_samples, random_seed=random_seed, min_per_stratum=1)
+    if num_features > max_features:
+        means = stats.get_stats(exp).values('mean')
+        feature_pos = np.sort(np.argsort(means, kind='mergesort')[::-1][:max_features])
+    logger.info('downsampling heatmap of %d samples x %d features to %d x %d' % (num_samples, num_features,
+                len(sample_pos) if sample_pos is not None else num_samples,
+                len(feature_pos) if feature_pos is not None else num_features))
+    newexp = subset_experiment(exp, sample_pos=sample_pos, feature_pos=feature_pos,
+                               call=format_call('downsample', max_samples=max_samples, max_features=max_features))
+    if getattr(newexp, 'out_of_core', False):
+        newexp = newexp.to_experiment()
+    return newexp
+
+
+def figure_file_name(outdir, exp_name, field, fmt):
+    '''Get the figure file name for the experiment and sort field (unsafe characters are replaced by _)'''
+    name = '%s_%s' % (exp_name, field if field is not None else 'unsorted')
+    name = re.sub(r'[^\w\-.]+', '_', name)
+    return os.path.join(outdir, '%s.%s' % (name, fmt))
+
+
+def render_figure(exp, filenames, field=None, sort=True, feature_field=None, barx_fields=None, plot_kwargs=None,
+                  max_samples=MAX_SAMPLES, max_features=MAX_FEATURES, dpi=150):
+    '''Render the experiment heatmap (without showing it) and save it
+
+    This function is used as the process pool worker, so it must stay a module level function
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    filenames : str or list of str
+        the output file(s). The format is set by the extension (png / pdf / svg)
+    field : str or None, optional
+        the sample field to sort by and show on the x axis. None to keep the sample order
+    sort : bool, optional
+        False to not sort the samples by the field
+    feature_field : str or None, optional
+        the feature field to show on the y axis (i.e. 'taxonomy')
+    barx_fields : list of str or None, optional
+        sample fields to show as color bars
+    plot_kwargs : dict or None, optional
+        additional calour plot parameters. None to use the config file 'plot' section
+    max_samples, max_features : int, optional
+        downsample larger heatmaps (see downsample)
+    dpi : int, optional
+        the png resolution
+
+    Returns
+    -------
+    list of str
+        the saved files
+    '''
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+    import matplotlib.pyplot as plt
+    from ezcalour_module import core
+
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    if plot_kwargs is None:
+        plot_kwargs = core.get_config_values('plot')
+    kwargs = dict(plot_kwargs)
+    kwargs.setdefault('feature_field', feature_field)
+    if sort and field is not None:
+        exp = exp.sort_samples(field)
+    exp = downsample(exp, field=field, max_samples=max_samples, max_features=max_features)
+    gui = exp.plot(gui='cli', sample_field=field, databases=[], barx_fields=barx_fields, xticks_max=None, **kwargs)
+    try:
+        for cname in filenames:
+            gui.figure.savefig(cname, dpi=dpi, bbox_inches='tight')
+            logger.debug('saved figure %s' % cname)
+    finally:
+        plt.close(gui.figure)
+    return filenames
+
+
+def export_figures(exps, fields, outdir, formats=('png',), max_workers=None, **kwargs):
+    '''Render and save the heatmaps for each experiment and sort field in a process pool
+
+    Parameters
+    ----------
+    exps : dict of {str: calour.Experiment}
+        the experiments to plot, by name (used for the file names)
+    fields : list of (str or None)
+        the sample fields to sort by (a figure for each). None for an unsorted figure.
+        Fields not in an experiment are skipped for it
+    outdir : str
+        the output directory (created if needed)
+    formats : list of str, optional
+        the figure formats (see FIGURE_FORMATS)
+    max_workers : int or None, optional
+        number of worker processes. None to use the number of CPUs
+    **kwargs :
+        passed to render_figure
+
+    Returns
+    -------
+    list of str
+        the saved files
+    '''
+    for cformat in formats:
+        if cformat not in FIGURE_FORMATS:
+            raise ValueError('Unknown figure format %s. Available formats are %s' % (cformat, FIGURE_FORMATS))
+    os.makedirs(outdir, exist_ok=True)
+    tasks = []
+    for cname, cexp in exps.items():
+        for cfield in fields:
+            if cfield is not None and cfield not in cexp.sample_metadata.columns:
+                logger.warning('field %s not in experiment %s - skipping' % (cfield, cname))
+                continue
+            tasks.append((cexp, [figure_file_name(outdir, cname, cfield, x) for x in formats], cfield))
+    logger.info('exporting %d figures to %s' % (len(tasks) * len(formats), outdir))
+    if max_workers == 1 or len(tasks) <= 1:
+        files = [render_figure(cexp, cfiles, field=cfield, **kwargs) for cexp, cfiles, cfield in tasks]
+    else:
+        # the experiments are passed to the workers through shared memory (see sharedmem.py)
+        sharedmem.prepare()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [sharedmem.submit(executor, render_figure, cexp, cfiles, cfield, **kwargs) for cexp, cfiles, cfield in tasks]
+            files = [cfuture.result() for cfuture in futures]
+    return [x for cfiles in files for x in cfiles]
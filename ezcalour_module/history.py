@@ -0,0 +1,527 @@
+'''Undo/redo history of experiment operations, stored as compact deltas
+
+Instead of keeping every intermediate experiment, each step is stored as the difference
+from its parent experiment: the sample/feature positions kept (which also encode sorting),
+the metadata columns added or changed, a per-sample scaling factor (for normalization)
+and the new call history entries. The full data matrix is stored only if the step changed
+the data in a way that cannot be described by these (for example a log transform).
+
+Each step also stores a reverse delta restoring the parent from the child: the data and
+metadata of the removed samples / features, the parent metadata columns changed by the
+step and the inverse scaling. So both undo and redo apply a single step to the current
+experiment (instead of replaying the history from the first experiment).
+
+The data check of a new step does not build the parent data subset: the parent and child
+data are compared using their products with random vectors (placed at the kept features).
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from ezcalour_module.experiment import subset_data, subset_experiment
+
+logger = getLogger(__name__)
+
+# experiment attributes handled explicitly by the delta (not stored in ExperimentDelta.attrs)
+_DELTA_FIELDS = {'data', 'sample_metadata', 'feature_metadata', 'info', '_call_history', '_displayname'}
+
+
+def _nbytes(obj):
+    '''Get the approximate memory used by an array / sparse matrix / DataFrame'''
+    if obj is None:
+        return 0
+    if scipy.sparse.issparse(obj):
+        obj = scipy.sparse.csr_matrix(obj)
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    if hasattr(obj, 'memory_usage'):
+        return int(obj.memory_usage(deep=True).sum())
+    if hasattr(obj, 'nbytes'):
+        return obj.nbytes
+    return 0
+
+
+def _positions(parent_index, child_index):
+    '''Get the position of each child index value in the parent index, or None if not a subset'''
+    if not parent_index.is_unique or not child_index.is_unique:
+        return None
+    pos = parent_index.get_indexer(child_index)
+    if np.any(pos < 0):
+        return None
+    if len(pos) == len(parent_index) and np.all(pos == np.arange(len(pos))):
+        # no change - store nothing
+        return slice(None)
+    return pos
+
+
+def _changed_columns(parent_md, child_md, pos):
+    '''Get the child metadata columns which are new or different from the parent columns (at positions pos)'''
+    if not isinstance(pos, slice):
+        parent_md = parent_md.iloc[pos]
+    changed = []
+    for ccol in child_md.columns:
+        if ccol not in parent_md.columns:
+            changed.append(ccol)
+            continue
+        pvals = parent_md[ccol]
+        cvals = child_md[ccol]
+        if pvals.dtype != cvals.dtype or not np.array_equal(pvals.values, cvals.values):
+            # array_equal fails on nan, so check using pandas equals
+            if not pvals.reset_index(drop=True).equals(cvals.reset_index(drop=True)):
+                changed.append(ccol)
+    if len(changed) == 0:
+        return None
+    return child_md[changed].copy()
+
+
+def _close(a, b):
+    '''Check if two arrays are equal up to floating point rounding'''
+    scale = max(np.abs(a).max(initial=0), np.abs(b).max(initial=0), 1)
+    return np.allclose(a, b, rtol=1e-9, atol=1e-9 * scale)
+
+
+def _projections(parent, child, sample_pos, feature_pos, num_vectors=2):
+    '''Get the products of the parent data (at the child samples / features) and the child data with random vectors
+
+    The parent data subset is not built - the vectors are placed at the kept feature positions
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray)
+        the parent and child products (child samples x (num_vectors + 1)). The first column is the row sums
+    '''
+    vectors = np.hstack([np.ones((child.data.shape[1], 1)), np.random.RandomState().standard_normal((child.data.shape[1], num_vectors))])
+    parent_vectors = np.zeros((parent.data.shape[1], vectors.shape[1]))
+    parent_vectors[feature_pos] = vectors
+    parent_proj = np.asarray(parent.data.dot(parent_vectors))[sample_pos]
+    child_proj = np.asarray(child.data.dot(vectors))
+    return parent_proj, child_proj
+
+
+def _row_sums(data):
+    return np.asarray(data.sum(axis=1)).ravel()
+
+
+def _scale_rows(data, scale):
+    '''Multiply each row of the data by scale (returns a new matrix)'''
+    if scipy.sparse.issparse(data):
+        data = scipy.sparse.csr_matrix(data, dtype=float, copy=True)
+        data.data *= np.repeat(scale, np.diff(data.indptr))
+        return data
+    return data.astype(float) * scale[:, None]
+
+
+class ExperimentDelta:
+    '''The difference between an experiment and its parent experiment'''
+    def __init__(self, sample_pos=slice(None), feature_pos=slice(None), sample_columns=None, feature_columns=None,
+                 sample_order=None, feature_order=None, scale=None, data=None, calls=None, info=None, attrs=None):
+        # positions (in the parent) of the samples/features in the child. slice(None) for no change
+        self.sample_pos = sample_pos
+        self.feature_pos = feature_pos
+        # DataFrame of the new or changed metadata columns (in the child order), or None
+        self.sample_columns = sample_columns
+        self.feature_columns = feature_columns
+        # the child metadata column order (to drop removed columns and restore the order)
+        self.sample_order = sample_order
+        self.feature_order = feature_order
+        # per-sample scaling factor (in the child order) applied to the data, or None
+        self.scale = scale
+        # the full child data (only if it cannot be described by positions and scaling), or None
+        self.data = data
+        # the call history entries added in the child
+        self.calls = calls if calls is not None else []
+        self.info = info if info is not None else {}
+        # other experiment attributes which changed (i.e. _studyname, normalized)
+        self.attrs = attrs if attrs is not None else {}
+
+    @property
+    def nbytes(self):
+        '''Approximate memory used by the delta (in bytes)'''
+        total = _nbytes(self.sample_columns) + _nbytes(self.feature_columns) + _nbytes(self.scale) + _nbytes(self.data)
+        for cpos in (self.sample_pos, self.feature_pos):
+            if not isinstance(cpos, slice):
+                total += _nbytes(cpos)
+        return total
+
+
+class ReverseDelta:
+    '''The difference restoring the parent experiment from the child experiment (see compute_reverse_delta)'''
+    def __init__(self, sample_pos=slice(None), feature_pos=slice(None), removed_samples=None, removed_features=None):
+        # positions (in the parent) of the samples/features in the child. slice(None) for no change
+        self.sample_pos = sample_pos
+        self.feature_pos = feature_pos
+        # positions (in the parent) of the samples/features not in the child
+        self.removed_samples = removed_samples if removed_samples is not None else np.zeros(0, dtype=np.int64)
+        self.removed_features = removed_features if removed_features is not None else np.zeros(0, dtype=np.int64)
+        # the parent data of the removed samples (all parent features), and of the child samples at the removed features, or None
+        self.removed_sample_data = None
+        self.removed_feature_data = None
+        # per-sample scaling factor (in the child order) restoring the parent data, or None
+        self.scale = None
+        # the full parent data (if it cannot be restored from the child data), or None
+        self.data = None
+        # the parent metadata of the removed samples/features, or None
+        self.removed_sample_metadata = None
+        self.removed_feature_metadata = None
+        # DataFrame of the parent metadata columns (in the child order) which the child changed or removed, or None
+        self.sample_columns = None
+        self.feature_columns = None
+        # the parent metadata column order
+        self.sample_order = None
+        self.feature_order = None
+        # the number of call history entries added in the child
+        self.num_calls = 0
+        self.info = {}
+        # the parent attributes which the child changed, and the child attributes not in the parent
+        self.attrs = {}
+        self.new_attrs = []
+
+    @property
+    def nbytes(self):
+        '''Approximate memory used by the reverse delta (in bytes)'''
+        total = 0
+        for cobj in (self.removed_samples, self.removed_features, self.removed_sample_data, self.removed_feature_data, self.scale, self.data,
+                     self.removed_sample_metadata, self.removed_feature_metadata, self.sample_columns, self.feature_columns):
+            total += _nbytes(cobj)
+        return total
+
+
+def compute_delta(parent, child):
+    '''Compute the delta that transforms the parent experiment into the child experiment
+
+    Parameters
+    ----------
+    parent, child : calour.Experiment
+
+    Returns
+    -------
+    ExperimentDelta or None
+        None if child is not derived from parent by subsetting/reordering
+        (i.e. sample or feature ids were changed), so the full child must be kept
+    '''
+    if getattr(parent, 'out_of_core', False) or getattr(child, 'out_of_core', False):
+        # the data is on disk - keep the (small) experiment views
+        return None
+    sample_pos = _positions(parent.sample_metadata.index, child.sample_metadata.index)
+    feature_pos = _positions(parent.feature_metadata.index, child.feature_metadata.index)
+    if sample_pos is None or feature_pos is None:
+        logger.debug('child ids are not a subset of parent ids - cannot compute delta')
+        return None
+
+    delta = ExperimentDelta(sample_pos=sample_pos, feature_pos=feature_pos)
+    delta.sample_columns = _changed_columns(parent.sample_metadata, child.sample_metadata, sample_pos)
+    delta.feature_columns = _changed_columns(parent.feature_metadata, child.feature_metadata, feature_pos)
+    delta.sample_order = list(child.sample_metadata.columns)
+    delta.feature_order = list(child.feature_metadata.columns)
+
+    # check if the data is the parent data subset, possibly with a per-sample scaling
+    spos = np.arange(parent.data.shape[0]) if isinstance(sample_pos, slice) else sample_pos
+    fpos = np.arange(parent.data.shape[1]) if isinstance(feature_pos, slice) else feature_pos
+    if child.data.shape != (len(spos), len(fpos)):
+        delta.data = child.data
+    else:
+        parent_proj, child_proj = _projections(parent, child, spos, fpos)
+        if not _close(parent_proj, child_proj):
+            psums = parent_proj[:, 0]
+            csums = child_proj[:, 0]
+            scale = np.zeros(len(psums))
+            nonzero = psums != 0
+            scale[nonzero] = csums[nonzero] / psums[nonzero]
+            if _close(parent_proj * scale[:, None], child_proj):
+                delta.scale = scale
+            else:
+                logger.debug('data changed - storing the full data in the delta')
+                delta.data = child.data
+
+    parent_history = getattr(parent, '_call_history', [])
+    delta.calls = list(getattr(child, '_call_history', []))[len(parent_history):]
+    delta.info = dict(child.info)
+    for ckey, cval in child.__dict__.items():
+        # skip the fields stored explicitly, and the ezcalour caches (i.e. metadata indexes)
+        if ckey in _DELTA_FIELDS or ckey.startswith('_ezcalour_'):
+            continue
+        if ckey not in parent.__dict__ or parent.__dict__[ckey] is not cval:
+            delta.attrs[ckey] = cval
+    return delta
+
+
+def apply_delta(parent, delta):
+    '''Create the child experiment from the parent experiment and the delta
+
+    Parameters
+    ----------
+    parent : calour.Experiment
+    delta : ExperimentDelta
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    spos = None if isinstance(delta.sample_pos, slice) else delta.sample_pos
+    fpos = None if isinstance(delta.feature_pos, slice) else delta.feature_pos
+    if delta.data is not None:
+        data = delta.data
+    else:
+        data = subset_data(parent.data, spos, fpos)
+        if delta.scale is not None:
+            data = _scale_rows(data, delta.scale)
+    newexp = subset_experiment(parent, spos, fpos, data=data, call=delta.calls)
+    for cmd, ccols, corder in ((newexp.sample_metadata, delta.sample_columns, delta.sample_order),
+                               (newexp.feature_metadata, delta.feature_columns, delta.feature_order)):
+        if ccols is not None:
+            for ccol in ccols.columns:
+                cmd[ccol] = ccols[ccol].values
+    newexp.sample_metadata = newexp.sample_metadata[delta.sample_order]
+    newexp.feature_metadata = newexp.feature_metadata[delta.feature_order]
+    newexp.info = dict(delta.info)
+    newexp.__dict__.update(delta.attrs)
+    return newexp
+
+
+def _removed(pos, size):
+    '''Get the positions (of size) not in pos'''
+    if isinstance(pos, slice):
+        return np.zeros(0, dtype=np.int64)
+    keep = np.zeros(size, dtype=bool)
+    keep[pos] = True
+    return np.where(~keep)[0]
+
+
+def compute_reverse_delta(parent, child, delta):
+    '''Compute the delta that restores the parent experiment from the child experiment
+
+    Parameters
+    ----------
+    parent, child : calour.Experiment
+    delta : ExperimentDelta
+        the delta from the parent to the child (see compute_delta)
+
+    Returns
+    -------
+    ReverseDelta
+    '''
+    rdelta = ReverseDelta(sample_pos=delta.sample_pos, feature_pos=delta.feature_pos,
+                          removed_samples=_removed(delta.sample_pos, parent.data.shape[0]),
+                          removed_features=_removed(delta.feature_pos, parent.data.shape[1]))
+    spos = None if isinstance(delta.sample_pos, slice) else delta.sample_pos
+    if delta.data is not None or scipy.sparse.issparse(parent.data) != scipy.sparse.issparse(child.data):
+        rdelta.data = parent.data
+    else:
+        if delta.scale is not None:
+            rdelta.scale = np.zeros(len(delta.scale))
+            nonzero = delta.scale != 0
+            rdelta.scale[nonzero] = 1 / delta.scale[nonzero]
+            if not np.all(nonzero):
+                # the child samples with no reads cannot be scaled back
+                rdelta.data = parent.data
+                rdelta.scale = None
+        if rdelta.data is None:
+            if len(rdelta.removed_samples) > 0:
+                rdelta.removed_sample_data = subset_data(parent.data, rdelta.removed_samples, None)
+            if len(rdelta.removed_features) > 0:
+                rdelta.removed_feature_data = subset_data(parent.data, spos, rdelta.removed_features)
+    if len(rdelta.removed_samples) > 0:
+        rdelta.removed_sample_metadata = parent.sample_metadata.iloc[rdelta.removed_samples].copy()
+    if len(rdelta.removed_features) > 0:
+        rdelta.removed_feature_metadata = parent.feature_metadata.iloc[rdelta.removed_features].copy()
+    rdelta.sample_columns = _changed_columns(child.sample_metadata, _kept(parent.sample_metadata, delta.sample_pos), slice(None))
+    rdelta.feature_columns = _changed_columns(child.feature_metadata, _kept(parent.feature_metadata, delta.feature_pos), slice(None))
+    rdelta.sample_order = list(parent.sample_metadata.columns)
+    rdelta.feature_order = list(parent.feature_metadata.columns)
+    rdelta.num_calls = len(delta.calls)
+    rdelta.info = dict(parent.info)
+    for ckey, cval in parent.__dict__.items():
+        if ckey in _DELTA_FIELDS or ckey.startswith('_ezcalour_'):
+            continue
+        if ckey not in child.__dict__ or child.__dict__[ckey] is not cval:
+            rdelta.attrs[ckey] = cval
+    rdelta.new_attrs = [x for x in child.__dict__ if x not in parent.__dict__ and x not in _DELTA_FIELDS and not x.startswith('_ezcalour_')]
+    return rdelta
+
+
+def _kept(md, pos):
+    '''Get the metadata rows at the positions (all rows for slice(None))'''
+    if isinstance(pos, slice):
+        return md
+    return md.iloc[pos]
+
+
+def _stack(parts, axis):
+    '''Concatenate the data matrices along the axis (0 - rows, 1 - columns)'''
+    parts = [x for x in parts if x is not None]
+    if len(parts) == 1:
+        return parts[0]
+    if scipy.sparse.issparse(parts[0]):
+        if axis == 0:
+            return scipy.sparse.vstack(parts, format='csr')
+        return scipy.sparse.hstack(parts, format='csr')
+    return np.concatenate(parts, axis=axis)
+
+
+def _restore_order(pos, removed):
+    '''Get the order restoring the parent positions from the kept (pos) then removed positions, or None if no change'''
+    if isinstance(pos, slice):
+        return None
+    return np.argsort(np.concatenate([pos, removed]), kind='mergesort')
+
+
+def _restore_metadata(md, columns, order, removed_md, restore):
+    for ccol in (columns.columns if columns is not None else []):
+        md[ccol] = columns[ccol].values
+    md = md[order]
+    if removed_md is not None:
+        md = pd.concat([md, removed_md])
+    if restore is not None:
+        md = md.iloc[restore]
+    return md
+
+
+def apply_reverse_delta(child, rdelta):
+    '''Create the parent experiment from the child experiment and the reverse delta
+
+    Parameters
+    ----------
+    child : calour.Experiment
+    rdelta : ReverseDelta
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    restore_samples = _restore_order(rdelta.sample_pos, rdelta.removed_samples)
+    restore_features = _restore_order(rdelta.feature_pos, rdelta.removed_features)
+    if rdelta.data is not None:
+        data = rdelta.data
+    else:
+        data = child.data
+        if rdelta.scale is not None:
+            data = _scale_rows(data, rdelta.scale)
+        if restore_features is not None:
+            data = subset_data(_stack([data, rdelta.removed_feature_data], axis=1), None, restore_features)
+        if restore_samples is not None:
+            data = subset_data(_stack([data, rdelta.removed_sample_data], axis=0), restore_samples, None)
+    newexp = subset_experiment(child, data=data)
+    newexp.sample_metadata = _restore_metadata(newexp.sample_metadata, rdelta.sample_columns, rdelta.sample_order,
+                                               rdelta.removed_sample_metadata, restore_samples)
+    newexp.feature_metadata = _restore_metadata(newexp.feature_metadata, rdelta.feature_columns, rdelta.feature_order,
+                                                rdelta.removed_feature_metadata, restore_features)
+    if rdelta.num_calls > 0:
+        newexp._call_history = newexp._call_history[:-rdelta.num_calls]
+    newexp.info = dict(rdelta.info)
+    for ckey in rdelta.new_attrs:
+        newexp.__dict__.pop(ckey, None)
+    newexp.__dict__.update(rdelta.attrs)
+    return newexp
+
+
+class ExperimentHistory:
+    '''Undo/redo history for one experiment in the experiment list
+
+    Each step is kept as an ExperimentDelta and a ReverseDelta (or as the full child and
+    parent experiments if a delta cannot be computed), so undo and redo cost one step.
+    '''
+    def __init__(self, root):
+        '''
+        Parameters
+        ----------
+        root : calour.Experiment
+            the first experiment in the history (restored from the reverse deltas, so it is not kept)
+        '''
+        # each step is an ExperimentDelta or a full calour.Experiment
+        self._steps = []
+        # the reverse of each step - a ReverseDelta or the full parent calour.Experiment
+        self._reverse = []
+        # the number of steps applied to the root to get the current experiment
+        self._pos = 0
+
+    def push(self, current, newexp):
+        '''Add a new step (removing the redo steps)
+
+        Parameters
+        ----------
+        current : calour.Experiment
+            the current experiment in the history
+        newexp : calour.Experiment
+            the experiment derived from current
+        '''
+        delta = compute_delta(current, newexp)
+        if delta is None:
+            delta = newexp
+            reverse = current
+        else:
+            reverse = compute_reverse_delta(current, newexp, delta)
+        del self._steps[self._pos:]
+        del self._reverse[self._pos:]
+        self._steps.append(delta)
+        self._reverse.append(reverse)
+        self._pos += 1
+        logger.debug('history step %d stored (%d bytes, %d bytes reverse)' % (self._pos, self._step_nbytes(delta), self._step_nbytes(reverse)))
+
+    def can_undo(self):
+        return self._pos > 0
+
+    def can_redo(self):
+        return self._pos < len(self._steps)
+
+    def undo(self, current):
+        '''Get the previous experiment in the history
+
+        Parameters
+        ----------
+        current : calour.Experiment
+            the current experiment in the history (the reverse step is applied to it)
+
+        Returns
+        -------
+        calour.Experiment
+        '''
+        if not self.can_undo():
+            raise ValueError('Nothing to undo')
+        self._pos -= 1
+        step = self._reverse[self._pos]
+        if isinstance(step, ReverseDelta):
+            return apply_reverse_delta(current, step)
+        return step
+
+    def redo(self, current):
+        '''Get the next experiment in the history
+
+        Parameters
+        ----------
+        current : calour.Experiment
+            the current experiment in the history (the redo step is applied to it)
+
+        Returns
+        -------
+        calour.Experiment
+        '''
+        if not self.can_redo():
+            raise ValueError('Nothing to redo')
+        step = self._steps[self._pos]
+        self._pos += 1
+        if isinstance(step, ExperimentDelta):
+            return apply_delta(current, step)
+        return step
+
+    def _step_nbytes(self, step):
+        if isinstance(step, (ExperimentDelta, ReverseDelta)):
+            return step.nbytes
+        return _nbytes(step.data) + _nbytes(step.sample_metadata) + _nbytes(step.feature_metadata)
+
+    @property
+    def nbytes(self):
+        '''Approximate memory used by the history steps (forward and reverse)'''
+        return sum([self._step_nbytes(cstep) for cstep in self._steps + self._reverse])
+
+    def __len__(self):
+        return len(self._steps)
@@ -0,0 +1,407 @@
+'''Job queue with priorities and dependencies, scheduled on a process pool
+
+Jobs (a picklable function + arguments) are submitted to the JobQueue with a priority and
+optional dependencies. A job argument can be a JobResult(job_id) placeholder, which is
+replaced by the result of that job when it is started (and adds the dependency), so
+actions can be chained, i.e. normalize and then diff. abundance on the normalized experiment.
+
+The queue does its own scheduling (the highest priority ready job is started when a worker
+is free), so poll() should be called periodically (i.e. from a GUI timer). Each job keeps
+its status, the log messages emitted while it ran and its resource usage (wall / cpu time and
+peak memory of the worker process).
+
+Experiment arguments and results are passed to / from the worker processes through shared
+memory (see sharedmem.py) instead of being pickled.
+
+Note that a running job cannot be stopped (the process pool does not support killing a single
+worker). Cancelling a running job discards its result when it finishes.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import logging
+import traceback
+from logging import getLogger
+from concurrent.futures import ProcessPoolExecutor
+
+from ezcalour_module import sharedmem
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+logger = getLogger(__name__)
+
+WAITING = 'waiting'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINISHED_STATUSES = (DONE, FAILED, CANCELLED)
+
+
+class JobResult:
+    '''Placeholder for the result of another job (used as a job argument)'''
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def __repr__(self):
+        return 'JobResult(%d)' % self.job_id
+
+
+class _ListHandler(logging.Handler):
+    '''Collect the log messages emitted while a job runs'''
+    def __init__(self):
+        super().__init__(level=logging.INFO)
+        self.lines = []
+        self.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def _usage():
+    '''Get the (cpu seconds, peak memory MB) of the current process'''
+    if resource is None:
+        return time.process_time(), 0.0
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in KB on linux and in bytes on macOS
+    rss = usage.ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+    return usage.ru_utime + usage.ru_stime, rss
+
+
+def _run_job(func, args, kwargs, shared=False):
+    '''Run the job function in the worker and collect its logs and resource usage
+
+    This is the process pool worker, so it must stay a module level function
+
+    Parameters
+    ----------
+    func : function
+    args : list
+    kwargs : dict
+    shared : bool, optional
+        True to attach the sharedmem.SharedExperiment arguments and share the result experiment (see sharedmem.py)
+
+    Returns
+    -------
+    (bool, result or str, list of str, dict)
+        (True, result) or (False, error message and traceback), the log lines and the resource usage
+    '''
+    handler = _ListHandler()
+    root = logging.getLogger()
+    root.addHandler(handler)
+    old_level = root.level
+    if root.level > logging.INFO or root.level == logging.NOTSET:
+        root.setLevel(logging.INFO)
+    start = time.time()
+    cpu_start, rss_start = _usage()
+    try:
+        if shared:
+            sharedmem._close_worker_segments()
+            args = [sharedmem.attach(x) for x in args]
+            kwargs = {k: sharedmem.attach(v) for k, v in kwargs.items()}
+        res = func(*args, **kwargs)
+        if shared:
+            res = sharedmem.share_result(res)
+        ok = True
+    except Exception as e:
+        res = '%s: %s\n%s' % (type(e).__name__, e, traceback.format_exc())
+        ok = False
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(old_level)
+    cpu_end, rss_end = _usage()
+    usage = {'wall': time.time() - start, 'cpu': cpu_end - cpu_start, 'max_rss_mb': rss_end, 'pid': os.getpid()}
+    return ok, res, handler.lines, usage
+
+
+class Job:
+    '''A queued job'''
+    def __init__(self, job_id, func, args, kwargs, name, priority, depends_on, callback, description):
+        self.id = job_id
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs)
+        self.name = name
+        self.priority = priority
+        # the jobs this job waits for (including the JobResult arguments)
+        placeholders = [x.job_id for x in list(self.args) + list(self.kwargs.values()) if isinstance(x, JobResult)]
+        self.depends_on = sorted(set(list(depends_on) + placeholders))
+        # called with the result (by the owner of the queue, see JobQueue.poll)
+        self.callback = callback
+        self.description = description
+        self.status = WAITING
+        self.result = None
+        self.error = None
+        self.log = []
+        self.usage = {}
+        self.attempts = 0
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self._future = None
+        self._cancel_requested = False
+        # the sharedmem handles of the arguments of the running job
+        self._shared = []
+
+    @property
+    def elapsed(self):
+        '''Run time (seconds) so far'''
+        if self.start_time is None:
+            return 0
+        end = self.end_time if self.end_time is not None else time.time()
+        return end - self.start_time
+
+    def __repr__(self):
+        return 'Job(%d, %s, %s)' % (self.id, self.name, self.status)
+
+
+class JobQueue:
+    '''Priority job queue with dependencies running on a process pool'''
+    def __init__(self, max_workers=None, executor_class=ProcessPoolExecutor, shared=None):
+        '''
+        Parameters
+        ----------
+        max_workers : int or None, optional
+            maximal number of jobs running concurrently. None to use the number of CPUs
+        executor_class : class, optional
+            the concurrent.futures executor to use (ThreadPoolExecutor for testing or I/O bound jobs)
+        shared : bool or None, optional
+            True to pass the experiments to / from the workers through shared memory (see sharedmem.py).
+            None to use shared memory for process pools
+        '''
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        if shared is None:
+            shared = issubclass(executor_class, ProcessPoolExecutor) and sharedmem.available()
+        self.max_workers = max_workers
+        self.shared = shared
+        self._executor_class = executor_class
+        self._executor = None
+        self._next_id = 1
+        # all the jobs by id (in submission order)
+        self.jobs = {}
+        # the jobs cancelled outside poll (returned by the next poll)
+        self._finished = []
+
+    def submit(self, func, args=(), kwargs=None, name=None, priority=0, depends_on=(), callback=None, description=''):
+        '''Add a job to the queue
+
+        Parameters
+        ----------
+        func : function
+            the job function. Must be picklable (a module level function)
+        args : tuple, optional
+            positional arguments. JobResult(job_id) arguments are replaced by the result of that job
+        kwargs : dict or None, optional
+            keyword arguments. JobResult(job_id) values are replaced by the result of that job
+        name : str or None, optional
+            the job name. None to use the function name
+        priority : int, optional
+            higher priority jobs are started first
+        depends_on : list of int, optional
+            ids of jobs that must finish successfully before this job starts
+        callback : function or None, optional
+            stored on the job (i.e. to register the result when the job is done)
+        description : str, optional
+            i.e. the experiment the job runs on
+
+        Returns
+        -------
+        Job
+        '''
+        if kwargs is None:
+            kwargs = {}
+        if name is None:
+            name = func.__name__
+        job = Job(self._next_id, func, args, kwargs, name, priority, depends_on, callback, description)
+        for cdep in job.depends_on:
+            if cdep not in self.jobs:
+                raise ValueError('Job %d depends on unknown job %d' % (job.id, cdep))
+        self._next_id += 1
+        self.jobs[job.id] = job
+        logger.debug('submitted job %r (priority %d, depends on %s)' % (job, priority, job.depends_on))
+        return job
+
+    def _resolve(self, value):
+        if isinstance(value, JobResult):
+            return self.jobs[value.job_id].result
+        return value
+
+    def _dependency_state(self, job):
+        '''Get DONE if all dependencies are done, FAILED if one failed / was cancelled, otherwise WAITING'''
+        for cdep in job.depends_on:
+            cstatus = self.jobs[cdep].status
+            if cstatus in (FAILED, CANCELLED):
+                return FAILED
+            if cstatus != DONE:
+                return WAITING
+        return DONE
+
+    @property
+    def running(self):
+        return [x for x in self.jobs.values() if x.status == RUNNING]
+
+    @property
+    def pending(self):
+        '''The jobs not finished yet'''
+        return [x for x in self.jobs.values() if x.status not in FINISHED_STATUSES]
+
+    def _start(self, job):
+        if self._executor is None:
+            if self.shared:
+                sharedmem.prepare()
+            self._executor = self._executor_class(max_workers=self.max_workers)
+        args = [self._resolve(x) for x in job.args]
+        kwargs = {k: self._resolve(v) for k, v in job.kwargs.items()}
+        if self.shared:
+            args = [sharedmem.share(x) for x in args]
+            kwargs = {k: sharedmem.share(v) for k, v in kwargs.items()}
+            job._shared = [x for x in args + list(kwargs.values()) if isinstance(x, sharedmem.SharedExperiment)]
+        job.status = RUNNING
+        job.attempts += 1
+        job.start_time = time.time()
+        job.end_time = None
+        job._future = self._executor.submit(_run_job, job.func, args, kwargs, self.shared)
+        logger.debug('started job %r' % job)
+
+    def _unpin(self, job):
+        '''Release the shared memory segments of the job arguments'''
+        for chandle in job._shared:
+            sharedmem.unpin(chandle)
+        job._shared = []
+
+    def poll(self):
+        '''Update the status of the running jobs and start the ready jobs
+
+        Returns
+        -------
+        list of Job
+            the jobs finished (done, failed or cancelled) since the last poll
+        '''
+        # (a cancelled job can be retried before the poll)
+        finished = [x for x in self._finished if x.status == CANCELLED]
+        self._finished = []
+        for job in self.running:
+            if not job._future.done():
+                continue
+            job.end_time = time.time()
+            try:
+                ok, res, job.log, job.usage = job._future.result()
+            except Exception as e:
+                # the worker process died, or the result could not be pickled
+                ok, res = False, '%s: %s' % (type(e).__name__, e)
+            job._future = None
+            self._unpin(job)
+            if ok:
+                res = sharedmem.adopt(res)
+            if job._cancel_requested:
+                job.status = CANCELLED
+            elif ok:
+                job.status = DONE
+                job.result = res
+            else:
+                job.status = FAILED
+                job.error = res
+                logger.warning('job %r failed: %s' % (job, res.splitlines()[0] if res else ''))
+            finished.append(job)
+
+        # fail the jobs whose dependencies failed, and start the ready jobs by priority
+        ready = []
+        for job in self.jobs.values():
+            if job.status != WAITING:
+                continue
+            cstate = self._dependency_state(job)
+            if cstate == FAILED:
+                job.status = CANCELLED
+                job.error = 'A job this job depends on (%s) failed or was cancelled' % job.depends_on
+                finished.append(job)
+            elif cstate == DONE:
+                ready.append(job)
+        ready.sort(key=lambda x: (-x.priority, x.id))
+        num_free = self.max_workers - len(self.running)
+        for job in ready[:max(num_free, 0)]:
+            self._start(job)
+        return finished
+
+    def _needed(self, job_id):
+        return any(job_id in x.depends_on for x in self.pending)
+
+    def cancel(self, job_id):
+        '''Cancel a job and the jobs depending on it
+
+        A waiting job is cancelled immediately. A running job is marked and its result is discarded when it finishes.
+        '''
+        job = self.jobs[job_id]
+        if job.status == WAITING:
+            job.status = CANCELLED
+            job.error = 'Cancelled'
+            self._finished.append(job)
+        elif job.status == RUNNING:
+            job._cancel_requested = True
+            if job._future.cancel():
+                # the job did not start, so the done path (poll) will not see it
+                job.status = CANCELLED
+                job.error = 'Cancelled'
+                job.end_time = time.time()
+                job._future = None
+                self._unpin(job)
+                self._finished.append(job)
+        for cjob in self.jobs.values():
+            if job_id in cjob.depends_on and cjob.status in (WAITING, RUNNING):
+                self.cancel(cjob.id)
+
+    def retry(self, job_id):
+        '''Requeue a failed or cancelled job (and the jobs depending on it that were cancelled)'''
+        job = self.jobs[job_id]
+        if job.status not in (FAILED, CANCELLED):
+            raise ValueError('Job %d is %s - only failed or cancelled jobs can be retried' % (job_id, job.status))
+        for cdep in job.depends_on:
+            if self.jobs[cdep].status in (FAILED, CANCELLED):
+                self.retry(cdep)
+        job.status = WAITING
+        job.error = None
+        job.result = None
+        job._cancel_requested = False
+        for cjob in self.jobs.values():
+            if job_id in cjob.depends_on and cjob.status == CANCELLED:
+                self.retry(cjob.id)
+
+    def remove_finished(self):
+        '''Remove the finished jobs no pending job depends on'''
+        for job in list(self.jobs.values()):
+            if job.status in FINISHED_STATUSES and not self._needed(job.id):
+                del self.jobs[job.id]
+
+    def set_max_workers(self, max_workers):
+        '''Change the number of concurrent jobs (the pool is recreated when no job is running)'''
+        if max_workers == self.max_workers:
+            return
+        self.max_workers = max_workers
+        if self._executor is not None and len(self.running) == 0:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def shutdown(self, wait=False):
+        '''Cancel the waiting jobs and shut down the pool'''
+        for job in self.pending:
+            if job.status == WAITING:
+                job.status = CANCELLED
+                job.error = 'Cancelled'
+                self._finished.append(job)
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
@@ -0,0 +1,308 @@
+'''Loading functions for EZCalour that do not depend on Qt
+
+Used by the GUI load dialogs and the command line to read one or many tables
+(optionally in parallel) and merge them into a single experiment.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+from glob import glob
+from logging import getLogger
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from ezcalour_module import native
+from ezcalour_module import metadata
+from ezcalour_module import biomselect
+from ezcalour_module import sharedmem
+from ezcalour_module.experiment import format_call
+
+logger = getLogger(__name__)
+
+# the table file extensions we know how to read (and the load type for each)
+TABLE_EXTENSIONS = {'.biom': 'Amplicon', '.qza': 'Qiime2'}
+
+# mapping file names to look for next to a table file (in this order).
+# {base} is replaced by the table file name without the extension
+MAP_FILE_PATTERNS = ['{base}_map.txt', '{base}.map.txt', '{base}_mapping.txt', 'map.txt', 'mapping.txt']
+
+
+def find_tables(folder, extensions=None):
+    '''Get the list of table files in a folder
+
+    Parameters
+    ----------
+    folder : str
+        the folder to look for tables in (not recursive)
+    extensions : list of str or None, optional
+        the file extensions to include. None to use all extensions in TABLE_EXTENSIONS
+
+    Returns
+    -------
+    list of str
+        full path to the table files (sorted by name)
+    '''
+    if extensions is None:
+        extensions = list(TABLE_EXTENSIONS.keys())
+    tables = []
+    for cext in extensions:
+        tables.extend(glob(os.path.join(folder, '*%s' % cext)))
+    tables = sorted(tables)
+    logger.debug('found %d tables in folder %s' % (len(tables), folder))
+    return tables
+
+
+def find_mapping_file(table_file, default=None):
+    '''Find the mapping file matching a table file
+
+    Looks in the table file directory for one of the MAP_FILE_PATTERNS names
+
+    Parameters
+    ----------
+    table_file : str
+        the table file to find the mapping file for
+    default : str or None, optional
+        the mapping file to return if no matching file is found
+
+    Returns
+    -------
+    str or None
+        the mapping file name, or default if not found
+    '''
+    dirname = os.path.dirname(table_file)
+    base = os.path.splitext(os.path.basename(table_file))[0]
+    for cpattern in MAP_FILE_PATTERNS:
+        cname = os.path.join(dirname, cpattern.format(base=base))
+        if os.path.isfile(cname):
+            return cname
+    return default
+
+
+def get_table_type(table_file):
+    '''Get the load type ('Amplicon', 'Qiime2') of a table based on the file extension
+
+    Parameters
+    ----------
+    table_file : str
+
+    Returns
+    -------
+    str
+        the load type. 'Amplicon' if extension is unknown
+    '''
+    ext = os.path.splitext(table_file)[1].lower()
+    return TABLE_EXTENSIONS.get(ext, 'Amplicon')
+
+
+def read_table(table_file, map_file=None, table_type=None, normalize=10000, min_reads=1000, selection=None, out_of_core=False):
+    '''Read a single table into a calour experiment
+
+    This function is used as the process pool worker, so it must stay a module level function
+
+    Parameters
+    ----------
+    table_file : str
+        the table (.biom / .qza) to read, or an EZCalour native experiment directory (.ezc)
+    map_file : str or None, optional
+        the mapping file matching the table
+    table_type : str or None, optional
+        'Amplicon' or 'Qiime2'. None to determine by the file extension
+    normalize : int or None, optional
+        the number of reads to normalize each sample to. None to skip normalization
+    min_reads : int or None, optional
+        remove samples with less than min_reads reads (before normalization)
+    selection : dict or None, optional
+        read only the selected samples and features of Amplicon tables. The keys are the
+        biomselect.read_selected sample_query, min_feature_reads and feature_ids parameters
+    out_of_core : bool, optional
+        True to open HDF5 biom tables as out-of-core experiments (see outofcore.py)
+
+    Returns
+    -------
+    calour.AmpliconExperiment
+    '''
+    if os.path.isdir(table_file) and native.is_native(table_file):
+        return native.read_native(table_file)
+    if out_of_core:
+        from ezcalour_module import outofcore
+
+        return outofcore.read_out_of_core(table_file, map_file, normalize=normalize, min_reads=min_reads)
+    # calour is imported here (and not at the module level) so importing the loaders stays fast
+    import calour as ca
+
+    if table_type is None:
+        table_type = get_table_type(table_file)
+    logger.debug('reading %s table %s map %s' % (table_type, table_file, map_file))
+    md_kwargs = metadata.read_kwargs(map_file)
+    if table_type == 'Qiime2':
+        expdat = ca.read_qiime2(table_file, sample_metadata_file=map_file, min_reads=min_reads, normalize=normalize, sample_metadata_kwargs=md_kwargs)
+    elif selection and biomselect.has_selection(**selection):
+        expdat = biomselect.read_selected(table_file, map_file, normalize=normalize, min_reads=min_reads, **selection)
+    else:
+        expdat = ca.read_amplicon(table_file, sample_metadata_file=map_file, min_reads=min_reads, normalize=normalize, sample_metadata_kwargs=md_kwargs)
+    return expdat
+
+
+def read_tables(tables, normalize=10000, min_reads=1000, max_workers=None, selection=None, out_of_core=False):
+    '''Read several tables in a process pool
+
+    Parameters
+    ----------
+    tables : list of (str, str or None)
+        the (table file, mapping file) to read
+    normalize : int or None, optional
+        the number of reads to normalize each sample to. None to skip normalization
+    min_reads : int or None, optional
+        remove samples with less than min_reads reads (before normalization)
+    max_workers : int or None, optional
+        number of worker processes. None to use the number of CPUs
+    selection : dict or None, optional
+        read only the selected samples and features (see read_table)
+    out_of_core : bool, optional
+        True to open HDF5 biom tables as out-of-core experiments (see read_table)
+
+    Returns
+    -------
+    list of calour.AmpliconExperiment
+        in the same order as tables
+    '''
+    if len(tables) == 0:
+        return []
+    # no need to pay for process startup and pickling for a single table
+    if len(tables) == 1 or max_workers == 1:
+        return [read_table(ctable, cmap, normalize=normalize, min_reads=min_reads, selection=selection, out_of_core=out_of_core) for ctable, cmap in tables]
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    max_workers = min(max_workers, len(tables))
+    logger.info('reading %d tables using %d processes' % (len(tables), max_workers))
+    # the experiments are returned through shared memory (see sharedmem.py)
+    sharedmem.prepare()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [sharedmem.submit(executor, read_table, ctable, cmap, None, normalize, min_reads, selection, out_of_core) for ctable, cmap in tables]
+        exps = [cfuture.result() for cfuture in futures]
+    return exps
+
+
+def merge_experiments(exps, names=None, source_field='_ezcalour_source'):
+    '''Merge several experiments into one experiment
+
+    Samples are concatenated and features are outer-joined. The merge is done on the
+    sparse data (the data of each experiment is re-indexed to the joint feature list)
+    so no dense copy of the data is created.
+    The merged experiment is normalized only if all the experiments are normalized to the
+    same number of reads. Its call history has the calls of each experiment (prefixed by
+    the experiment name) followed by the merge call.
+
+    Parameters
+    ----------
+    exps : list of calour.Experiment
+        the experiments to merge
+    names : list of str or None, optional
+        name of each experiment (stored in the source_field sample metadata field).
+        None to use the experiment data file name
+    source_field : str, optional
+        name of the sample metadata field to store the source experiment name in
+
+    Returns
+    -------
+    calour.Experiment
+        the merged experiment (same class as the first experiment)
+    '''
+    if len(exps) == 0:
+        raise ValueError('No experiments to merge')
+    if names is None:
+        names = [cexp.info.get('data_file', str(idx)) for idx, cexp in enumerate(exps)]
+
+    # the joint feature list, keeping the order of first appearance
+    all_features = pd.Index(pd.unique(np.concatenate([cexp.feature_metadata.index.values for cexp in exps])))
+    num_features = len(all_features)
+    logger.debug('merging %d experiments with %d total features' % (len(exps), num_features))
+
+    data = []
+    sample_mds = []
+    feature_mds = []
+    all_sample_ids = set()
+    for cexp, cname in zip(exps, names):
+        cdata = scipy.sparse.csr_matrix(cexp.get_data(sparse=True))
+        # move the column indices of the experiment to the joint feature positions
+        colmap = all_features.get_indexer(cexp.feature_metadata.index)
+        cdata = scipy.sparse.csr_matrix((cdata.data, colmap[cdata.indices], cdata.indptr), shape=(cdata.shape[0], num_features))
+        data.append(cdata)
+
+        csmd = cexp.sample_metadata.copy()
+        csmd[source_field] = cname
+        # sample ids must be unique in the merged experiment, so prefix the duplicates
+        dups = csmd.index.isin(list(all_sample_ids))
+        if dups.any():
+            logger.warning('%d duplicate sample ids in %s. Adding prefix' % (np.sum(dups), cname))
+            newids = np.where(dups, ['%s_%s' % (cname, cid) for cid in csmd.index], csmd.index)
+            csmd.index = newids
+            if '_sample_id' in csmd.columns:
+                csmd['_sample_id'] = newids
+        all_sample_ids.update(csmd.index)
+        sample_mds.append(csmd)
+        feature_mds.append(cexp.feature_metadata)
+
+    merged_data = scipy.sparse.vstack(data, format='csr')
+    sample_metadata = pd.concat(sample_mds, axis=0, sort=False)
+    # concat of categoricals with different categories gives object fields, so convert them back
+    cat_fields = set([ccol for cmd in sample_mds for ccol in cmd.columns if isinstance(cmd[ccol].dtype, pd.CategoricalDtype)])
+    metadata.categorize(sample_metadata, columns=list(cat_fields) + [source_field], max_category_fraction=1)
+    feature_metadata = feature_mds[0]
+    for cfmd in feature_mds[1:]:
+        feature_metadata = feature_metadata.combine_first(cfmd)
+    feature_metadata = feature_metadata.reindex(all_features)
+
+    info = dict(exps[0].info)
+    info['data_file'] = ';'.join([str(cexp.info.get('data_file', 'NA')) for cexp in exps])
+    info['sample_metadata_file'] = ';'.join([str(cexp.info.get('sample_metadata_file', 'NA')) for cexp in exps])
+    newexp = exps[0].__class__(merged_data, sample_metadata, feature_metadata, sparse=True, info=info,
+                               description='merge of %d experiments' % len(exps))
+    normalized = set([getattr(cexp, 'normalized', 0) for cexp in exps])
+    if len(normalized) == 1:
+        newexp.normalized = normalized.pop()
+    else:
+        logger.warning('merging experiments with different normalizations (%s). The merged experiment is not normalized' % ', '.join(sorted([str(x) for x in normalized])))
+        newexp.normalized = 0
+    newexp._call_history = ['%s: %s' % (cname, ccall) for cexp, cname in zip(exps, names) for ccall in getattr(cexp, '_call_history', [])]
+    newexp._call_history.append(format_call('merge_experiments', names=list(names), source_field=source_field))
+    return newexp
+
+
+def read_and_merge(tables, normalize=10000, min_reads=1000, max_workers=None, selection=None, out_of_core=False):
+    '''Read several tables in parallel and merge them into one experiment
+
+    Parameters
+    ----------
+    tables : list of (str, str or None)
+        the (table file, mapping file) to read
+    normalize : int or None, optional
+        the number of reads to normalize each sample to. None to skip normalization
+    min_reads : int or None, optional
+        remove samples with less than min_reads reads (before normalization)
+    max_workers : int or None, optional
+        number of worker processes. None to use the number of CPUs
+    selection : dict or None, optional
+        read only the selected samples and features (see read_table)
+    out_of_core : bool, optional
+        True to open HDF5 biom tables as out-of-core experiments (see read_table)
+
+    Returns
+    -------
+    calour.AmpliconExperiment
+    '''
+    if out_of_core:
+        raise ValueError('Out of core experiments cannot be merged')
+    exps = read_tables(tables, normalize=normalize, min_reads=min_reads, max_workers=max_workers, selection=selection)
+    names = [os.path.basename(ctable) for ctable, cmap in tables]
+    return merge_experiments(exps, names=names)
@@ -0,0 +1,207 @@
+'''Typed, categorical loading of mapping files
+
+Low cardinality string fields in the mapping file are stored as pandas categoricals
+(one small integer code per sample instead of a python string), which reduces the
+memory usage of large mapping files and makes comparisons on these fields vectorized.
+
+The inferred schema is cached next to the mapping file (as <mapping file>.ezschema.json)
+so it is only computed once per file version.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import json
+from logging import getLogger
+
+import pandas as pd
+
+logger = getLogger(__name__)
+
+SCHEMA_EXTENSION = '.ezschema.json'
+# number of rows read from the mapping file for the type inference
+SCHEMA_SAMPLE_ROWS = 10000
+# a string field is stored as categorical if number of unique values <= MAX_CATEGORY_FRACTION * number of values
+MAX_CATEGORY_FRACTION = 0.5
+
+
+def _is_categorical(values):
+    return isinstance(values.dtype, pd.CategoricalDtype)
+
+
+def infer_schema(md, max_category_fraction=MAX_CATEGORY_FRACTION):
+    '''Infer the type of each metadata field
+
+    Parameters
+    ----------
+    md : pandas.DataFrame
+        the metadata (read with all fields as str)
+    max_category_fraction : float, optional
+        a string field is categorical if the number of unique values is <= max_category_fraction * number of values
+
+    Returns
+    -------
+    dict of {str: str}
+        the type of each field ('numeric', 'category' or 'str')
+    '''
+    schema = {}
+    for ccol in md.columns:
+        values = md[ccol].dropna()
+        if len(values) == 0:
+            schema[ccol] = 'str'
+            continue
+        if pd.to_numeric(values, errors='coerce').notnull().all():
+            schema[ccol] = 'numeric'
+            continue
+        num_unique = values.nunique()
+        if num_unique <= max(2, max_category_fraction * len(values)):
+            schema[ccol] = 'category'
+        else:
+            schema[ccol] = 'str'
+    return schema
+
+
+def get_schema(map_file, use_cache=True):
+    '''Get the field types schema of a mapping file (using the cached schema if the file did not change)
+
+    Parameters
+    ----------
+    map_file : str
+        the tab separated mapping file (first column is the sample id)
+    use_cache : bool, optional
+        False to ignore the cached schema (it is still written)
+
+    Returns
+    -------
+    dict of {str: str}
+        the type of each field ('numeric', 'category' or 'str')
+    '''
+    cstat = os.stat(map_file)
+    cache_file = map_file + SCHEMA_EXTENSION
+    if use_cache and os.path.isfile(cache_file):
+        try:
+            with open(cache_file) as fl:
+                cache = json.load(fl)
+            if cache['size'] == cstat.st_size and cache['mtime'] == cstat.st_mtime:
+                logger.debug('using cached schema %s' % cache_file)
+                return cache['schema']
+        except Exception as e:
+            logger.debug('cannot read schema cache file %s: %s' % (cache_file, e))
+    sample = pd.read_csv(map_file, sep='\t', dtype=str, index_col=0, nrows=SCHEMA_SAMPLE_ROWS)
+    schema = infer_schema(sample)
+    try:
+        with open(cache_file, 'w') as fl:
+            json.dump({'size': cstat.st_size, 'mtime': cstat.st_mtime, 'schema': schema}, fl)
+    except OSError as e:
+        logger.debug('cannot write schema cache file %s: %s' % (cache_file, e))
+    return schema
+
+
+def read_kwargs(map_file):
+    '''Get the calour sample_metadata_kwargs for reading the mapping file with categorical fields
+
+    Parameters
+    ----------
+    map_file : str or None
+        the mapping file
+
+    Returns
+    -------
+    dict or None
+        the kwargs to pass to calour read functions as sample_metadata_kwargs (None if map_file is None)
+    '''
+    if map_file is None:
+        return None
+    try:
+        schema = get_schema(map_file)
+    except Exception as e:
+        logger.warning('cannot infer mapping file %s schema: %s' % (map_file, e))
+        return None
+    dtypes = {k: 'category' for k, v in schema.items() if v == 'category'}
+    if len(dtypes) == 0:
+        return None
+    return {'dtype': dtypes}
+
+
+def read_mapping(sample_ids, map_file):
+    '''Read the mapping file (first column is the sample id, categorical fields by the schema) aligned to the sample ids
+
+    Parameters
+    ----------
+    sample_ids : list of str
+        the data table sample ids
+    map_file : str or None
+        the mapping file. None to return an empty metadata table
+
+    Returns
+    -------
+    pandas.DataFrame
+        the sample metadata (index is sample_ids, NA for samples missing from the mapping file)
+    '''
+    if not map_file:
+        return pd.DataFrame(index=sample_ids)
+    kwargs = read_kwargs(map_file)
+    if kwargs is None:
+        kwargs = {}
+    dtypes = kwargs.get('dtype', {})
+    index_col = pd.read_csv(map_file, sep='\t', nrows=0).columns[0]
+    dtypes[index_col] = str
+    md = pd.read_csv(map_file, sep='\t', dtype=dtypes)
+    md.set_index(index_col, inplace=True)
+    if md.index.duplicated().any():
+        raise ValueError('duplicate sample ids in mapping file %s: %s' % (map_file, set(md.index[md.index.duplicated()])))
+    missing = set(sample_ids).difference(md.index)
+    if missing:
+        logger.warning('%d samples have data but do not have metadata: %r' % (len(missing), missing))
+    return md.reindex(sample_ids)
+
+
+def categorize(md, columns=None, max_category_fraction=MAX_CATEGORY_FRACTION):
+    '''Convert low cardinality string fields to categorical (in place)
+
+    Parameters
+    ----------
+    md : pandas.DataFrame
+        the metadata
+    columns : list of str or None, optional
+        the fields to convert. None to check all object fields
+    max_category_fraction : float, optional
+        a field is converted if the number of unique values is <= max_category_fraction * number of values
+    '''
+    if columns is None:
+        columns = [ccol for ccol in md.columns if md[ccol].dtype == object]
+    for ccol in columns:
+        values = md[ccol]
+        if _is_categorical(values) or values.dtype != object:
+            continue
+        if values.nunique() <= max(2, max_category_fraction * len(values)):
+            md[ccol] = values.astype('category')
+
+
+def keep_categoricals(newexp, exp):
+    '''Restore the categorical fields of exp in the sample metadata of newexp (derived from exp)
+
+    Unused categories are removed, and fields which lost their categorical type
+    (i.e. when calour builds a new metadata table) are converted back.
+
+    Parameters
+    ----------
+    newexp : calour.Experiment
+        the derived experiment (changed in place)
+    exp : calour.Experiment
+        the original experiment
+    '''
+    md = newexp.sample_metadata
+    for ccol in exp.sample_metadata.columns:
+        if ccol not in md.columns or not _is_categorical(exp.sample_metadata[ccol]):
+            continue
+        if _is_categorical(md[ccol]):
+            md[ccol] = md[ccol].cat.remove_unused_categories()
+        else:
+            md[ccol] = md[ccol].astype('category')
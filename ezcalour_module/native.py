@@ -0,0 +1,179 @@
+'''EZCalour native on-disk experiment format
+
+An experiment is stored as a directory containing:
+    manifest.json : the experiment class, shape, info, call history and metadata column types
+    data.npy (dense) or data.npy, indices.npy, indptr.npy (csr sparse) : the data buffers
+    sample_ids.npy, feature_ids.npy : the sample / feature ids
+    sample_md/<n>.npy, feature_md/<n>.npy : one file per metadata column
+        (categorical/string columns are stored as integer codes, with the categories in the manifest)
+
+The buffers are opened using numpy memory mapping (copy-on-write), so opening is
+almost instant regardless of the table size, the pages are read only when used, and
+several EZCalour processes opening the same experiment share the pages through the OS cache.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import json
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+logger = getLogger(__name__)
+
+NATIVE_FORMAT_NAME = 'ezcalour-native'
+NATIVE_FORMAT_VERSION = 1
+NATIVE_EXTENSION = '.ezc'
+
+
+def _save_column(values, fname):
+    '''Save a metadata column as a npy file
+
+    Returns
+    -------
+    dict
+        the column type description for the manifest
+    '''
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        np.save(fname, values.cat.codes.values)
+        return {'kind': 'categorical', 'categories': [_to_json(x) for x in values.cat.categories]}
+    if values.dtype.kind in 'biufcM':
+        np.save(fname, values.values)
+        return {'kind': 'numeric', 'dtype': str(values.dtype)}
+    # object / string column - store as categorical codes of the string values (missing values are -1)
+    cat = pd.Categorical(values.astype(str).where(values.notnull(), None))
+    np.save(fname, cat.codes)
+    return {'kind': 'object', 'categories': [_to_json(x) for x in cat.categories]}
+
+
+def _to_json(val):
+    if isinstance(val, np.generic):
+        return val.item()
+    return val
+
+
+def _load_column(fname, desc):
+    values = np.load(fname, mmap_mode='c')
+    if desc['kind'] == 'numeric':
+        return values
+    cat = pd.Categorical.from_codes(np.asarray(values), categories=desc['categories'])
+    if desc['kind'] == 'categorical':
+        return cat
+    return np.asarray(cat, dtype=object)
+
+
+def _save_metadata(md, dirname):
+    os.makedirs(dirname, exist_ok=True)
+    columns = []
+    for idx, ccol in enumerate(md.columns):
+        desc = _save_column(md[ccol], os.path.join(dirname, '%d.npy' % idx))
+        desc['name'] = ccol
+        columns.append(desc)
+    return columns
+
+
+def _load_metadata(dirname, columns, ids):
+    md = pd.DataFrame(index=pd.Index(ids))
+    for idx, desc in enumerate(columns):
+        md[desc['name']] = _load_column(os.path.join(dirname, '%d.npy' % idx), desc)
+    return md
+
+
+def save_native(exp, dirname):
+    '''Save the experiment in the EZCalour native format
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    dirname : str
+        the output directory (created if does not exist)
+    '''
+    os.makedirs(dirname, exist_ok=True)
+    data = exp.data
+    sparse = scipy.sparse.issparse(data)
+    if sparse:
+        data = scipy.sparse.csr_matrix(data)
+        np.save(os.path.join(dirname, 'data.npy'), data.data)
+        np.save(os.path.join(dirname, 'indices.npy'), data.indices)
+        np.save(os.path.join(dirname, 'indptr.npy'), data.indptr)
+    else:
+        np.save(os.path.join(dirname, 'data.npy'), np.ascontiguousarray(data))
+    np.save(os.path.join(dirname, 'sample_ids.npy'), np.array([str(x) for x in exp.sample_metadata.index]))
+    np.save(os.path.join(dirname, 'feature_ids.npy'), np.array([str(x) for x in exp.feature_metadata.index]))
+    manifest = {'format': NATIVE_FORMAT_NAME,
+                'version': NATIVE_FORMAT_VERSION,
+                'exp_class': exp.__class__.__name__,
+                'shape': list(data.shape),
+                'sparse': sparse,
+                'dtype': str(data.dtype),
+                'normalized': _to_json(getattr(exp, 'normalized', None)),
+                'description': getattr(exp, 'description', ''),
+                'info': {k: str(v) for k, v in exp.info.items()},
+                'call_history': [str(x) for x in getattr(exp, '_call_history', [])],
+                'sample_columns': _save_metadata(exp.sample_metadata, os.path.join(dirname, 'sample_md')),
+                'feature_columns': _save_metadata(exp.feature_metadata, os.path.join(dirname, 'feature_md'))}
+    # write the manifest last so a partially written directory cannot be opened
+    with open(os.path.join(dirname, 'manifest.json'), 'w') as fl:
+        json.dump(manifest, fl, indent=1)
+    logger.info('saved experiment in native format to %s' % dirname)
+
+
+def is_native(dirname):
+    '''Check if the directory contains an experiment in the EZCalour native format'''
+    return os.path.isfile(os.path.join(dirname, 'manifest.json'))
+
+
+def read_native(dirname):
+    '''Open an experiment saved in the EZCalour native format
+
+    The data buffers are memory mapped (copy-on-write), so nothing is read until used
+
+    Parameters
+    ----------
+    dirname : str
+        the experiment directory
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    # calour is imported here (and not at the module level) so importing this module stays fast
+    import calour as ca
+
+    with open(os.path.join(dirname, 'manifest.json')) as fl:
+        manifest = json.load(fl)
+    if manifest.get('format') != NATIVE_FORMAT_NAME:
+        raise ValueError('%s is not an EZCalour native experiment' % dirname)
+    if manifest.get('version', 0) > NATIVE_FORMAT_VERSION:
+        raise ValueError('%s was saved with a newer EZCalour version (format version %s)' % (dirname, manifest['version']))
+    shape = tuple(manifest['shape'])
+    if manifest['sparse']:
+        data = scipy.sparse.csr_matrix((np.load(os.path.join(dirname, 'data.npy'), mmap_mode='c'),
+                                        np.load(os.path.join(dirname, 'indices.npy'), mmap_mode='c'),
+                                        np.load(os.path.join(dirname, 'indptr.npy'), mmap_mode='c')), shape=shape, copy=False)
+    else:
+        data = np.load(os.path.join(dirname, 'data.npy'), mmap_mode='c')
+    sample_ids = np.load(os.path.join(dirname, 'sample_ids.npy')).astype(object)
+    feature_ids = np.load(os.path.join(dirname, 'feature_ids.npy')).astype(object)
+    sample_metadata = _load_metadata(os.path.join(dirname, 'sample_md'), manifest['sample_columns'], sample_ids)
+    feature_metadata = _load_metadata(os.path.join(dirname, 'feature_md'), manifest['feature_columns'], feature_ids)
+
+    exp_class = getattr(ca, manifest['exp_class'], ca.Experiment)
+    info = dict(manifest['info'])
+    info['data_file'] = dirname
+    exp = exp_class(data, sample_metadata, feature_metadata, sparse=manifest['sparse'], info=info,
+                    description=manifest.get('description', ''))
+    exp._call_history = list(manifest['call_history'])
+    if manifest.get('normalized') is not None:
+        exp.normalized = manifest['normalized']
+    logger.debug('opened native experiment %s (%d samples, %d features)' % (dirname, shape[0], shape[1]))
+    return exp
@@ -0,0 +1,251 @@
+'''Beta diversity distances and PCoA ordination for large experiments
+
+The sample distance matrix is computed in blocks of samples. For each pair of blocks, only
+the features present in one of the two blocks are densified (so the sparse data is never
+densified as a whole), and the block distances are computed using BLAS (jaccard, euclidean)
+or the scipy cdist C implementation (braycurtis), which release the GIL, so the block pairs
+run in parallel threads. The distance matrix is stored as float32 (1.6GB for 20k samples).
+
+The PCoA double centering is done in place on the distance matrix, and the leading axes are
+found using a randomized eigendecomposition (a few products of the matrix with a thin random
+matrix), so the cost is O(n^2 k) instead of the O(n^3) full eigendecomposition.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+from scipy.spatial.distance import cdist
+
+from ezcalour_module.experiment import subset_experiment, format_call
+
+logger = getLogger(__name__)
+
+DISTANCE_METHODS = ['braycurtis', 'jaccard', 'euclidean']
+# below this number of samples use the exact eigendecomposition
+EXACT_MAX_SAMPLES = 2000
+
+
+def _block_distance(block1, block2, method):
+    '''Get the distances between the rows of two dense blocks'''
+    if method == 'braycurtis':
+        dist = cdist(block1, block2, 'braycurtis')
+        # two empty samples
+        dist[np.isnan(dist)] = 0
+        return dist
+    if method == 'jaccard':
+        pres1 = (block1 > 0).astype(np.float64)
+        pres2 = (block2 > 0).astype(np.float64)
+        inter = pres1 @ pres2.T
+        union = pres1.sum(axis=1)[:, None] + pres2.sum(axis=1)[None, :] - inter
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dist = 1 - inter / union
+        dist[union == 0] = 0
+        return dist
+    if method == 'euclidean':
+        sqdist = np.sum(block1 ** 2, axis=1)[:, None] + np.sum(block2 ** 2, axis=1)[None, :] - 2 * (block1 @ block2.T)
+        return np.sqrt(np.maximum(sqdist, 0))
+    raise ValueError('Unknown distance method %s. Available methods are %s' % (method, DISTANCE_METHODS))
+
+
+def distance_matrix(data, method='braycurtis', memory_budget=256 * 2 ** 20, n_jobs=None):
+    '''Get the distance matrix between the rows (samples) of the data, computed in parallel blocks
+
+    Parameters
+    ----------
+    data : numpy.ndarray or scipy.sparse matrix
+        samples in rows, features in columns
+    method : str, optional
+        the distance method (see DISTANCE_METHODS). jaccard is on the presence/absence
+    memory_budget : int, optional
+        maximal number of bytes to use for the dense blocks of each block pair
+    n_jobs : int or None, optional
+        number of threads. None to use the number of CPUs
+
+    Returns
+    -------
+    numpy.ndarray of float32
+        the (num_samples x num_samples) distance matrix
+    '''
+    if method not in DISTANCE_METHODS:
+        raise ValueError('Unknown distance method %s. Available methods are %s' % (method, DISTANCE_METHODS))
+    data = scipy.sparse.csr_matrix(data, dtype=np.float64)
+    num_samples, num_features = data.shape
+    # two dense blocks of (block_size x active features) and the block distances
+    block_size = int(memory_budget / (8 * (2 * max(num_features, 1) + 1)))
+    block_size = min(max(block_size, 16), num_samples)
+    blocks = [np.arange(start, min(start + block_size, num_samples)) for start in range(0, num_samples, block_size)]
+    block_features = [np.unique(data[cblock].indices) for cblock in blocks]
+    dist = np.zeros((num_samples, num_samples), dtype=np.float32)
+
+    def _compute(pair):
+        idx1, idx2 = pair
+        active = np.union1d(block_features[idx1], block_features[idx2])
+        block1 = data[blocks[idx1]][:, active].toarray()
+        block2 = data[blocks[idx2]][:, active].toarray()
+        cdist_block = _block_distance(block1, block2, method)
+        dist[np.ix_(blocks[idx1], blocks[idx2])] = cdist_block
+        if idx1 != idx2:
+            dist[np.ix_(blocks[idx2], blocks[idx1])] = cdist_block.T
+
+    pairs = [(idx1, idx2) for idx1 in range(len(blocks)) for idx2 in range(idx1, len(blocks))]
+    logger.debug('computing %s distances for %d samples in %d block pairs (block size %d)' % (method, num_samples, len(pairs), block_size))
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(_compute, pairs))
+    np.fill_diagonal(dist, 0)
+    return dist
+
+
+def _double_center(dist, block_size=2048):
+    '''Convert the distance matrix (in place) to the PCoA centered matrix -0.5 * J D^2 J, in blocks of rows'''
+    num_samples = len(dist)
+    row_means = np.zeros(num_samples)
+    for start in range(0, num_samples, block_size):
+        cblock = dist[start:start + block_size]
+        np.square(cblock, out=cblock)
+        row_means[start:start + block_size] = cblock.mean(axis=1, dtype=np.float64)
+    grand_mean = row_means.mean()
+    for start in range(0, num_samples, block_size):
+        cblock = dist[start:start + block_size]
+        cblock -= row_means[start:start + block_size, None].astype(np.float32)
+        cblock -= row_means[None, :].astype(np.float32)
+        cblock += np.float32(grand_mean)
+        cblock *= np.float32(-0.5)
+    return dist
+
+
+def _randomized_eigh(mat, num_axes, oversample=10, num_iterations=4, random_seed=None):
+    '''Get the leading eigenvalues / eigenvectors of a symmetric matrix using the randomized range finder'''
+    rand = np.random.RandomState(random_seed)
+    size = min(num_axes + oversample, len(mat))
+    basis = mat @ rand.normal(size=(len(mat), size)).astype(mat.dtype)
+    for citer in range(num_iterations):
+        basis, _ = np.linalg.qr(basis)
+        basis = mat @ basis
+    basis, _ = np.linalg.qr(basis)
+    small = basis.T @ (mat @ basis)
+    eigvals, eigvecs = np.linalg.eigh((small + small.T).astype(np.float64) / 2)
+    return eigvals, basis.astype(np.float64) @ eigvecs
+
+
+def pcoa(dist, num_axes=3, random_seed=None):
+    '''Principal coordinates analysis of a distance matrix
+
+    Note the distance matrix is overwritten (used for the centered matrix)
+
+    Parameters
+    ----------
+    dist : numpy.ndarray
+        the (square, symmetric) distance matrix
+    num_axes : int, optional
+        the number of axes to return
+    random_seed : int or None, optional
+        for the randomized eigendecomposition (used when there are more than EXACT_MAX_SAMPLES samples)
+
+    Returns
+    -------
+    coords : numpy.ndarray
+        (num_samples x num_axes) the sample coordinates
+    proportion_explained : numpy.ndarray
+        the fraction of the total variance (the centered matrix trace) explained by each axis
+    '''
+    num_samples = len(dist)
+    num_axes = min(num_axes, num_samples)
+    centered = _double_center(dist)
+    total = np.trace(centered, dtype=np.float64)
+    if num_samples <= EXACT_MAX_SAMPLES:
+        eigvals, eigvecs = scipy.linalg.eigh(centered.astype(np.float64), subset_by_index=[num_samples - num_axes, num_samples - 1])
+    else:
+        eigvals, eigvecs = _randomized_eigh(centered, num_axes, random_seed=random_seed)
+    order = np.argsort(eigvals)[::-1][:num_axes]
+    eigvals = eigvals[order]
+    eigvecs = eigvecs[:, order]
+    # axes with negative eigenvalues (non euclidean distances) have no real coordinates
+    coords = eigvecs * np.sqrt(np.maximum(eigvals, 0))
+    proportion = eigvals / total if total > 0 else np.zeros(len(eigvals))
+    return coords, proportion
+
+
+def beta_diversity(exp, method='braycurtis', num_axes=3, random_seed=None, n_jobs=None):
+    '''Compute the PCoA of the beta diversity and add the sample coordinates as sample metadata fields
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    method : str, optional
+        the distance method (see DISTANCE_METHODS)
+    num_axes : int, optional
+        number of PCoA axes to add
+    random_seed : int or None, optional
+    n_jobs : int or None, optional
+        number of threads for the distance computation. None to use the number of CPUs
+
+    Returns
+    -------
+    calour.Experiment
+        with the coordinates in the sample metadata fields '<method>_PC1', '<method>_PC2'...
+        and the method and proportion explained in info['ordination']
+    '''
+    dist = distance_matrix(exp.data, method=method, n_jobs=n_jobs)
+    coords, proportion = pcoa(dist, num_axes=num_axes, random_seed=random_seed)
+    del dist
+    newexp = subset_experiment(exp, call=format_call('beta_diversity', method=method, num_axes=num_axes, random_seed=random_seed))
+    fields = []
+    for idx in range(coords.shape[1]):
+        cfield = '%s_PC%d' % (method, idx + 1)
+        newexp.sample_metadata[cfield] = coords[:, idx]
+        fields.append(cfield)
+    newexp.info['ordination'] = {'method': method, 'fields': fields, 'proportion_explained': [float(x) for x in proportion]}
+    logger.info('%s PCoA proportion explained: %s' % (method, ', '.join(['%.3f' % x for x in proportion])))
+    return newexp
+
+
+def plot_ordination(exp, field=None, axes=(1, 2)):
+    '''Scatter plot of the samples on two ordination axes (added by beta_diversity)
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+        an experiment returned by beta_diversity
+    field : str or None, optional
+        the sample metadata field to color the samples by. None to not color
+    axes : (int, int), optional
+        the axes to plot (1 is the first axis)
+
+    Returns
+    -------
+    matplotlib.figure.Figure
+    '''
+    import matplotlib.pyplot as plt
+
+    ordination = exp.info.get('ordination')
+    if ordination is None:
+        raise ValueError('No ordination in experiment. Run beta diversity first')
+    xfield, yfield = [ordination['fields'][x - 1] for x in axes]
+    xprop, yprop = [ordination['proportion_explained'][x - 1] for x in axes]
+    fig, ax = plt.subplots()
+    md = exp.sample_metadata
+    if field is None:
+        ax.scatter(md[xfield], md[yfield], s=10)
+    else:
+        for cval, cmd in md.groupby(field, observed=True):
+            ax.scatter(cmd[xfield], cmd[yfield], s=10, label=str(cval))
+        if md[field].nunique() <= 20:
+            ax.legend(title=field)
+    ax.set_xlabel('PC%d (%.1f%%)' % (axes[0], 100 * xprop))
+    ax.set_ylabel('PC%d (%.1f%%)' % (axes[1], 100 * yprop))
+    ax.set_title('%s PCoA' % ordination['method'])
+    return fig
@@ -0,0 +1,492 @@
+'''Out-of-core experiments for tables larger than the memory
+
+The data of an out-of-core experiment stays in the HDF5 biom table on disk. The biom
+format stores the matrix twice, compressed by samples and by features, so the table is
+read in chunks of samples (for the per-sample and per-feature sums, normalization and
+loading) or in chunks of features (for the per-feature permutation tests). The read
+chunks are kept in an in-memory least recently used cache of bounded size (shared by all
+the experiments derived from the same table).
+
+An OutOfCoreExperiment is a view of the table: the selected sample and feature positions
+(in their order), and a scale factor for each sample (normalization). So filtering,
+sorting and normalizing only create a new view (the needed statistics are computed in one
+pass over the chunks, see stats.py), and diff abundance / correlation stream the feature
+chunks through the block permutation tests (see permtest.py). A view which is small enough
+(at most MATERIALIZE_MAX_BYTES of non-zero values) is read into a regular calour
+experiment, so the final small results can be used with all the EZCalour actions.
+
+The views implement the calour Experiment methods used by the supported actions (normalize,
+sort_by_metadata, filter_samples); other actions raise an error asking to filter the
+experiment first.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import threading
+from logging import getLogger
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse
+
+from ezcalour_module import metadata
+from ezcalour_module import biomselect
+from ezcalour_module.experiment import subset_data, format_call
+
+logger = getLogger(__name__)
+
+# number of rows (samples or features) in each chunk read from the table
+CHUNK_ROWS = 2048
+# the maximal total size of the cached chunks
+CACHE_BYTES = 512 * 2 ** 20
+# views with at most this size (of the sparse data) are read into memory
+MATERIALIZE_MAX_BYTES = 1024 * 2 ** 20
+# the maximal size of the dense feature blocks used in the permutation tests
+BLOCK_BYTES = 128 * 2 ** 20
+# bytes per non-zero value in a csr matrix (float64 value and int32 index)
+_NNZ_BYTES = 12
+
+
+class ChunkCache:
+    '''A least recently used cache of the read chunks, bounded by their total size in bytes'''
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._chunks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        '''Get the chunk, calling loader() to read it if not in the cache'''
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            self._chunks.move_to_end(key)
+            self.hits += 1
+            return chunk
+        self.misses += 1
+        chunk = loader()
+        size = _csr_nbytes(chunk)
+        while self._chunks and self.nbytes + size > self.max_bytes:
+            _, old = self._chunks.popitem(last=False)
+            self.nbytes -= _csr_nbytes(old)
+        if size <= self.max_bytes:
+            self._chunks[key] = chunk
+            self.nbytes += size
+        return chunk
+
+    def clear(self):
+        self._chunks.clear()
+        self.nbytes = 0
+
+
+def _csr_nbytes(mat):
+    return mat.data.nbytes + mat.indices.nbytes + mat.indptr.nbytes
+
+
+class ChunkedTable:
+    '''An HDF5 biom table read in chunks of samples or features (see module documentation)
+
+    Parameters
+    ----------
+    table_file : str
+        the HDF5 biom table
+    chunk_rows : int, optional
+        number of samples / features in each chunk
+    cache_bytes : int, optional
+        the chunk cache size
+    '''
+    # the biom group storing the matrix compressed by each axis
+    _GROUPS = {'s': 'sample', 'f': 'observation'}
+
+    def __init__(self, table_file, chunk_rows=CHUNK_ROWS, cache_bytes=CACHE_BYTES):
+        import h5py
+
+        self.table_file = table_file
+        self.chunk_rows = chunk_rows
+        self.cache_bytes = cache_bytes
+        with h5py.File(table_file, 'r') as fl:
+            self.sample_ids = biomselect._decode(fl['sample/ids'][:])
+            self.feature_ids = biomselect._decode(fl['observation/ids'][:])
+            # the number of non-zero values of each sample / feature (used to estimate view sizes)
+            self.nnz = {'s': np.diff(fl['sample/matrix/indptr'][:]), 'f': np.diff(fl['observation/matrix/indptr'][:])}
+        self.shape = (len(self.sample_ids), len(self.feature_ids))
+        self._init_state()
+
+    def _init_state(self):
+        self._file = None
+        self._lock = threading.Lock()
+        self.cache = ChunkCache(self.cache_bytes)
+
+    def __getstate__(self):
+        # the open file, lock and cache are not sent to worker processes (reopened when needed)
+        state = dict(self.__dict__)
+        for ckey in ('_file', '_lock', 'cache'):
+            del state[ckey]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def _group(self, axis):
+        import h5py
+
+        if self._file is None:
+            self._file = h5py.File(self.table_file, 'r')
+        return self._file[self._GROUPS[axis]]
+
+    def chunk(self, axis, idx):
+        '''Get chunk idx of the rows (samples if axis is 's', features if 'f') as a csr matrix with all the columns'''
+        def _load():
+            start = idx * self.chunk_rows
+            end = min(start + self.chunk_rows, self.shape[0 if axis == 's' else 1])
+            num_columns = self.shape[1 if axis == 's' else 0]
+            return biomselect.read_rows(self._group(axis), np.arange(start, end), np.ones(num_columns, dtype=bool))
+
+        with self._lock:
+            return self.cache.get((axis, idx), _load)
+
+    def iter_rows(self, axis, row_pos, column_pos):
+        '''Iterate over the selected rows in chunks (in the table order)
+
+        Parameters
+        ----------
+        axis : str
+            's' to iterate over samples, 'f' to iterate over features
+        row_pos : numpy.ndarray of int
+            the rows to read (samples for axis 's')
+        column_pos : numpy.ndarray of int
+            the columns to keep (in this order)
+
+        Yields
+        ------
+        view_idx : numpy.ndarray of int
+            the position in row_pos of each row of the block
+        block : scipy.sparse.csr_matrix
+            (len(view_idx) x len(column_pos))
+        '''
+        row_pos = np.asarray(row_pos)
+        chunk_ids = row_pos // self.chunk_rows
+        order = np.argsort(chunk_ids, kind='mergesort')
+        bounds = np.concatenate([[0], np.where(np.diff(chunk_ids[order]) != 0)[0] + 1, [len(order)]])
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if start == end:
+                continue
+            view_idx = order[start:end]
+            cchunk = self.chunk(axis, chunk_ids[view_idx[0]])
+            yield view_idx, subset_data(cchunk, row_pos[view_idx] % self.chunk_rows, column_pos)
+
+
+class OutOfCoreExperiment:
+    '''A view of an HDF5 biom table on disk (see module documentation)
+
+    Parameters
+    ----------
+    table : ChunkedTable
+    sample_metadata : pandas.DataFrame
+        the metadata of the samples in the view
+    feature_metadata : pandas.DataFrame
+        the metadata of the features in the view
+    sample_pos, feature_pos : numpy.ndarray of int
+        the positions in the table of the samples / features in the view
+    sample_scale : numpy.ndarray or None, optional
+        the factor to multiply each sample by (for normalization). None for no scaling
+    info : dict or None, optional
+    description : str, optional
+    exp_class : str, optional
+        the calour experiment class to use when reading into memory
+    '''
+    out_of_core = True
+
+    def __init__(self, table, sample_metadata, feature_metadata, sample_pos, feature_pos, sample_scale=None, info=None,
+                 description='', exp_class='AmpliconExperiment'):
+        self.table = table
+        self.sample_metadata = sample_metadata
+        self.feature_metadata = feature_metadata
+        self.sample_pos = np.asarray(sample_pos)
+        self.feature_pos = np.asarray(feature_pos)
+        self.sample_scale = sample_scale
+        self.info = info if info is not None else {}
+        self.description = description
+        self.exp_class = exp_class
+        self.normalized = 0
+        self._call_history = []
+        self._studyname = description
+        # a new token for each view, so cached statistics are not used for another view
+        self.view_token = object()
+
+    @property
+    def shape(self):
+        return (len(self.sample_pos), len(self.feature_pos))
+
+    @property
+    def data(self):
+        raise ValueError('Experiment %s is out of core (%d samples, %d features) and its data is not in memory.\n'
+                         'Filter it (or use a supported action) until it is small enough to load' % (self._studyname, self.shape[0], self.shape[1]))
+
+    def __repr__(self):
+        return 'OutOfCoreExperiment %s with %d samples, %d features (table %s, cache %d MB)' % (
+            self.description, self.shape[0], self.shape[1], self.table.table_file, self.table.cache.max_bytes // 2 ** 20)
+
+    def nbytes_estimate(self):
+        '''Get an upper bound of the in-memory (csr) size of the view data'''
+        nnz = min(np.sum(self.table.nnz['s'][self.sample_pos]), np.sum(self.table.nnz['f'][self.feature_pos]))
+        return int(nnz) * _NNZ_BYTES
+
+    def _new_view(self, sample_pos=None, feature_pos=None, sample_scale=None, call=None, materialize=True):
+        '''Create a new view with a subset of the samples / features (positions in this view)
+
+        The new view is read into memory if it is small enough (and materialize is True)
+        '''
+        newexp = self.__class__.__new__(self.__class__)
+        newexp.__dict__.update(self.__dict__)
+        newexp.view_token = object()
+        if sample_pos is None:
+            newexp.sample_metadata = self.sample_metadata.copy()
+        else:
+            newexp.sample_pos = self.sample_pos[sample_pos]
+            newexp.sample_metadata = self.sample_metadata.iloc[sample_pos].copy()
+            if self.sample_scale is not None:
+                newexp.sample_scale = self.sample_scale[sample_pos]
+        if feature_pos is None:
+            newexp.feature_metadata = self.feature_metadata.copy()
+        else:
+            newexp.feature_pos = self.feature_pos[feature_pos]
+            newexp.feature_metadata = self.feature_metadata.iloc[feature_pos].copy()
+        if sample_scale is not None:
+            newexp.sample_scale = sample_scale
+        newexp.info = dict(self.info)
+        newexp._call_history = list(self._call_history)
+        if call is not None:
+            newexp._call_history.extend([call] if isinstance(call, str) else call)
+        if materialize and newexp.nbytes_estimate() <= MATERIALIZE_MAX_BYTES:
+            return newexp.to_experiment()
+        return newexp
+
+    def subset(self, sample_pos=None, feature_pos=None, call=None):
+        '''Get the view of the samples / features (see experiment.subset_experiment)'''
+        return self._new_view(sample_pos=sample_pos, feature_pos=feature_pos, call=call)
+
+    def iter_samples(self):
+        '''Iterate over the samples in chunks
+
+        Yields
+        ------
+        view_idx : numpy.ndarray of int
+            the positions (in the view) of the samples in the block
+        block : scipy.sparse.csr_matrix
+            (samples x features) the scaled data of the samples
+        '''
+        for view_idx, block in self.table.iter_rows('s', self.sample_pos, self.feature_pos):
+            if self.sample_scale is not None:
+                # the block is a copy, so it can be scaled in place
+                block.data *= np.repeat(self.sample_scale[view_idx], np.diff(block.indptr))
+            yield view_idx, block
+
+    def iter_features(self, feature_idx=None, sample_idx=None, max_bytes=BLOCK_BYTES):
+        '''Iterate over the features in dense blocks
+
+        Parameters
+        ----------
+        feature_idx : numpy.ndarray of int or None, optional
+            the features (positions in the view) to include. None for all features
+        sample_idx : numpy.ndarray of int or None, optional
+            the samples (positions in the view) to include. None for all samples
+        max_bytes : int, optional
+            the maximal size of each dense block
+
+        Yields
+        ------
+        idx : numpy.ndarray of int
+            the positions (in feature_idx) of the features in the block
+        block : numpy.ndarray
+            (features x samples) the scaled data
+        '''
+        if feature_idx is None:
+            feature_idx = np.arange(self.shape[1])
+        if sample_idx is None:
+            sample_idx = np.arange(self.shape[0])
+        scale = self.sample_scale[sample_idx] if self.sample_scale is not None else None
+        max_rows = max(1, int(max_bytes / (8 * max(len(sample_idx), 1))))
+        for view_idx, block in self.table.iter_rows('f', self.feature_pos[feature_idx], self.sample_pos[sample_idx]):
+            for start in range(0, len(view_idx), max_rows):
+                dense = block[start:start + max_rows].toarray()
+                if scale is not None:
+                    dense *= scale[None, :]
+                yield view_idx[start:start + max_rows], dense
+
+    def sums(self, cutoff):
+        '''Get the per-feature sums, per-sample sums and per-feature number of samples with value >= cutoff in one pass
+
+        Returns
+        -------
+        feature_sum, sample_sum, feature_present : numpy.ndarray
+        '''
+        num_samples, num_features = self.shape
+        feature_sum = np.zeros(num_features)
+        sample_sum = np.zeros(num_samples)
+        present = np.zeros(num_features, dtype=np.int64)
+        for view_idx, block in self.iter_samples():
+            feature_sum += np.bincount(block.indices, weights=block.data, minlength=num_features)
+            sample_sum[view_idx] = np.asarray(block.sum(axis=1)).ravel()
+            present += np.bincount(block.indices[block.data >= cutoff], minlength=num_features)
+        return feature_sum, sample_sum, present
+
+    def feature_dot(self, weights):
+        '''Get data.T @ weights (i.e. the weighted feature means), streaming over the samples'''
+        result = np.zeros(self.shape[1])
+        for view_idx, block in self.iter_samples():
+            result += block.T.dot(weights[view_idx])
+        return result
+
+    def to_experiment(self):
+        '''Read the view into a calour experiment
+
+        Returns
+        -------
+        calour.Experiment
+        '''
+        num_samples, num_features = self.shape
+        blocks = []
+        order = []
+        for view_idx, block in self.iter_samples():
+            blocks.append(block)
+            order.append(view_idx)
+        if len(blocks) > 0:
+            data = scipy.sparse.vstack(blocks, format='csr')
+            # the blocks are in the table order. put the samples in the view order
+            data = data[np.argsort(np.concatenate(order))]
+        else:
+            data = scipy.sparse.csr_matrix((num_samples, num_features))
+        logger.info('read out of core experiment %s into memory (%d samples, %d features)' % (self._studyname, num_samples, num_features))
+        return self.with_data(data, call='to_experiment()')
+
+    def with_data(self, data, sample_pos=None, feature_pos=None, call=None):
+        '''Get a calour experiment with the metadata of a subset of the view and the given data
+
+        Parameters
+        ----------
+        data : numpy.ndarray or scipy.sparse.csr_matrix
+            (samples x features) the data of the subset (i.e. computed by streaming over the view)
+        sample_pos, feature_pos : numpy.ndarray of int or None, optional
+            the positions (in the view) of the samples / features. None for all
+        call : str or list of str or None, optional
+            the call history entries to add
+
+        Returns
+        -------
+        calour.Experiment
+        '''
+        import calour as ca
+
+        sample_md = self.sample_metadata if sample_pos is None else self.sample_metadata.iloc[sample_pos]
+        feature_md = self.feature_metadata if feature_pos is None else self.feature_metadata.iloc[feature_pos]
+        exp_class = getattr(ca, self.exp_class, ca.Experiment)
+        exp = exp_class(data, sample_md.copy(), feature_md.copy(), sparse=scipy.sparse.issparse(data), info=dict(self.info),
+                        description=self.description)
+        exp._call_history = list(self._call_history)
+        if call is not None:
+            exp._call_history.extend([call] if isinstance(call, str) else call)
+        exp.normalized = self.normalized
+        exp._studyname = self._studyname
+        return exp
+
+    # the calour Experiment methods used by the core actions
+
+    def normalize(self, total=10000):
+        '''Normalize each sample to total (only the sample scale factors are changed)'''
+        from ezcalour_module import stats
+
+        sample_sum = stats.get_stats(self).values('sample_sum')
+        with np.errstate(divide='ignore'):
+            factor = np.where(sample_sum > 0, total / sample_sum, 0)
+        scale = factor if self.sample_scale is None else self.sample_scale * factor
+        newexp = self._new_view(sample_scale=scale, call=format_call('normalize', total=total), materialize=False)
+        newexp.normalized = total
+        return newexp
+
+    def sort_by_metadata(self, field, axis=0):
+        '''Sort the samples (axis 0 or 's') or features (axis 1 or 'f') by a metadata field'''
+        if axis in (0, 's'):
+            order = self.sample_metadata.reset_index(drop=True).sort_values(field, kind='mergesort').index.values
+            return self._new_view(sample_pos=order, call=format_call('sort_by_metadata', field=field, axis='s'))
+        order = self.feature_metadata.reset_index(drop=True).sort_values(field, kind='mergesort').index.values
+        return self._new_view(feature_pos=order, call=format_call('sort_by_metadata', field=field, axis='f'))
+
+    def sort_samples(self, field):
+        return self.sort_by_metadata(field, axis=0)
+
+    def filter_samples(self, field, values, negate=False):
+        '''Keep the samples with a field value in values (or not in values if negate is True)'''
+        if not isinstance(values, (list, tuple, np.ndarray)):
+            values = [values]
+        mask = self.sample_metadata[field].isin(values).values
+        if negate:
+            mask = ~mask
+        return self._new_view(sample_pos=np.where(mask)[0], call=format_call('filter_samples', field=field, values=values, negate=negate))
+
+
+def is_out_of_core(exp):
+    '''True if the experiment is an out-of-core view'''
+    return getattr(exp, 'out_of_core', False)
+
+
+def read_out_of_core(table_file, map_file=None, normalize=10000, min_reads=1000, chunk_rows=CHUNK_ROWS, cache_bytes=CACHE_BYTES):
+    '''Open an HDF5 biom table as an out-of-core experiment
+
+    Only the ids, metadata and per-sample read counts are read (the sample read counts are
+    computed from the matrix values, see biomselect.row_sums)
+
+    Parameters
+    ----------
+    table_file : str
+        the HDF5 biom table
+    map_file : str or None, optional
+        the mapping file
+    normalize : int or None, optional
+        number of reads to normalize each sample to. None to skip normalization
+    min_reads : int or None, optional
+        remove samples with less than min_reads reads
+    chunk_rows : int, optional
+        number of samples / features read at a time
+    cache_bytes : int, optional
+        the maximal size of the chunk cache
+
+    Returns
+    -------
+    OutOfCoreExperiment
+    '''
+    import h5py
+
+    if not biomselect.is_hdf5_biom(table_file):
+        raise ValueError('%s is not an HDF5 biom table. Only HDF5 biom tables can be opened out of core' % table_file)
+    table = ChunkedTable(table_file, chunk_rows=chunk_rows, cache_bytes=cache_bytes)
+    sample_md = metadata.read_mapping(table.sample_ids, map_file)
+    sample_md['_sample_id'] = sample_md.index.values
+    with h5py.File(table_file, 'r') as fl:
+        reads = biomselect.row_sums(fl['sample'])
+        feature_md = biomselect._feature_metadata(fl, np.arange(table.shape[1]), table.feature_ids)
+    sample_md['_calour_original_abundance'] = reads
+    feature_md['_feature_id'] = feature_md.index.values
+    info = {'data_file': table_file, 'sample_metadata_file': map_file}
+    exp = OutOfCoreExperiment(table, sample_md, feature_md, np.arange(table.shape[0]), np.arange(table.shape[1]), info=info,
+                              description=os.path.basename(table_file))
+    exp._call_history = [format_call('read_out_of_core', table_file=table_file, map_file=map_file, normalize=normalize, min_reads=min_reads)]
+    if min_reads is not None:
+        exp = exp._new_view(sample_pos=np.where(reads >= min_reads)[0], call=format_call('filter_by_data', cutoff=min_reads), materialize=False)
+        reads = reads[exp.sample_pos]
+    if normalize is not None:
+        # all the features are in the view, so the sample sums are the original reads
+        with np.errstate(divide='ignore'):
+            scale = np.where(reads > 0, normalize / reads, 0)
+        exp = exp._new_view(sample_scale=scale, call=format_call('normalize', total=normalize), materialize=False)
+        exp.normalized = normalize
+    logger.info('opened %s out of core (%d samples, %d features)' % (table_file, exp.shape[0], exp.shape[1]))
+    return exp
@@ -0,0 +1,541 @@
+'''Permutation tests with discrete FDR (dsFDR) computed in blocks of features
+
+The same tests as calour diff_abundance ('meandiff' statistic) and correlation ('spearman'
+/ 'pearson', optionally only on the non-zero samples), with the same permutations for the
+same random seed, but the features are processed in blocks: the permuted statistics of
+each block are reduced to the per-feature p-values and a histogram of the permuted
+p-values (the permutation p-values take only numperm + 1 discrete values), which is all
+the dsFDR procedure needs. So the memory does not depend on the number of features, and
+the data can be streamed (see outofcore.py).
+
+The result (PermutationResult) keeps the statistics, p-values and null histogram, so it
+can be thresholded for any FDR level without recomputing the permutations. diff_abundance
+and correlation keep the results in a size bounded cache, keyed by the experiment data
+fingerprint and the test parameters (field and its values, groups, method, transform,
+number of permutations and random seed), so re-running a test with only a different FDR
+level just re-thresholds the cached result. Tests without a random seed are not cached.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import hashlib
+from logging import getLogger
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.stats
+
+from ezcalour_module import stats
+from ezcalour_module.experiment import subset_experiment, format_call
+
+logger = getLogger(__name__)
+
+TRANSFORMS = ['rankdata', 'binarydata', 'log2data', None]
+CORRELATION_METHODS = ['spearman', 'pearson']
+# the maximal total size of the cached test results
+CACHE_BYTES = 256 * 2 ** 20
+# the maximal size of the dense feature blocks
+BLOCK_BYTES = 128 * 2 ** 20
+
+
+class PermutationResult:
+    '''The per-feature statistics and the permutation null of a test
+
+    Attributes
+    ----------
+    stat : numpy.ndarray
+        the effect size of each feature (as calour _calour_stat)
+    pvals : numpy.ndarray
+        the permutation p-value of each feature
+    null_counts : numpy.ndarray of int
+        null_counts[k] is the number of permuted statistics (over all features) with
+        p-value 1 - k / (numperm + 1)
+    numperm : int
+    '''
+    def __init__(self, stat, pvals, null_counts, numperm):
+        self.stat = stat
+        self.pvals = pvals
+        self.null_counts = null_counts
+        self.numperm = numperm
+
+    @property
+    def nbytes(self):
+        return self.stat.nbytes + self.pvals.nbytes + self.null_counts.nbytes
+
+    def threshold(self, alpha):
+        '''Get the significant features at FDR level alpha (the calour dsfdr procedure)
+
+        Parameters
+        ----------
+        alpha : float
+
+        Returns
+        -------
+        reject : numpy.ndarray of bool
+        qvals : numpy.ndarray
+        '''
+        num_features = len(self.pvals)
+        qvals = np.ones(num_features)
+        if num_features == 0:
+            return np.zeros(0, dtype=bool), qvals
+        # the candidate thresholds, from the largest p-value
+        candidates = np.unique(self.pvals)[::-1]
+        real_num = np.searchsorted(np.sort(self.pvals), candidates, side='right')
+        levels = _pvalue_levels(self.numperm)
+        # number of permuted p-values <= each candidate (levels are descending)
+        null_le = np.cumsum(self.null_counts[::-1])[::-1]
+        null_num = null_le[np.searchsorted(-levels, -candidates, side='left')]
+        fdr = (real_num + null_num) / (real_num * (self.numperm + 1))
+        good = np.where(fdr <= alpha)[0]
+        if len(good) == 0:
+            return np.zeros(num_features, dtype=bool), qvals
+        qvals = np.minimum(fdr[np.searchsorted(-candidates, -self.pvals)], 1)
+        return self.pvals <= candidates[good[0]], qvals
+
+
+def _pvalue_levels(numperm):
+    '''The possible permutation p-values (descending), computed as in calour dsfdr'''
+    return 1 - (np.arange(numperm + 1, dtype=np.float64) / (numperm + 1))
+
+
+def transform_block(data, transform):
+    '''Transform a (features x samples) block as calour dsfdr (each feature separately)'''
+    if transform == 'rankdata':
+        return scipy.stats.rankdata(data, axis=1)
+    if transform == 'binarydata':
+        data = data.copy()
+        data[data != 0] = 1
+        return data
+    if transform == 'log2data':
+        return np.log2(np.maximum(data, 2))
+    if transform is None:
+        return data
+    raise ValueError('transform type %s not supported. Available transforms are %s' % (transform, TRANSFORMS))
+
+
+def block_pvalues(t, u):
+    '''Get the permutation p-values and the null p-value histogram of a block
+
+    Parameters
+    ----------
+    t : numpy.ndarray
+        (features) the absolute real statistics
+    u : numpy.ndarray
+        (features x numperm) the absolute permuted statistics (changed in place)
+
+    Returns
+    -------
+    pvals : numpy.ndarray
+    null_counts : numpy.ndarray of int
+        (numperm + 1) the histogram of the permuted p-value levels
+    '''
+    numperm = u.shape[1]
+    # fix floating point errors (as calour dsfdr)
+    close = np.isclose(t[:, None], u)
+    u[close] = np.broadcast_to(t[:, None], u.shape)[close]
+    # the 'min' rank - 1 of each value among the feature's [t, u] values
+    t_less = np.sum(u < t[:, None], axis=1)
+    u_less = scipy.stats.rankdata(u, method='min', axis=1) - 1 + (t[:, None] < u)
+    pvals = 1 - (t_less.astype(np.float64) / (numperm + 1))
+    null_counts = np.bincount(u_less.astype(np.int64).ravel(), minlength=numperm + 1)
+    return pvals, null_counts
+
+
+def _collect(blocks, num_features, numperm, compute):
+    '''Run the block computation on all the blocks and combine the results (in the feature order)'''
+    stat = np.zeros(num_features)
+    pvals = np.zeros(num_features)
+    null_counts = np.zeros(numperm + 1, dtype=np.int64)
+    for feature_idx, block in blocks:
+        cstat, t, u = compute(block)
+        cpvals, cnull = block_pvalues(t, u)
+        stat[feature_idx] = cstat
+        pvals[feature_idx] = cpvals
+        null_counts += cnull
+    return PermutationResult(stat, pvals, null_counts, numperm)
+
+
+def diff_abundance_test(blocks, num_features, labels, transform='rankdata', numperm=1000, random_seed=None):
+    '''Mean difference permutation test between two groups of samples (as calour diff_abundance)
+
+    Parameters
+    ----------
+    blocks : iterable of (numpy.ndarray of int, numpy.ndarray)
+        the (feature positions, features x samples data block) to test. Each feature should appear once
+    num_features : int
+        the total number of features in the blocks
+    labels : numpy.ndarray
+        (samples) 1 for the first group, 0 for the second group
+    transform : str or None, optional
+        see TRANSFORMS
+    numperm : int, optional
+    random_seed : int or None, optional
+
+    Returns
+    -------
+    PermutationResult
+        stat is mean(group 1) - mean(group 0) of the transformed data
+    '''
+    rng = np.random.default_rng(random_seed)
+    labels = np.asarray(labels).copy()
+    k1 = 1 / np.sum(labels == 0)
+    k2 = 1 / np.sum(labels == 1)
+    # the permuted group weights are the same for all blocks
+    p = np.zeros([len(labels), numperm])
+    labels_perm = labels
+    for cperm in range(numperm):
+        labels_perm = rng.permutation(labels_perm)
+        p[labels_perm == 0, cperm] = k1
+    p2 = np.ones(p.shape) * k2
+    p2[p > 0] = 0
+
+    def _compute(block):
+        data = transform_block(block, transform)
+        tstat = np.mean(data[:, labels == 1], axis=1) - np.mean(data[:, labels == 0], axis=1)
+        u = np.abs(np.dot(data, p) - np.dot(data, p2))
+        return tstat, np.abs(tstat), u
+
+    return _collect(blocks, num_features, numperm, _compute)
+
+
+def correlation_test(blocks, num_features, labels, method='spearman', nonzero=False, transform=None, numperm=1000, random_seed=None):
+    '''Correlation permutation test with a numeric sample field (as calour correlation)
+
+    Parameters
+    ----------
+    blocks : iterable of (numpy.ndarray of int, numpy.ndarray)
+        the (feature positions, features x samples data block) to test. Each feature should appear once
+    num_features : int
+        the total number of features in the blocks
+    labels : numpy.ndarray
+        (samples) the numeric field values (no NaNs)
+    method : str, optional
+        'spearman' or 'pearson'
+    nonzero : bool, optional
+        True to correlate each feature only on the samples where it is non-zero
+    transform : str or None, optional
+        see TRANSFORMS
+    numperm : int, optional
+    random_seed : int or None, optional
+
+    Returns
+    -------
+    PermutationResult
+        stat is the correlation coefficient
+    '''
+    if method not in CORRELATION_METHODS:
+        raise ValueError('Unknown correlation method %s. Available methods are %s' % (method, CORRELATION_METHODS))
+    rng = np.random.default_rng(random_seed)
+    labels = np.asarray(labels, dtype=np.float64)
+    if nonzero:
+        return _collect(blocks, num_features, numperm, lambda block: _nonzero_correlation(block, labels, method, transform, numperm, rng))
+    if method == 'spearman':
+        labels = scipy.stats.rankdata(labels)
+    labels = labels - np.mean(labels)
+    permlabels = np.zeros([len(labels), numperm])
+    for cperm in range(numperm):
+        permlabels[:, cperm] = rng.permutation(labels)
+    tlabels = labels / np.std(labels)
+    tlabels = tlabels / len(tlabels)
+    tlabels = tlabels - np.mean(tlabels)
+
+    def _compute(block):
+        data = transform_block(block, transform)
+        if method == 'spearman':
+            data = scipy.stats.rankdata(data, axis=1)
+        data = data - np.mean(data, axis=1)[:, None]
+        t = np.abs(np.dot(data, labels))
+        stdval = np.std(data, axis=1)
+        stdval[stdval == 0] = 1
+        tdata = data / stdval[:, None]
+        tdata = tdata - np.mean(tdata, axis=1)[:, None]
+        tdata = tdata - np.mean(data, axis=1)[:, None]
+        tstat = np.dot(tdata, tlabels)
+        return tstat, t, np.abs(np.dot(data, permlabels))
+
+    return _collect(blocks, num_features, numperm, _compute)
+
+
+def _nonzero_correlation(block, labels, method, transform, numperm, rng):
+    '''The correlation of each feature on its non-zero samples (as calour dsfdr nonzerospearman / nonzeropearson)'''
+    data = transform_block(block, transform)
+    num_features = data.shape[0]
+    tstat = np.zeros(num_features)
+    t = np.zeros(num_features)
+    u = np.zeros([num_features, numperm])
+    for idx in range(num_features):
+        nonzero = np.nonzero(data[idx])[0]
+        if len(nonzero) == 0:
+            continue
+        cvalues = data[idx, nonzero]
+        clabels = labels[nonzero]
+        if method == 'spearman':
+            cvalues = scipy.stats.rankdata(cvalues)
+            clabels = scipy.stats.rankdata(clabels)
+        cvalues = cvalues - np.mean(cvalues)
+        clabels = clabels - np.mean(clabels)
+        tstat[idx] = np.dot(cvalues, clabels)
+        t[idx] = np.abs(tstat[idx])
+        if np.std(cvalues) == 0:
+            continue
+        tstat[idx] = tstat[idx] / (np.std(cvalues) * np.std(clabels) * len(cvalues))
+        permlabels = np.zeros([len(clabels), numperm])
+        for cperm in range(numperm):
+            permlabels[:, cperm] = rng.permutation(clabels)
+        u[idx] = np.abs(np.dot(cvalues, permlabels))
+    return tstat, t, u
+
+
+class ResultCache:
+    '''A least recently used cache of the test results, bounded by their total size in bytes'''
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._results = OrderedDict()
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key):
+        entry = self._results.get(key)
+        if entry is not None:
+            self._results.move_to_end(key)
+        return entry
+
+    def put(self, key, feature_idx, result):
+        size = feature_idx.nbytes + result.nbytes
+        if key in self._results or size > self.max_bytes:
+            return
+        while self._results and self.nbytes + size > self.max_bytes:
+            _, (old_idx, old_result) = self._results.popitem(last=False)
+            self.nbytes -= old_idx.nbytes + old_result.nbytes
+        self._results[key] = (feature_idx, result)
+        self.nbytes += size
+
+    def clear(self):
+        self._results.clear()
+        self.nbytes = 0
+
+
+_cache = ResultCache()
+
+
+def clear_cache():
+    '''Remove all the cached test results
+
+    Returns
+    -------
+    int
+        the number of bytes freed
+    '''
+    freed = _cache.nbytes
+    _cache.clear()
+    logger.info('cleared %d cached test results' % freed)
+    return freed
+
+
+def cache_info():
+    '''Get the number of cached test results and their total size in bytes'''
+    return len(_cache), _cache.nbytes
+
+
+def fingerprint(exp):
+    '''Get a hash of the experiment data and sample / feature ids (computed once per data matrix)'''
+    token = stats._data_token(exp)
+    cached = getattr(exp, '_ezcalour_fingerprint', None)
+    if cached is not None and cached[0] is token:
+        return cached[1]
+    digest = hashlib.blake2b(digest_size=16)
+    if getattr(exp, 'out_of_core', False):
+        digest.update(os.path.abspath(exp.table.table_file).encode())
+        digest.update(str(os.path.getmtime(exp.table.table_file)).encode())
+        buffers = [exp.sample_pos, exp.feature_pos] + ([exp.sample_scale] if exp.sample_scale is not None else [])
+    elif scipy.sparse.issparse(exp.data):
+        data = scipy.sparse.csr_matrix(exp.data)
+        buffers = [data.data, data.indices, data.indptr]
+    else:
+        buffers = [exp.data]
+    for cbuf in buffers:
+        digest.update(np.ascontiguousarray(cbuf).view(np.uint8))
+    for cids in (exp.sample_metadata.index, exp.feature_metadata.index):
+        digest.update(pd.util.hash_pandas_object(pd.Series(cids, dtype=object), index=False).values.view(np.uint8))
+    exp._ezcalour_fingerprint = (token, digest.hexdigest())
+    return exp._ezcalour_fingerprint[1]
+
+
+def _values_hash(values):
+    return hashlib.blake2b(pd.util.hash_pandas_object(values, index=False).values.view(np.uint8), digest_size=16).hexdigest()
+
+
+def _feature_blocks(exp, feature_idx, sample_idx, max_bytes=BLOCK_BYTES):
+    '''Iterate over dense (features x samples) blocks of the selected features / samples
+
+    Yields (positions in feature_idx, block). Out of core experiments are read in chunks (see outofcore.py)
+    '''
+    if getattr(exp, 'out_of_core', False):
+        yield from exp.iter_features(feature_idx=feature_idx, sample_idx=sample_idx, max_bytes=max_bytes)
+        return
+    data = exp.data
+    if scipy.sparse.issparse(data):
+        data = scipy.sparse.csc_matrix(scipy.sparse.csr_matrix(data)[sample_idx])
+    else:
+        data = data[sample_idx]
+    max_rows = max(1, int(max_bytes / (8 * max(len(sample_idx), 1))))
+    for start in range(0, len(feature_idx), max_rows):
+        cpos = feature_idx[start:start + max_rows]
+        block = data[:, cpos]
+        block = block.toarray() if scipy.sparse.issparse(block) else np.array(block, dtype=np.float64)
+        yield np.arange(start, start + len(cpos)), block.T
+
+
+def _present_features(exp, sample_idx):
+    '''Get the features with non-zero total in the samples (as calour filter_sum_abundance(0, strict=True))'''
+    if len(sample_idx) == exp.shape[0]:
+        sums = stats.get_stats(exp).values('sum')
+    else:
+        mask = np.zeros(exp.shape[0], dtype=bool)
+        mask[sample_idx] = True
+        sums = stats.feature_means(exp, mask)
+    return np.where(sums > 0)[0]
+
+
+def _cached_test(key, random_seed, compute):
+    '''Get the (feature_idx, result) from the cache, or compute and cache it'''
+    if random_seed is None:
+        return compute()
+    entry = _cache.get(key)
+    if entry is not None:
+        logger.info('using the cached permutation test result')
+        return entry
+    feature_idx, result = compute()
+    _cache.put(key, feature_idx, result)
+    return feature_idx, result
+
+
+def _significant(exp, feature_idx, result, alpha, direction, call):
+    '''Get the significant features (in all the samples) with the test results, sorted by effect size as calour
+
+    Returns
+    -------
+    calour.Experiment or None
+        None if no significant features
+    '''
+    reject, qvals = result.threshold(alpha)
+    keep = np.where(reject)[0]
+    logger.info('found %d significant features' % len(keep))
+    if len(keep) == 0:
+        return None
+    stat = result.stat[keep]
+    pvals = result.pvals[keep]
+    # sort by effect size, and within the same effect size by p-value (as calour)
+    keep = keep[np.lexsort((np.where(stat > 0, -pvals, pvals), stat))]
+    newexp = subset_experiment(exp, feature_pos=feature_idx[keep], call=call)
+    newexp.feature_metadata['_calour_stat'] = result.stat[keep]
+    newexp.feature_metadata['_calour_pval'] = result.pvals[keep]
+    newexp.feature_metadata['_calour_qval'] = qvals[keep]
+    newexp.feature_metadata['_calour_direction'] = [direction[0] if x > 0 else direction[1] for x in result.stat[keep]]
+    return newexp
+
+
+def diff_abundance(exp, field, val1, val2=None, alpha=0.1, transform='rankdata', numperm=1000, random_seed=None):
+    '''Differential abundance (mean difference) permutation test between two groups of samples, as calour diff_abundance
+
+    Parameters
+    ----------
+    exp : calour.Experiment or outofcore.OutOfCoreExperiment
+    field : str
+        the field defining the groups
+    val1 : str or list of str
+        the field values of group 1
+    val2 : str or list of str or None, optional
+        the field values of group 2. None to use all samples not in group 1
+    alpha : float, optional
+        the FDR level
+    transform : str or None, optional
+        see TRANSFORMS
+    numperm : int, optional
+    random_seed : int or None, optional
+        None to not set the random seed (the result is not cached)
+
+    Returns
+    -------
+    calour.Experiment or None
+        the significant features (None if none found)
+    '''
+    val1 = list(val1) if isinstance(val1, (list, tuple)) else [val1]
+    values = exp.sample_metadata[field]
+    grp1 = ','.join([str(x) for x in val1])
+    if val2 is not None:
+        val2 = list(val2) if isinstance(val2, (list, tuple)) else [val2]
+        sample_idx = np.where(values.isin(val1 + val2).values)[0]
+        grp2 = ','.join([str(x) for x in val2])
+    else:
+        sample_idx = np.arange(exp.shape[0])
+        grp2 = 'NOT %s' % grp1
+    labels = values.iloc[sample_idx].isin(val1).values.astype(np.float64)
+
+    def _compute():
+        feature_idx = _present_features(exp, sample_idx)
+        logger.info('diff abundance on %d samples (%d in group 1), %d features' % (len(sample_idx), np.sum(labels), len(feature_idx)))
+        result = diff_abundance_test(_feature_blocks(exp, feature_idx, sample_idx), len(feature_idx), labels, transform=transform,
+                                     numperm=numperm, random_seed=random_seed)
+        return feature_idx, result
+
+    key = (fingerprint(exp), 'diff_abundance', field, _values_hash(values), tuple(val1), tuple(val2) if val2 is not None else None,
+           transform, numperm, random_seed)
+    feature_idx, result = _cached_test(key, random_seed, _compute)
+    call = format_call('diff_abundance', field=field, val1=val1, val2=val2, alpha=alpha, transform=transform, random_seed=random_seed)
+    return _significant(exp, feature_idx, result, alpha, (grp1, grp2), call)
+
+
+def correlation(exp, field, method='spearman', nonzero=False, alpha=0.1, transform=None, numperm=1000, random_seed=None):
+    '''Correlation permutation test of the features with a numeric sample field, as calour correlation
+
+    Samples with a non numeric field value are ignored
+
+    Parameters
+    ----------
+    exp : calour.Experiment or outofcore.OutOfCoreExperiment
+    field : str
+    method : str, optional
+        'spearman' or 'pearson'
+    nonzero : bool, optional
+        True to correlate each feature only on the samples where it is non-zero
+    alpha : float, optional
+        the FDR level
+    transform : str or None, optional
+        see TRANSFORMS
+    numperm : int, optional
+    random_seed : int or None, optional
+        None to not set the random seed (the result is not cached)
+
+    Returns
+    -------
+    calour.Experiment or None
+        the significant features (None if none found)
+    '''
+    values = exp.sample_metadata[field]
+    labels = pd.to_numeric(values, errors='coerce').values.astype(np.float64)
+    sample_idx = np.where(~np.isnan(labels))[0]
+    if len(sample_idx) < len(labels):
+        logger.warning('NaN values encountered in labels for correlation. Ignoring these samples')
+
+    def _compute():
+        feature_idx = _present_features(exp, np.arange(exp.shape[0]))
+        result = correlation_test(_feature_blocks(exp, feature_idx, sample_idx), len(feature_idx), labels[sample_idx], method=method,
+                                  nonzero=nonzero, transform=transform, numperm=numperm, random_seed=random_seed)
+        return feature_idx, result
+
+    key = (fingerprint(exp), 'correlation', field, _values_hash(values), method, nonzero, transform, numperm, random_seed)
+    feature_idx, result = _cached_test(key, random_seed, _compute)
+    call = format_call('correlation', field=field, method=method, nonzero=nonzero, alpha=alpha, random_seed=random_seed)
+    return _significant(exp, feature_idx, result, alpha, (field, 'Anti-%s' % field), call)
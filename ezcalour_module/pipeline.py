@@ -0,0 +1,135 @@
+'''Fused filtering pipeline
+
+Runs a chain of calour filter/normalize steps as one operation: the per-sample and
+per-feature statistics are computed on the original data matrix using sample/feature
+masks and per-sample scaling factors (for normalization steps), and the data is
+copied only once at the end.
+
+Each step is a (name, params) tuple. The supported steps (and their parameters) are:
+    'filter_orig_reads' : min_reads
+    'filter_abundance' : cutoff
+    'filter_prevalence' : fraction, cutoff (default 1/10000)
+    'filter_mean_abundance' : cutoff
+    'normalize' : total
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from logging import getLogger
+
+import numpy as np
+import scipy.sparse
+
+from ezcalour_module.experiment import subset_experiment, subset_data, format_call
+
+logger = getLogger(__name__)
+
+PIPELINE_STEPS = ['filter_orig_reads', 'filter_abundance', 'filter_prevalence', 'filter_mean_abundance', 'normalize']
+
+
+def _feature_sums(data, weights):
+    '''Get the weighted per-feature sum (weights are per sample, 0 for removed samples)'''
+    if scipy.sparse.issparse(data):
+        return np.asarray(data.T.dot(weights)).ravel()
+    return weights.dot(data)
+
+
+def _sample_sums(data, fmask):
+    '''Get the per-sample sum over the selected features'''
+    if scipy.sparse.issparse(data):
+        return np.asarray(data.dot(fmask.astype(float))).ravel()
+    return data.dot(fmask.astype(float))
+
+
+def _feature_prevalence(data, smask, scale, cutoff):
+    '''Get the number of selected samples where each (scaled) feature value is >= cutoff'''
+    if scipy.sparse.issparse(data):
+        data = scipy.sparse.csr_matrix(data)
+        row_ids = np.repeat(np.arange(data.shape[0]), np.diff(data.indptr))
+        present = smask[row_ids] & (data.data * scale[row_ids] >= cutoff)
+        counts = np.bincount(data.indices[present], minlength=data.shape[1])
+        # zeros are not stored in the sparse matrix, so count them if the cutoff allows
+        if cutoff <= 0:
+            counts = np.full(data.shape[1], np.sum(smask))
+        return counts
+    return np.sum((data[smask] * scale[smask][:, None]) >= cutoff, axis=0)
+
+
+def run_pipeline(exp, steps):
+    '''Run a chain of filter/normalize steps on the experiment with a single copy of the data
+
+    The result is equivalent to calling each step on the result of the previous step.
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+        the experiment to process
+    steps : list of (str, dict)
+        the steps to run, in order (see module documentation)
+
+    Returns
+    -------
+    calour.Experiment
+        the processed experiment. The call history contains an entry for each step
+    '''
+    data = exp.data
+    num_samples, num_features = data.shape
+    smask = np.ones(num_samples, dtype=bool)
+    fmask = np.ones(num_features, dtype=bool)
+    # per-sample multiplicative factor from the normalization steps
+    scale = np.ones(num_samples)
+    normalized = None
+    calls = []
+    for cname, cparams in steps:
+        logger.debug('pipeline step %s %s' % (cname, cparams))
+        if cname == 'filter_orig_reads':
+            orig = exp.sample_metadata['_calour_original_abundance'].values
+            smask &= orig >= cparams['min_reads']
+        elif cname == 'filter_abundance':
+            fmask &= _feature_sums(data, scale * smask) >= cparams['cutoff']
+        elif cname == 'filter_prevalence':
+            cutoff = cparams.get('cutoff', 1 / 10000)
+            nsamples = max(np.sum(smask), 1)
+            fmask &= _feature_prevalence(data, smask, scale, cutoff) / nsamples >= cparams['fraction']
+        elif cname == 'filter_mean_abundance':
+            nsamples = max(np.sum(smask), 1)
+            means = _feature_sums(data, scale * smask) / nsamples
+            # the mean is relative to the mean total reads per sample (as in calour)
+            total = np.sum(means[fmask])
+            if total > 0:
+                means = means / total
+            fmask &= means >= cparams['cutoff']
+        elif cname == 'normalize':
+            sums = _sample_sums(data, fmask) * scale
+            factor = np.zeros(num_samples)
+            nonzero = sums > 0
+            factor[nonzero] = cparams['total'] / sums[nonzero]
+            scale = scale * factor
+            normalized = cparams['total']
+        else:
+            raise ValueError('Unknown pipeline step %s. Available steps are %s' % (cname, PIPELINE_STEPS))
+        calls.append(format_call(cname, **cparams))
+
+    sample_pos = np.where(smask)[0]
+    feature_pos = np.where(fmask)[0]
+    logger.info('pipeline keeps %d of %d samples and %d of %d features' % (len(sample_pos), num_samples, len(feature_pos), num_features))
+    newdata = subset_data(data, sample_pos, feature_pos)
+    if normalized is not None:
+        # apply the scaling in place on the (already copied) data
+        sscale = scale[sample_pos]
+        if scipy.sparse.issparse(newdata):
+            newdata = newdata.astype(float, copy=False)
+            newdata.data *= np.repeat(sscale, np.diff(newdata.indptr))
+        else:
+            newdata = newdata.astype(float, copy=False)
+            newdata *= sscale[:, None]
+    newexp = subset_experiment(exp, sample_pos, feature_pos, data=newdata, call=calls)
+    if normalized is not None:
+        newexp.normalized = normalized
+    return newexp
@@ -0,0 +1,190 @@
+'''Fast preview of slow actions on a stratified subsample
+
+The action (i.e. core.analysis_diff_abundance) is first run on a small pilot subsample,
+and the pilot run time is used to choose the largest subsample expected to finish within
+the time budget (the run time is assumed to be proportional to samples x features). The
+samples are subsampled stratified by the tested metadata field (so the group proportions
+are kept), and the features stratified by their total abundance (so rare and abundant
+features are both represented). A field with too many values for the subsample size (i.e.
+per-sample ids or dates) is not used for stratification, and the subsample never has more
+positions than asked for.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import time
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+from ezcalour_module.experiment import subset_experiment, format_call
+
+logger = getLogger(__name__)
+
+# default time budget (seconds) for the preview
+TIME_BUDGET = 5
+# the pilot subsample size
+PILOT_SAMPLES = 100
+PILOT_FEATURES = 500
+# number of strata for numeric fields and for the feature abundances
+NUM_STRATA = 10
+# subsample without stratification if the number of strata is more than this fraction of the subsample size
+MAX_STRATA_FRACTION = 0.25
+
+
+def _strata(values, num_strata=NUM_STRATA):
+    '''Get the stratum code of each value (the value itself for categorical values, a quantile bin for numeric values)'''
+    values = pd.Series(values)
+    if values.dtype.kind in 'biuf' and values.nunique() > num_strata:
+        return pd.qcut(values.rank(method='first'), num_strata, labels=False).values
+    return pd.factorize(values.astype(str))[0]
+
+
+def stratified_positions(strata, size, random_seed=None, min_per_stratum=2):
+    '''Get a stratified random subset of positions
+
+    Each stratum keeps (about) its proportion, but at least min_per_stratum positions (if it has them).
+    If there are more than MAX_STRATA_FRACTION * size strata, the positions are selected without stratification
+
+    Parameters
+    ----------
+    strata : numpy.ndarray of int
+        the stratum of each position
+    size : int
+        the total number of positions to select (the result has at most size positions)
+    random_seed : int or None, optional
+    min_per_stratum : int, optional
+
+    Returns
+    -------
+    numpy.ndarray of int
+        the sorted selected positions
+    '''
+    strata = np.asarray(strata)
+    if size >= len(strata):
+        return np.arange(len(strata))
+    rand = np.random.RandomState(random_seed)
+    codes, uniques = pd.factorize(strata)
+    if len(uniques) > MAX_STRATA_FRACTION * size:
+        logger.debug('%d strata for %d positions - selecting without stratification' % (len(uniques), size))
+        return np.sort(rand.choice(len(strata), size, replace=False))
+    sizes = np.bincount(codes, minlength=len(uniques))
+    counts = np.minimum(sizes, np.maximum(min_per_stratum, np.round(size / len(strata) * sizes).astype(int)))
+    # the rounding and the minimum per stratum can add positions - remove them from the largest strata
+    excess = counts.sum() - size
+    while excess > 0:
+        reducible = np.where(counts > min_per_stratum)[0]
+        if len(reducible) == 0:
+            break
+        take = reducible[np.argsort(-counts[reducible], kind='mergesort')][:excess]
+        counts[take] -= 1
+        excess -= len(take)
+    selected = [rand.choice(np.where(codes == cstratum)[0], ccount, replace=False) for cstratum, ccount in enumerate(counts)]
+    return np.sort(np.concatenate(selected))
+
+
+def subsample(exp, num_samples, num_features, field=None, random_seed=None):
+    '''Get a stratified random subsample of the experiment
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    num_samples : int
+        number of samples to keep
+    num_features : int
+        number of features to keep
+    field : str or None, optional
+        the sample metadata field to stratify the samples by. None for no stratification
+    random_seed : int or None, optional
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    if field is not None:
+        sample_strata = _strata(exp.sample_metadata[field].values)
+    else:
+        sample_strata = np.zeros(exp.shape[0], dtype=int)
+    sample_pos = stratified_positions(sample_strata, num_samples, random_seed=random_seed)
+    feature_sums = np.asarray(exp.data.sum(axis=0)).ravel()
+    feature_pos = stratified_positions(_strata(feature_sums), num_features, random_seed=random_seed, min_per_stratum=0)
+    return subset_experiment(exp, sample_pos=sample_pos, feature_pos=feature_pos,
+                             call=format_call('preview_subsample', num_samples=len(sample_pos), num_features=len(feature_pos), field=field))
+
+
+class PreviewResult:
+    '''The result of a preview run'''
+    def __init__(self, result, num_samples, num_features, total_samples, total_features, elapsed):
+        # the action result (on the subsample)
+        self.result = result
+        self.num_samples = num_samples
+        self.num_features = num_features
+        self.total_samples = total_samples
+        self.total_features = total_features
+        self.elapsed = elapsed
+
+    @property
+    def complete(self):
+        '''True if the preview used all the data (so it is the full result)'''
+        return self.num_samples == self.total_samples and self.num_features == self.total_features
+
+    def __str__(self):
+        return 'Preview on %d of %d samples, %d of %d features (%.1f seconds)' % (self.num_samples, self.total_samples, self.num_features,
+                                                                                 self.total_features, self.elapsed)
+
+
+def run_preview(func, exp, kwargs=None, field=None, subsample_samples=True, subsample_features=True, time_budget=TIME_BUDGET, random_seed=None):
+    '''Run an action on a stratified subsample of the experiment, sized to finish within the time budget
+
+    Parameters
+    ----------
+    func : function
+        the action. Called as func(subexp, **kwargs)
+    exp : calour.Experiment
+    kwargs : dict or None, optional
+        the action parameters
+    field : str or None, optional
+        the sample metadata field to stratify the samples by (i.e. the tested field)
+    subsample_samples, subsample_features : bool, optional
+        False to keep all the samples / features
+    time_budget : float, optional
+        the target run time (seconds)
+    random_seed : int or None, optional
+
+    Returns
+    -------
+    PreviewResult
+    '''
+    if kwargs is None:
+        kwargs = {}
+    total_samples, total_features = exp.shape
+    start = time.time()
+    max_samples = total_samples if not subsample_samples else min(total_samples, PILOT_SAMPLES)
+    max_features = total_features if not subsample_features else min(total_features, PILOT_FEATURES)
+    subexp = subsample(exp, max_samples, max_features, field=field, random_seed=random_seed)
+    res = func(subexp, **kwargs)
+    pilot_time = time.time() - start
+    num_samples, num_features = subexp.shape
+
+    # scale each subsampled axis by the same factor so samples x features grows with the remaining time
+    remaining = time_budget - pilot_time
+    if remaining > pilot_time and (num_samples < total_samples or num_features < total_features):
+        scale = remaining / max(pilot_time, 1e-3)
+        factor = np.sqrt(scale) if (subsample_samples and subsample_features) else scale
+        new_samples = total_samples if not subsample_samples else min(total_samples, int(num_samples * factor))
+        new_features = total_features if not subsample_features else min(total_features, int(num_features * factor))
+        if new_samples > num_samples or new_features > num_features:
+            logger.debug('preview pilot took %f sec. running on %d samples, %d features' % (pilot_time, new_samples, new_features))
+            subexp = subsample(exp, new_samples, new_features, field=field, random_seed=random_seed)
+            res = func(subexp, **kwargs)
+            num_samples, num_features = subexp.shape
+    preview = PreviewResult(res, num_samples, num_features, total_samples, total_features, time.time() - start)
+    logger.info(str(preview))
+    return preview
@@ -0,0 +1,351 @@
+'''Boolean metadata queries using per-field indexes
+
+A query is a boolean expression on the sample metadata fields, for example:
+    body_site in (gut, oral) and age > 30 and not antibiotics
+
+Supported terms:
+    field in (v1, v2, ...)    field not in (v1, v2, ...)
+    field == v    field != v    field > v    field >= v    field < v    field <= v
+    field    (true if the value is true/yes/1 for a text field or non-zero for a numeric field)
+combined with and, or, not and parentheses. Values (and fields) containing spaces or
+special characters can be quoted with ' or ".
+
+Each field is indexed once per experiment (a bitmap per value for categorical fields,
+a sorted order for numeric fields), so evaluating a query is vectorized set algebra
+on boolean masks. A field index is rebuilt if its column was replaced in place (i.e. a
+field converted to categorical), based on the column dtype, length and data buffer.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import re
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+from ezcalour_module.experiment import subset_experiment, format_call
+
+logger = getLogger(__name__)
+
+TRUE_VALUES = {'true', 't', 'yes', 'y', '1'}
+
+# fields with more unique values than this are not indexed by per-value bitmaps
+MAX_BITMAP_VALUES = 256
+
+_TOKEN_RE = re.compile(r'\s*(?:(?P<op>==|!=|>=|<=|>|<|\(|\)|,)|"(?P<dq>[^"]*)"|\'(?P<sq>[^\']*)\'|(?P<word>[^\s(),=!<>"\']+))')
+
+
+def _tokenize(query):
+    '''Split the query into tokens. Each token is (kind, text) where kind is 'op', 'word' or 'quoted'.'''
+    tokens = []
+    pos = 0
+    query = query.rstrip()
+    while pos < len(query):
+        match = _TOKEN_RE.match(query, pos)
+        if match is None or match.end() == pos:
+            raise ValueError('Cannot parse query at position %d: %s' % (pos, query[pos:]))
+        if match.group('op') is not None:
+            tokens.append(('op', match.group('op')))
+        elif match.group('dq') is not None:
+            tokens.append(('quoted', match.group('dq')))
+        elif match.group('sq') is not None:
+            tokens.append(('quoted', match.group('sq')))
+        else:
+            tokens.append(('word', match.group('word')))
+        pos = match.end()
+    return tokens
+
+
+class FieldIndex:
+    '''Index of the values of one metadata field'''
+    def __init__(self, values):
+        '''
+        Parameters
+        ----------
+        values : pandas.Series
+            the field values
+        '''
+        self.size = len(values)
+        self.numeric = values.dtype.kind in 'biuf'
+        if self.numeric:
+            self.values = values.values.astype(float)
+            self.order = np.argsort(self.values, kind='mergesort')
+            self.sorted = self.values[self.order]
+        else:
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                codes = values.cat.codes.values
+                categories = values.cat.categories
+            else:
+                codes, categories = pd.factorize(values)
+            self.codes = codes
+            # the position of each value (as str) in the categories
+            self.categories = {}
+            for idx, ccat in enumerate(categories):
+                self.categories.setdefault(str(ccat), []).append(idx)
+            self._bitmaps = {}
+            self.use_bitmaps = len(categories) <= MAX_BITMAP_VALUES
+
+    def _bitmap(self, code):
+        bitmap = self._bitmaps.get(code)
+        if bitmap is None:
+            bitmap = self.codes == code
+            self._bitmaps[code] = bitmap
+        return bitmap
+
+    def isin(self, vals):
+        '''Get the mask of samples with a value in vals (list of str)'''
+        if self.numeric:
+            return np.isin(self.values, [_to_float(x) for x in vals])
+        codes = [ccode for cval in vals for ccode in self.categories.get(cval, [])]
+        if self.use_bitmaps:
+            mask = np.zeros(self.size, dtype=bool)
+            for ccode in codes:
+                mask |= self._bitmap(ccode)
+            return mask
+        return np.isin(self.codes, codes)
+
+    def compare(self, op, val):
+        '''Get the mask of samples where (field op val) is true'''
+        if op == '==':
+            return self.isin([val])
+        if op == '!=':
+            return ~self.isin([val])
+        if not self.numeric:
+            raise ValueError('Operator %s can only be used on numeric fields' % op)
+        val = _to_float(val)
+        # use the sorted order to get the range of matching positions
+        if op == '>':
+            start, end = np.searchsorted(self.sorted, val, side='right'), self.size
+        elif op == '>=':
+            start, end = np.searchsorted(self.sorted, val, side='left'), self.size
+        elif op == '<':
+            start, end = 0, np.searchsorted(self.sorted, val, side='left')
+        elif op == '<=':
+            start, end = 0, np.searchsorted(self.sorted, val, side='right')
+        else:
+            raise ValueError('Unknown operator %s' % op)
+        mask = np.zeros(self.size, dtype=bool)
+        mask[self.order[start:end]] = True
+        # nan values are sorted last and never match
+        mask &= ~np.isnan(self.values)
+        return mask
+
+    def truth(self):
+        '''Get the mask of samples where the field value is true'''
+        if self.numeric:
+            return np.nan_to_num(self.values) != 0
+        return self.isin([cval for cval in self.categories if cval.lower() in TRUE_VALUES])
+
+
+def _to_float(val):
+    try:
+        return float(val)
+    except ValueError:
+        raise ValueError('Value %s is not a number' % val)
+
+
+def _column_version(values):
+    '''Get a cheap version of a metadata column, which changes when the column is replaced
+
+    Changing single values without replacing the column buffer is not detected
+    '''
+    if isinstance(values.dtype, np.dtype):
+        # a new series view is created for each access, but it uses the same buffer
+        arr = values.to_numpy(copy=False)
+        return (values.dtype, len(values), arr.__array_interface__['data'][0], arr.strides)
+    # extension arrays (categorical, string) are the same object while the column is not replaced
+    return (values.dtype, len(values), id(values.array))
+
+
+class MetadataIndex:
+    '''Lazily built indexes for all the fields of a metadata table'''
+    def __init__(self, md):
+        self.md = md
+        # field name -> (column version, FieldIndex)
+        self._fields = {}
+
+    def field(self, name):
+        if name not in self.md.columns:
+            raise ValueError('Field %s not found in sample metadata' % name)
+        values = self.md[name]
+        version = _column_version(values)
+        cached = self._fields.get(name)
+        if cached is None or cached[0] != version:
+            cached = (version, FieldIndex(values))
+            self._fields[name] = cached
+        return cached[1]
+
+    def query(self, query):
+        '''Evaluate the query
+
+        Parameters
+        ----------
+        query : str
+
+        Returns
+        -------
+        numpy.ndarray of bool
+            True for the samples matching the query
+        '''
+        parser = _Parser(_tokenize(query), self)
+        mask = parser.parse()
+        return mask
+
+
+class _Parser:
+    '''Recursive descent parser evaluating the query on the metadata index
+
+    query := or_expr
+    or_expr := and_expr ('or' and_expr)*
+    and_expr := not_expr ('and' not_expr)*
+    not_expr := 'not' not_expr | term
+    term := '(' or_expr ')' | field [op value | ['not'] 'in' '(' value (',' value)* ')']
+    '''
+    def __init__(self, tokens, index):
+        self.tokens = tokens
+        self.pos = 0
+        self.index = index
+
+    def _peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise ValueError('Unexpected end of query')
+        self.pos += 1
+        return token
+
+    def _is_keyword(self, token, keyword):
+        return token[0] == 'word' and token[1].lower() == keyword
+
+    def _expect(self, text):
+        token = self._next()
+        if token != ('op', text):
+            raise ValueError('Expected %s but got %s' % (text, token[1]))
+
+    def parse(self):
+        if len(self.tokens) == 0:
+            return np.ones(len(self.index.md), dtype=bool)
+        mask = self._or()
+        if self.pos != len(self.tokens):
+            raise ValueError('Unexpected %s in query' % self._peek()[1])
+        return mask
+
+    def _or(self):
+        mask = self._and()
+        while self._is_keyword(self._peek(), 'or'):
+            self._next()
+            mask = mask | self._and()
+        return mask
+
+    def _and(self):
+        mask = self._not()
+        while self._is_keyword(self._peek(), 'and'):
+            self._next()
+            mask = mask & self._not()
+        return mask
+
+    def _not(self):
+        if self._is_keyword(self._peek(), 'not'):
+            self._next()
+            return ~self._not()
+        return self._term()
+
+    def _value(self):
+        token = self._next()
+        if token[0] == 'op':
+            raise ValueError('Expected a value but got %s' % token[1])
+        return token[1]
+
+    def _term(self):
+        token = self._peek()
+        if token == ('op', '('):
+            self._next()
+            mask = self._or()
+            self._expect(')')
+            return mask
+        field = self.index.field(self._value())
+        token = self._peek()
+        if token[0] == 'op' and token[1] in ('==', '!=', '>', '>=', '<', '<='):
+            self._next()
+            return field.compare(token[1], self._value())
+        negate = False
+        if self._is_keyword(token, 'not') and self._is_keyword(self._peek(1), 'in'):
+            self._next()
+            negate = True
+            token = self._peek()
+        if self._is_keyword(token, 'in'):
+            self._next()
+            self._expect('(')
+            vals = [self._value()]
+            while self._peek() == ('op', ','):
+                self._next()
+                vals.append(self._value())
+            self._expect(')')
+            mask = field.isin(vals)
+            return ~mask if negate else mask
+        return field.truth()
+
+
+def get_index(exp):
+    '''Get the sample metadata index of the experiment (built once and cached on the experiment)
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+
+    Returns
+    -------
+    MetadataIndex
+    '''
+    index = getattr(exp, '_ezcalour_md_index', None)
+    # derived experiments share the attribute but have a new sample metadata, so check it is the same table
+    if index is None or index.md is not exp.sample_metadata:
+        index = MetadataIndex(exp.sample_metadata)
+        exp._ezcalour_md_index = index
+    return index
+
+
+def query_mask(exp, query):
+    '''Get the samples matching the query
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    query : str
+        the query (see module documentation)
+
+    Returns
+    -------
+    numpy.ndarray of bool
+        True for the samples matching the query
+    '''
+    return get_index(exp).query(query)
+
+
+def filter_query(exp, query):
+    '''Keep only the samples matching the query
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    query : str
+        the query (see module documentation)
+
+    Returns
+    -------
+    calour.Experiment
+        with only the matching samples
+    '''
+    mask = query_mask(exp, query)
+    return subset_experiment(exp, sample_pos=np.where(mask)[0], call=format_call('filter_query', query=query))
@@ -0,0 +1,164 @@
+'''Shared (interned) storage of the feature id strings
+
+Amplicon feature ids are the full ASV sequences (150-400 bp), stored in the feature metadata
+index and in the '_feature_id' (and '_orig_feature_id' after primer trimming) fields. pandas
+subsets share the string objects, but experiments read from different tables, returned from
+worker processes or loaded from files each hold their own copy of the same sequences.
+
+intern_experiment() replaces the id strings of an experiment with the equal string objects
+already used by other experiments (from a process wide pool), so each sequence is stored once
+regardless of the number of experiments using it. The ids stay python strings, so calour
+and dbBact see no difference. memory_usage() measures (an upper bound of) the memory saved.
+
+The pool is rebuilt from the experiments passed to rebuild_pool() (i.e. the ones in the GUI
+experiment list), so the strings of removed experiments can be freed. As this scans all the
+ids, it is done only when the pool holds more than POOL_MAX_RATIO times the number of ids
+of these experiments.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import sys
+import operator
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+logger = getLogger(__name__)
+
+# the feature metadata fields holding feature ids (in addition to the index)
+ID_FIELDS = ['_feature_id', '_orig_feature_id']
+
+# rebuild the pool when it holds more than this times the number of ids of the live experiments
+POOL_MAX_RATIO = 2
+
+# the canonical string object of each id
+_pool = {}
+
+
+def _id_columns(exp):
+    '''Get the feature id value lists of the experiment (the index first)'''
+    fmd = exp.feature_metadata
+    columns = [fmd.index] + [fmd[x] for x in ID_FIELDS if x in fmd.columns]
+    return [np.asarray(x, dtype=object).tolist() for x in columns]
+
+
+def _intern_values(values, replaced):
+    '''Get the canonical objects of the values (None if all the values are already canonical)
+
+    The replaced objects are added to the replaced dict (by id)
+    '''
+    new = list(map(_pool.setdefault, values, values))
+    if not any(map(operator.is_not, new, values)):
+        return None
+    replaced.update([(id(cold), cold) for cnew, cold in zip(new, values) if cnew is not cold])
+    return new
+
+
+def intern_experiment(exp):
+    '''Replace the feature id strings of the experiment with the shared string objects (in place)
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+
+    Returns
+    -------
+    int
+        the number of bytes of id strings replaced by the shared objects (freed if not used elsewhere)
+    '''
+    if getattr(exp, 'out_of_core', False):
+        return 0
+    fmd = exp.feature_metadata
+    columns = _id_columns(exp)
+    replaced = {}
+    new_index = _intern_values(columns[0], replaced)
+    if new_index is not None:
+        fmd.index = pd.Index(new_index, name=fmd.index.name, dtype=fmd.index.dtype)
+    for cfield, cvalues in zip([x for x in ID_FIELDS if x in fmd.columns], columns[1:]):
+        new = _intern_values(cvalues, replaced)
+        if new is not None:
+            fmd[cfield] = pd.Series(new, index=fmd.index, dtype=fmd[cfield].dtype).values
+    saved = sum([sys.getsizeof(x) for x in replaced.values()])
+    if saved > 0:
+        logger.debug('feature ids of %s now use the shared strings (%d bytes replaced)' % (getattr(exp, '_studyname', ''), saved))
+    return saved
+
+
+def _num_ids(exp):
+    '''Get the number of id values of the experiment (without reading them)'''
+    fmd = exp.feature_metadata
+    return len(fmd) * (1 + len([x for x in ID_FIELDS if x in fmd.columns]))
+
+
+def rebuild_pool(exps, force=False):
+    '''Keep in the pool only the id strings of the experiments (so the strings of other experiments can be freed)
+
+    Parameters
+    ----------
+    exps : list of calour.Experiment
+    force : bool, optional
+        False to rebuild only if the pool holds more than POOL_MAX_RATIO times the number of ids of the experiments.
+        True to always rebuild
+
+    Returns
+    -------
+    bool
+        True if the pool was rebuilt
+    '''
+    global _pool
+    exps = [x for x in exps if not getattr(x, 'out_of_core', False)]
+    if not force and len(_pool) <= POOL_MAX_RATIO * sum([_num_ids(x) for x in exps]):
+        return False
+    pool = {}
+    for cexp in exps:
+        for cvalues in _id_columns(cexp):
+            pool.update(zip(cvalues, cvalues))
+    logger.debug('id pool rebuilt (%d ids, was %d)' % (len(pool), len(_pool)))
+    _pool = pool
+    return True
+
+
+def _distinct(columns):
+    '''Get the distinct objects in the columns (by id)'''
+    objs = {}
+    for cvalues in columns:
+        objs.update(zip(map(id, cvalues), cvalues))
+    return objs
+
+
+def memory_usage(exps):
+    '''Measure the memory used by the feature id strings of the experiments, with and without sharing
+
+    Parameters
+    ----------
+    exps : list of calour.Experiment
+
+    Returns
+    -------
+    dict
+        'ids': number of id values (index and id fields of all the experiments),
+        'copies': bytes if each value was a separate string (as when each experiment / field is read separately),
+        'used': bytes of the distinct string objects actually used,
+        'saved': copies - used. This is an upper bound of the memory saved by interning,
+        as experiments derived by pandas subsets already share the strings of their parent
+    '''
+    num_ids = 0
+    copies = 0
+    columns = []
+    for cexp in exps:
+        if getattr(cexp, 'out_of_core', False):
+            continue
+        for cvalues in _id_columns(cexp):
+            num_ids += len(cvalues)
+            copies += sum(map(sys.getsizeof, cvalues))
+            columns.append(cvalues)
+    used = sum([sys.getsizeof(x) for x in _distinct(columns).values()])
+    return {'ids': num_ids, 'copies': copies, 'used': used, 'saved': copies - used}
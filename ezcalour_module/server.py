@@ -0,0 +1,586 @@
+'''Local JSON-RPC analysis server
+
+Exposes the EZCalour actions (load, filter, normalize, diff. abundance, save...) over a
+local HTTP JSON-RPC 2.0 API, so they can be triggered from a LIMS or a notebook:
+
+    curl -H 'Content-Type: application/json' -H 'Authorization: Bearer <token>' \
+         -d '{"jsonrpc": "2.0", "id": 1, "method": "load", "params": {"table": "x.biom"}}' http://127.0.0.1:8765
+
+Each HTTP request must carry the server token (a random per-session token printed when the
+server starts, unless a token is given) in the Authorization header, and the application/json
+Content-Type. Requests with a non-local Origin header (i.e. sent by a web page open in the
+browser) are rejected. The server binds to a non-loopback address only if a token is given.
+
+Experiments are kept in memory and referenced by the id returned from the method creating them.
+Requests are executed on a bounded thread pool. Requests waiting for a free worker are queued
+(up to max_queue, after which the server answers busy), and a request not done within the timeout
+returns a timeout error. Per method metrics (calls, errors, timeouts, queue wait and run time)
+are available using the 'metrics' method. The cheap introspection methods (INLINE_METHODS) run
+in the request thread, so they answer also when all the workers are busy.
+
+Use TestClient to call the server in-process without a network.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import hmac
+import json
+import time
+import uuid
+import inspect
+import secrets
+import ipaddress
+import threading
+from logging import getLogger
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from ezcalour_module import core
+from ezcalour_module import loaders
+from ezcalour_module import export
+
+logger = getLogger(__name__)
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+SERVER_BUSY = -32000
+REQUEST_TIMEOUT = -32001
+
+DEFAULT_PORT = 8765
+
+
+class RPCError(Exception):
+    '''An error returned to the JSON-RPC client'''
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class ExperimentStore:
+    '''Thread safe storage of the server experiments by id'''
+    def __init__(self):
+        self._exps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, exp, name=None):
+        '''Add an experiment and get its id'''
+        exp_id = uuid.uuid4().hex[:12]
+        if name is not None:
+            exp._studyname = name
+        elif not hasattr(exp, '_studyname'):
+            exp._studyname = exp_id
+        with self._lock:
+            self._exps[exp_id] = exp
+        return exp_id
+
+    def get(self, exp_id):
+        with self._lock:
+            exp = self._exps.get(exp_id)
+        if exp is None:
+            raise RPCError(INVALID_PARAMS, 'Experiment %s not found' % exp_id)
+        return exp
+
+    def remove(self, exp_id):
+        with self._lock:
+            if self._exps.pop(exp_id, None) is None:
+                raise RPCError(INVALID_PARAMS, 'Experiment %s not found' % exp_id)
+
+    def items(self):
+        with self._lock:
+            return list(self._exps.items())
+
+
+def exp_summary(exp_id, exp):
+    '''Get the JSON description of an experiment'''
+    return {'id': exp_id, 'name': getattr(exp, '_studyname', exp_id), 'type': type(exp).__name__,
+            'samples': exp.shape[0], 'features': exp.shape[1],
+            'sample_fields': [str(x) for x in exp.sample_metadata.columns],
+            'data_file': str(exp.info.get('data_file', '')), 'normalized': getattr(exp, 'normalized', 0)}
+
+
+# the registered server methods: name -> function(server, **params)
+METHODS = {}
+# the methods executed in the request thread (not using a worker slot)
+INLINE_METHODS = {'list', 'metrics', 'methods'}
+
+
+def rpc_method(func):
+    '''Register a server method. The method name is the function name without the leading rpc_'''
+    METHODS[func.__name__[len('rpc_'):]] = func
+    return func
+
+
+def _stored(server, newexp):
+    '''Store a new experiment and get its summary (None if there is no experiment, i.e. no significant features)'''
+    if newexp is None:
+        return None
+    new_id = server.store.add(newexp)
+    return exp_summary(new_id, newexp)
+
+
+@rpc_method
+def rpc_load(server, table, map_file=None, name=None, table_type=None, normalize=10000, min_reads=None):
+    '''Load a table (.biom / .qza / native .ezc) with an optional mapping file'''
+    if map_file is None:
+        map_file = loaders.find_mapping_file(table)
+    exp = loaders.read_table(table, map_file, table_type=table_type, normalize=normalize, min_reads=min_reads)
+    exp_id = server.store.add(exp, name=name if name is not None else table)
+    return exp_summary(exp_id, exp)
+
+
+@rpc_method
+def rpc_list(server):
+    '''List the loaded experiments'''
+    return [exp_summary(exp_id, exp) for exp_id, exp in server.store.items()]
+
+
+@rpc_method
+def rpc_info(server, exp):
+    '''Get the experiment summary'''
+    return exp_summary(exp, server.store.get(exp))
+
+
+@rpc_method
+def rpc_remove(server, exp):
+    '''Remove the experiment from the server'''
+    server.store.remove(exp)
+    return True
+
+
+@rpc_method
+def rpc_filter_samples(server, exp, field, values, negate=False, name=None):
+    '''Keep samples with a value of field in values'''
+    return _stored(server, core.sample_filter(server.store.get(exp), field, values, negate=negate, name=name))
+
+
+@rpc_method
+def rpc_filter_query(server, exp, query, name=None):
+    '''Keep samples matching the metadata query (see query.py)'''
+    return _stored(server, core.sample_filter_query(server.store.get(exp), query, name=name))
+
+
+@rpc_method
+def rpc_filter_orig_reads(server, exp, min_reads, name=None):
+    '''Keep samples with at least min_reads original reads'''
+    return _stored(server, core.sample_filter_by_original_reads(server.store.get(exp), min_reads, name=name))
+
+
+@rpc_method
+def rpc_filter_abundance(server, exp, cutoff, name=None):
+    '''Keep features with at least cutoff total reads'''
+    return _stored(server, core.feature_filter_min_reads(server.store.get(exp), cutoff, name=name))
+
+
+@rpc_method
+def rpc_filter_prevalence(server, exp, fraction, name=None):
+    '''Keep features present in at least fraction of the samples'''
+    return _stored(server, core.feature_filter_prevalence(server.store.get(exp), fraction, name=name))
+
+
+@rpc_method
+def rpc_filter_mean_abundance(server, exp, cutoff, name=None):
+    '''Keep features with mean frequency of at least cutoff'''
+    return _stored(server, core.feature_filter_mean(server.store.get(exp), cutoff, name=name))
+
+
+@rpc_method
+def rpc_filter_taxonomy(server, exp, values, negate=False, exact=False, rank=None, name=None):
+    '''Keep features matching the taxonomy values'''
+    return _stored(server, core.feature_filter_taxonomy(server.store.get(exp), values, negate=negate, exact=exact, rank=rank, name=name))
+
+
+@rpc_method
+def rpc_normalize(server, exp, total=10000, name=None):
+    '''Normalize each sample to total reads'''
+    return _stored(server, core.sample_normalize(server.store.get(exp), total, name=name))
+
+
+@rpc_method
+def rpc_pipeline(server, exp, steps, name=None):
+    '''Run a list of [step name, {params}] filter / normalize steps in one pass'''
+    steps = [(cstep[0], cstep[1]) for cstep in steps]
+    return _stored(server, core.feature_filter_pipeline(server.store.get(exp), steps, name=name))
+
+
+@rpc_method
+def rpc_sort_samples(server, exp, field, name=None):
+    '''Sort the samples by the metadata field'''
+    return _stored(server, core.sample_sort(server.store.get(exp), field, name=name))
+
+
+@rpc_method
+def rpc_cluster_features(server, exp, min_reads=10, method='auto', name=None):
+    '''Cluster the features (method is one of core.FEATURE_CLUSTER_METHODS)'''
+    return _stored(server, core.feature_cluster(server.store.get(exp), min_reads, method=method, name=name))
+
+
+@rpc_method
+def rpc_diff_abundance(server, exp, field, val1, val2=None, alpha=0.1, method='rankmean', random_seed=2020, name=None):
+    '''Differential abundance test ('rankmean', 'mean' or 'binary'). Returns None if no significant features'''
+    return _stored(server, core.analysis_diff_abundance(server.store.get(exp), field, val1, val2, alpha=alpha, method=method,
+                                                        random_seed=random_seed, name=name))
+
+
+@rpc_method
+def rpc_correlation(server, exp, field, method='spearman', nonzero=False, alpha=0.1, random_seed=2020, name=None):
+    '''Features correlated with a numeric metadata field. Returns None if no significant features'''
+    return _stored(server, core.analysis_correlation(server.store.get(exp), field, method=method, nonzero=nonzero, alpha=alpha,
+                                                     random_seed=random_seed, name=name))
+
+
+@rpc_method
+def rpc_clear_test_cache(server):
+    '''Remove the cached permutation test results. Returns the number of bytes freed'''
+    return core.clear_test_cache()
+
+
+@rpc_method
+def rpc_beta_diversity(server, exp, method='braycurtis', num_axes=3, random_seed=2020, name=None):
+    '''PCoA of the sample distances. The coordinates are added as sample metadata fields'''
+    return _stored(server, core.analysis_beta_diversity(server.store.get(exp), method=method, num_axes=num_axes,
+                                                        random_seed=random_seed, name=name))
+
+
+@rpc_method
+def rpc_save(server, exp, prefix, fmt='hdf5', compression='gzip', level=4, fasta=True):
+    '''Save the experiment (see export.export_experiment) and get the written file names'''
+    return export.export_experiment(server.store.get(exp), prefix, fmt=fmt, compression=compression, level=level, fasta=fasta)
+
+
+@rpc_method
+def rpc_metrics(server):
+    '''Get the server request metrics'''
+    return server.get_metrics()
+
+
+@rpc_method
+def rpc_methods(server):
+    '''List the available methods with their parameters'''
+    res = {}
+    for cname, cfunc in METHODS.items():
+        params = list(inspect.signature(cfunc).parameters.keys())[1:]
+        res[cname] = {'params': params, 'doc': cfunc.__doc__}
+    return res
+
+
+def _json_default(obj):
+    '''Convert numpy types in the results to JSON'''
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    return str(obj)
+
+
+class AnalysisServer:
+    '''The JSON-RPC request handling, experiment store, worker pool and metrics'''
+    def __init__(self, max_workers=4, max_queue=16, timeout=600, token=None):
+        '''
+        Parameters
+        ----------
+        max_workers : int, optional
+            number of requests executed concurrently
+        max_queue : int, optional
+            number of requests waiting for a worker before the server answers busy
+        timeout : float or None, optional
+            seconds to wait for a request result before answering with a timeout error.
+            The request itself keeps running in its worker (python threads cannot be killed).
+        token : str or None, optional
+            the token the HTTP requests must carry (Authorization: Bearer <token>).
+            None to generate a random token for this session (see serve)
+        '''
+        self.store = ExperimentStore()
+        self.token_configured = token is not None
+        self.token = token if token is not None else secrets.token_urlsafe(32)
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ezcalour-rpc')
+        # bounds the number of running + queued requests
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._metrics_lock = threading.Lock()
+        self._metrics = {}
+        self._active = 0
+        self._start_time = time.time()
+        self._httpd = None
+
+    def _record(self, method, status, wait=0, run=0):
+        with self._metrics_lock:
+            cm = self._metrics.setdefault(method, {'calls': 0, 'errors': 0, 'timeouts': 0, 'busy': 0,
+                                                   'total_wait': 0.0, 'total_run': 0.0, 'max_run': 0.0})
+            cm['calls'] += 1
+            if status != 'ok':
+                cm[status] += 1
+            cm['total_wait'] += wait
+            cm['total_run'] += run
+            cm['max_run'] = max(cm['max_run'], run)
+
+    def get_metrics(self):
+        '''Get the per method metrics (call counts and queue wait / run times in seconds)'''
+        with self._metrics_lock:
+            methods = {}
+            for cname, cm in self._metrics.items():
+                methods[cname] = dict(cm)
+                methods[cname]['mean_run'] = cm['total_run'] / cm['calls']
+                methods[cname]['mean_wait'] = cm['total_wait'] / cm['calls']
+            return {'uptime': time.time() - self._start_time, 'active': self._active, 'max_workers': self.max_workers,
+                    'max_queue': self.max_queue, 'experiments': len(self.store.items()), 'methods': methods}
+
+    def call(self, method, params=None):
+        '''Run a server method on the worker pool and get the result
+
+        Parameters
+        ----------
+        method : str
+            the method name (from METHODS)
+        params : dict or None, optional
+            the method parameters
+
+        Returns
+        -------
+        the method result (JSON serializable)
+
+        Raises
+        ------
+        RPCError
+            if the method fails, times out or the server is busy
+        '''
+        func = METHODS.get(method)
+        if func is None:
+            raise RPCError(METHOD_NOT_FOUND, 'Method %s not found' % method)
+        if params is None:
+            params = {}
+        if not isinstance(params, dict):
+            raise RPCError(INVALID_PARAMS, 'Only named parameters are supported')
+        try:
+            inspect.signature(func).bind(self, **params)
+        except TypeError as e:
+            raise RPCError(INVALID_PARAMS, 'Invalid parameters for %s: %s' % (method, e))
+        if method in INLINE_METHODS:
+            start = time.time()
+            res = func(self, **params)
+            self._record(method, 'ok', run=time.time() - start)
+            return res
+        if not self._slots.acquire(blocking=False):
+            self._record(method, 'busy')
+            raise RPCError(SERVER_BUSY, 'Server busy (%d requests running or queued)' % (self.max_workers + self.max_queue))
+        submitted = time.time()
+        started = []
+
+        def _run():
+            started.append(time.time())
+            with self._metrics_lock:
+                self._active += 1
+            try:
+                return func(self, **params)
+            finally:
+                with self._metrics_lock:
+                    self._active -= 1
+                self._slots.release()
+
+        future = self._executor.submit(_run)
+        try:
+            res = future.result(timeout=self.timeout)
+        except TimeoutError:
+            self._record(method, 'timeouts', wait=started[0] - submitted if started else time.time() - submitted)
+            raise RPCError(REQUEST_TIMEOUT, 'Method %s did not finish in %s seconds' % (method, self.timeout))
+        except RPCError:
+            self._record(method, 'errors', wait=started[0] - submitted, run=time.time() - started[0])
+            raise
+        except Exception as e:
+            logger.warning('method %s failed: %s' % (method, e))
+            self._record(method, 'errors', wait=started[0] - submitted, run=time.time() - started[0])
+            raise RPCError(INTERNAL_ERROR, '%s: %s' % (type(e).__name__, e))
+        self._record(method, 'ok', wait=started[0] - submitted, run=time.time() - started[0])
+        return res
+
+    def handle(self, request):
+        '''Handle a JSON-RPC 2.0 request (dict) or batch (list of dict)
+
+        Returns
+        -------
+        dict or list of dict or None
+            the response (None for notifications)
+        '''
+        if isinstance(request, list):
+            if len(request) == 0:
+                return self._error(None, INVALID_REQUEST, 'Empty batch')
+            responses = [self.handle(x) for x in request]
+            return [x for x in responses if x is not None]
+        if not isinstance(request, dict) or request.get('jsonrpc') != '2.0' or not isinstance(request.get('method'), str):
+            return self._error(None, INVALID_REQUEST, 'Invalid JSON-RPC 2.0 request')
+        req_id = request.get('id')
+        try:
+            res = self.call(request['method'], request.get('params'))
+        except RPCError as e:
+            if 'id' not in request:
+                return None
+            return self._error(req_id, e.code, e.message)
+        if 'id' not in request:
+            return None
+        return {'jsonrpc': '2.0', 'id': req_id, 'result': res}
+
+    def handle_json(self, text):
+        '''Handle a JSON-RPC request string and get the response string (or None for notifications)'''
+        try:
+            request = json.loads(text)
+        except ValueError as e:
+            response = self._error(None, PARSE_ERROR, 'Parse error: %s' % e)
+        else:
+            response = self.handle(request)
+        if response is None or response == []:
+            return None
+        return json.dumps(response, default=_json_default)
+
+    def _error(self, req_id, code, message):
+        return {'jsonrpc': '2.0', 'id': req_id, 'error': {'code': code, 'message': message}}
+
+    def check_headers(self, headers):
+        '''Check the HTTP request headers (token, content type and origin)
+
+        Parameters
+        ----------
+        headers : email.message.Message
+            the HTTP request headers
+
+        Returns
+        -------
+        (int, str) or None
+            the HTTP error status and message, or None if the request is allowed
+        '''
+        auth = headers.get('Authorization', '')
+        if not auth.startswith('Bearer ') or not hmac.compare_digest(auth[len('Bearer '):].strip().encode('utf8'), self.token.encode('utf8')):
+            return 401, 'Missing or invalid server token'
+        if headers.get_content_type() != 'application/json':
+            return 415, 'Content-Type must be application/json'
+        origin = headers.get('Origin')
+        if origin is not None and not _is_local_origin(origin):
+            return 403, 'Cross origin requests are not allowed'
+        return None
+
+    def serve(self, host='127.0.0.1', port=DEFAULT_PORT):
+        '''Serve HTTP JSON-RPC requests (POST to /) until shutdown() is called
+
+        Raises
+        ------
+        ValueError
+            if the host is not a loopback address and no token was given
+        '''
+        if not is_loopback(host) and not self.token_configured:
+            raise ValueError('Listening on the non-loopback address %s requires a server token' % host)
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                error = server.check_headers(self.headers)
+                if error is not None:
+                    logger.warning('rejected request from %s: %s' % (self.address_string(), error[1]))
+                    self.send_error(error[0], error[1])
+                    return
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    text = self.rfile.read(length).decode('utf8')
+                except UnicodeDecodeError as e:
+                    response = json.dumps(server._error(None, PARSE_ERROR, 'Parse error: %s' % e))
+                else:
+                    response = server.handle_json(text)
+                if response is None:
+                    self.send_response(204)
+                    self.end_headers()
+                    return
+                body = response.encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug('%s - %s' % (self.address_string(), format % args))
+
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        logger.info('EZCalour server listening on http://%s:%d' % (host, port))
+        if not self.token_configured:
+            logger.info('server token (send as "Authorization: Bearer <token>"): %s' % self.token)
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+    def shutdown(self):
+        '''Stop the HTTP server and the worker pool'''
+        if self._httpd is not None:
+            self._httpd.shutdown()
+        self._executor.shutdown(wait=False)
+
+
+def is_loopback(host):
+    '''Check if the host name / address is a loopback address'''
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _is_local_origin(origin):
+    '''Check if the Origin header value is a page served from this computer'''
+    try:
+        host = urlsplit(origin).hostname
+    except ValueError:
+        return False
+    return host is not None and is_loopback(host)
+
+
+class TestClient:
+    '''In-process client for the server (no network). Requests and responses go through JSON encoding.'''
+    def __init__(self, server=None):
+        '''
+        Parameters
+        ----------
+        server : AnalysisServer or None, optional
+            the server to call. None to create a new server
+        '''
+        if server is None:
+            server = AnalysisServer()
+        self.server = server
+        self._next_id = 0
+
+    def call(self, method, **params):
+        '''Call a server method and get the result
+
+        Raises
+        ------
+        RPCError
+            if the server returns an error
+        '''
+        self._next_id += 1
+        response = json.loads(self.server.handle_json(json.dumps({'jsonrpc': '2.0', 'id': self._next_id, 'method': method, 'params': params}, default=_json_default)))
+        if 'error' in response:
+            raise RPCError(response['error']['code'], response['error']['message'])
+        return response['result']
+
+    def __getattr__(self, method):
+        if method not in METHODS:
+            raise AttributeError(method)
+        return lambda **params: self.call(method, **params)
@@ -0,0 +1,424 @@
+'''Zero-copy transfer of experiments to and from worker processes using shared memory
+
+Sending an experiment to a process pool worker pickles the whole data matrix, which for
+large tables takes longer than the computation. Instead, share() copies the data buffers
+(the dense array, or the CSR / CSC data, indices and indptr) once into
+multiprocessing.shared_memory segments and returns a small picklable SharedExperiment
+handle (the segment names and the experiment metadata). The worker attach()es to the
+segments without copying (as read-only arrays, so a job cannot change the data of other
+jobs), and its result experiment is sent back the same way (share_result() in the worker,
+adopt() in the parent, which then owns the result segments).
+
+The segments of an experiment are reused for all the jobs on the same data matrix, and are
+released (unlinked) when release() is called for the experiment (i.e. when it is removed
+from the GUI experiment list), when the experiment is garbage collected, or at exit.
+Segments used by a running job are pinned, and released only when the job is done (unpin()).
+
+Experiments smaller than SHARE_MIN_BYTES, out-of-core experiments and other objects are
+passed unchanged (pickled as before). If shared memory is not available (i.e. it failed to
+start in a frozen application) the experiments are also pickled. Results are sent through
+shared memory only on POSIX systems (on windows a segment is freed when the worker closes it).
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import uuid
+import weakref
+from logging import getLogger
+from collections import defaultdict
+
+import numpy as np
+import scipy.sparse
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+    resource_tracker = None
+
+logger = getLogger(__name__)
+
+# smaller experiments are pickled (not worth the segments)
+SHARE_MIN_BYTES = 2 ** 20
+# send the worker results through shared memory (a segment must outlive the worker process that created it)
+SHARE_RESULTS = os.name == 'posix'
+_SPARSE_FORMATS = {'csr': scipy.sparse.csr_matrix, 'csc': scipy.sparse.csc_matrix}
+
+# the segments owned by this process, by name (created by share() or adopted results)
+_segments = {}
+# number of running jobs using each segment
+_pins = defaultdict(int)
+# segments released while pinned (unlinked when unpinned)
+_released = set()
+# unlinked segments still mapped by live arrays (closed by _collect)
+_closing = []
+# worker side: the segments attached / created for the current job (closed when the next job starts)
+_attached = {}
+_created = []
+
+
+class SharedExperiment:
+    '''Picklable handle of an experiment with the data in shared memory segments'''
+    def __init__(self, cls, state, fmt, shape, buffers):
+        '''
+        Parameters
+        ----------
+        cls : class
+            the experiment class
+        state : dict
+            the experiment attributes (without the data)
+        fmt : str
+            'dense', 'csr' or 'csc'
+        shape : tuple of int
+            the data shape
+        buffers : list of (str, str, tuple)
+            the (segment name, dtype, shape) of each buffer (the dense array, or the sparse data, indices and indptr)
+        '''
+        self.cls = cls
+        self.state = state
+        self.fmt = fmt
+        self.shape = shape
+        self.buffers = buffers
+
+    @property
+    def names(self):
+        return [x[0] for x in self.buffers]
+
+    @property
+    def nbytes(self):
+        return sum([int(np.prod(cshape)) * np.dtype(cdtype).itemsize for _, cdtype, cshape in self.buffers])
+
+    def __repr__(self):
+        return 'SharedExperiment(%s, %s, %d bytes in %d segments)' % (self.cls.__name__, self.shape, self.nbytes, len(self.buffers))
+
+
+def available():
+    '''Check if shared memory segments can be used'''
+    return shared_memory is not None
+
+
+def prepare():
+    '''Start the shared memory resource tracker before creating a process pool
+
+    Forked workers started before the tracker would start their own tracker, which unlinks the
+    segments they attached to when they exit
+    '''
+    if resource_tracker is None or os.name != 'posix':
+        return
+    try:
+        resource_tracker.ensure_running()
+    except Exception as e:
+        logger.debug('cannot start the resource tracker: %s' % e)
+
+
+def _state(exp):
+    '''Get the experiment attributes to pickle (without the data and the data caches)'''
+    return {k: v for k, v in exp.__dict__.items() if k != 'data' and not k.startswith('_ezcalour_')}
+
+
+def _data_buffers(data):
+    '''Get the (format, buffers) of the data, or (None, None) if it cannot be shared'''
+    if scipy.sparse.issparse(data):
+        if data.format not in _SPARSE_FORMATS:
+            return None, None
+        return data.format, [data.data, data.indices, data.indptr]
+    if isinstance(data, np.ndarray) and data.dtype != object:
+        return 'dense', [data]
+    return None, None
+
+
+def _create(arrays):
+    '''Copy the arrays into new shared memory segments
+
+    Returns
+    -------
+    list of (SharedMemory, (str, str, tuple))
+        the segment and the buffer description of each array
+    '''
+    segments = []
+    try:
+        for carr in arrays:
+            shm = shared_memory.SharedMemory(name='ezc_%s' % uuid.uuid4().hex[:20], create=True, size=max(carr.nbytes, 1))
+            segments.append(shm)
+            np.ndarray(carr.shape, dtype=carr.dtype, buffer=shm.buf)[...] = carr
+    except Exception:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+        raise
+    return [(shm, (shm.name, carr.dtype.str, carr.shape)) for shm, carr in zip(segments, arrays)]
+
+
+def _open(name):
+    '''Attach to an existing segment'''
+    try:
+        # python >= 3.13: attaching does not register the segment with the resource tracker
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def _arrays(handle, segments, writeable):
+    '''Get the arrays of the handle buffers on the attached segments'''
+    arrays = []
+    for shm, (_, cdtype, cshape) in zip(segments, handle.buffers):
+        carr = np.ndarray(cshape, dtype=np.dtype(cdtype), buffer=shm.buf)
+        carr.flags.writeable = writeable
+        arrays.append(carr)
+    return arrays
+
+
+def _build(handle, arrays):
+    '''Create the experiment from the handle and the data arrays'''
+    if handle.fmt == 'dense':
+        data = arrays[0]
+    else:
+        data = _SPARSE_FORMATS[handle.fmt](tuple(arrays), shape=handle.shape, copy=False)
+    exp = handle.cls.__new__(handle.cls)
+    exp.__dict__.update(handle.state)
+    exp.data = data
+    return exp
+
+
+def _own(exp, segments, buffers):
+    '''Keep the segments of the experiment data in this process, until it is released or garbage collected'''
+    for shm in segments:
+        _segments[shm.name] = shm
+    names = [x[0] for x in buffers]
+    # the owner reference is not copied by copy.deepcopy, so copies of the experiment do not own the segments
+    exp._ezcalour_shared = (weakref.ref(exp), exp.data, buffers, weakref.finalize(exp, _free, names))
+
+
+def _owned(exp):
+    '''Get the (owner, data, buffers, finalizer) of the experiment segments, or None
+
+    Derived experiments (shallow attribute copies or deep copies) inherit the attribute of
+    their parent, so it is used only if the experiment and its data matrix are the owners
+    '''
+    cached = exp.__dict__.get('_ezcalour_shared')
+    if cached is None or cached[0]() is not exp or cached[1] is not exp.data:
+        return None
+    return cached
+
+
+def share(exp, min_bytes=SHARE_MIN_BYTES):
+    '''Get a shared memory handle of the experiment for sending it to a worker process
+
+    The data is copied to the segments only once (the segments are reused while the data matrix is not replaced).
+    The segments are pinned until unpin(handle) is called.
+
+    Parameters
+    ----------
+    exp : calour.Experiment or object
+    min_bytes : int, optional
+        experiments with less data bytes are not shared
+
+    Returns
+    -------
+    SharedExperiment or object
+        exp itself if it is not an experiment that can be shared
+    '''
+    if not available() or getattr(exp, 'out_of_core', False) or not hasattr(exp, 'sample_metadata'):
+        return exp
+    fmt, arrays = _data_buffers(getattr(exp, 'data', None))
+    if fmt is None or sum([x.nbytes for x in arrays]) < min_bytes:
+        return exp
+    cached = _owned(exp)
+    if cached is not None and all([x[0] in _segments for x in cached[2]]):
+        buffers = cached[2]
+    else:
+        try:
+            created = _create(arrays)
+        except Exception as e:
+            logger.warning('cannot create shared memory segments (%s) - the experiment will be pickled' % e)
+            return exp
+        buffers = [x[1] for x in created]
+        _own(exp, [x[0] for x in created], buffers)
+        logger.debug('shared %d bytes of %s in %d segments' % (sum([x.nbytes for x in arrays]), getattr(exp, '_studyname', ''), len(buffers)))
+    handle = SharedExperiment(type(exp), _state(exp), fmt, exp.data.shape, buffers)
+    pin(handle)
+    return handle
+
+
+def pin(handle):
+    '''Keep the handle segments until unpin is called (i.e. while a job uses them)'''
+    for cname in handle.names:
+        _pins[cname] += 1
+
+
+def unpin(handle):
+    '''Release the pin of the handle segments (freeing the segments released while pinned)'''
+    if not isinstance(handle, SharedExperiment):
+        return
+    for cname in handle.names:
+        _pins[cname] -= 1
+        if _pins[cname] <= 0:
+            del _pins[cname]
+            if cname in _released:
+                _free([cname])
+
+
+def release(exp):
+    '''Unlink the shared memory segments of the experiment (the experiment stays valid in this process)
+
+    Segments pinned by running jobs are unlinked when the jobs are done. Nothing is unlinked
+    if the experiment does not own the segments (i.e. it inherited the attribute of its parent)
+    '''
+    cached = _owned(exp)
+    exp.__dict__.pop('_ezcalour_shared', None)
+    if cached is None:
+        return
+    cached[3].detach()
+    _free([x[0] for x in cached[2]])
+
+
+def _free(names):
+    for cname in names:
+        if _pins.get(cname, 0) > 0:
+            _released.add(cname)
+            continue
+        _released.discard(cname)
+        shm = _segments.pop(cname, None)
+        if shm is None:
+            continue
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+        _closing.append(shm)
+    _collect()
+
+
+def _collect():
+    '''Close the unlinked segments that are not used by any array anymore'''
+    for shm in list(_closing):
+        try:
+            shm.close()
+        except BufferError:
+            continue
+        _closing.remove(shm)
+
+
+def shared_nbytes():
+    '''Get the total size of the shared memory segments owned by this process'''
+    return sum([x.size for x in _segments.values()])
+
+
+def _close_worker_segments():
+    '''Close the segments attached / created by the previous job in this worker (if not used anymore)'''
+    for cname, shm in list(_attached.items()):
+        try:
+            shm.close()
+        except BufferError:
+            continue
+        del _attached[cname]
+    for shm in list(_created):
+        try:
+            shm.close()
+        except BufferError:
+            continue
+        _created.remove(shm)
+
+
+def attach(value):
+    '''Get the experiment of a SharedExperiment handle (in the worker), without copying the data
+
+    The data arrays are read-only. Other values are returned unchanged
+    '''
+    if not isinstance(value, SharedExperiment):
+        return value
+    segments = []
+    for cname in value.names:
+        if cname not in _attached:
+            _attached[cname] = _open(cname)
+        segments.append(_attached[cname])
+    return _build(value, _arrays(value, segments, writeable=False))
+
+
+def share_result(value):
+    '''Put the experiment data (or each experiment data in a list / tuple) in new segments, for returning from the worker
+
+    The segments are owned by the parent process when it adopts the result (see adopt)
+    '''
+    if not SHARE_RESULTS or not available():
+        return value
+    if isinstance(value, (list, tuple)):
+        return type(value)([share_result(x) for x in value])
+    if getattr(value, 'out_of_core', False) or not hasattr(value, 'sample_metadata'):
+        return value
+    fmt, arrays = _data_buffers(getattr(value, 'data', None))
+    if fmt is None or sum([x.nbytes for x in arrays]) < SHARE_MIN_BYTES:
+        return value
+    try:
+        created = _create(arrays)
+    except Exception as e:
+        logger.debug('cannot create shared memory segments for the result (%s)' % e)
+        return value
+    _created.extend([x[0] for x in created])
+    return SharedExperiment(type(value), _state(value), fmt, value.data.shape, [x[1] for x in created])
+
+
+def adopt(value):
+    '''Get the experiment of a SharedExperiment result (in the parent), taking ownership of its segments
+
+    Other values (and lists / tuples of them) are returned unchanged
+    '''
+    if isinstance(value, (list, tuple)):
+        return type(value)([adopt(x) for x in value])
+    if not isinstance(value, SharedExperiment):
+        return value
+    segments = [_open(x) for x in value.names]
+    exp = _build(value, _arrays(value, segments, writeable=False))
+    _own(exp, segments, value.buffers)
+    return exp
+
+
+def run_shared(func, args, kwargs):
+    '''Run func in a worker process on the attached experiments, and share its result
+
+    This is the process pool worker, so it must stay a module level function. Use submit() to call it
+    '''
+    _close_worker_segments()
+    args = [attach(x) for x in args]
+    kwargs = {k: attach(v) for k, v in kwargs.items()}
+    return share_result(func(*args, **kwargs))
+
+
+def submit(executor, func, *args, **kwargs):
+    '''Submit func to a process pool with the experiment arguments (and result) passed through shared memory
+
+    Returns
+    -------
+    SharedFuture
+        its result() is the adopted func result (the argument segments are unpinned when it is called)
+    '''
+    handles = [share(x) for x in args] + [share(x) for x in kwargs.values()]
+    future = executor.submit(run_shared, func, handles[:len(args)], dict(zip(kwargs.keys(), handles[len(args):])))
+    return SharedFuture(future, handles)
+
+
+class SharedFuture:
+    '''The future of a submit() job. result() adopts the job result and unpins the arguments (in the calling thread)'''
+    def __init__(self, future, handles):
+        self.future = future
+        self._handles = handles
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        try:
+            res = self.future.result(timeout=timeout)
+        finally:
+            if self.future.done():
+                for chandle in self._handles:
+                    unpin(chandle)
+                self._handles = []
+        return adopt(res)
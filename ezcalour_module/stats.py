@@ -0,0 +1,220 @@
+'''Per-experiment feature and sample summary statistics
+
+The feature sums, means, prevalence and the sample sums are computed once, in a single
+pass over the (sparse or dense) data, and cached on the experiment. The filter actions use
+them to build the feature / sample masks (instead of calour recomputing the statistic for
+each filter), and the filter dialogs use them to show how many features / samples are kept
+(and a histogram of the statistic) while the threshold is changed.
+
+The statistics are:
+    feature stats : 'sum', 'mean', 'relative_mean' (mean relative to the mean total per sample, as
+        calour filter_mean_abundance), 'prevalence' (fraction of samples with value >= PREVALENCE_CUTOFF)
+    sample stats : 'sample_sum', 'original_reads' (the reads before any processing)
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from logging import getLogger
+
+import numpy as np
+import scipy.sparse
+
+from ezcalour_module.experiment import subset_experiment
+
+logger = getLogger(__name__)
+
+# the minimal value for a feature to be present in a sample (as in calour filter_prevalence)
+PREVALENCE_CUTOFF = 1 / 10000
+FEATURE_STATS = ['sum', 'mean', 'relative_mean', 'prevalence']
+SAMPLE_STATS = ['sample_sum', 'original_reads']
+# the stats shown on a log scale in the histograms
+LOG_STATS = ['sum', 'mean', 'relative_mean', 'sample_sum', 'original_reads']
+HISTOGRAM_BINS = 40
+_HISTOGRAM_BARS = ' ▁▂▃▄▅▆▇█'
+
+
+class ExperimentStats:
+    '''The summary statistics of an experiment (see module documentation)'''
+    def __init__(self, exp):
+        # keep the tables the stats were computed from, to check the cache is still valid
+        self.data = _data_token(exp)
+        self.sample_metadata = exp.sample_metadata
+        self.num_samples, self.num_features = exp.shape
+        self._values = {}
+        if getattr(exp, 'out_of_core', False):
+            # one pass over the chunks of the table on disk (see outofcore.py)
+            self._values['sum'], self._values['sample_sum'], present = exp.sums(PREVALENCE_CUTOFF)
+        elif scipy.sparse.issparse(exp.data):
+            data = scipy.sparse.csr_matrix(exp.data)
+            row_ids = np.repeat(np.arange(self.num_samples), np.diff(data.indptr))
+            self._values['sum'] = np.bincount(data.indices, weights=data.data, minlength=self.num_features)
+            self._values['sample_sum'] = np.bincount(row_ids, weights=data.data, minlength=self.num_samples)
+            present = np.bincount(data.indices[data.data >= PREVALENCE_CUTOFF], minlength=self.num_features)
+        else:
+            data = exp.data
+            self._values['sum'] = data.sum(axis=0, dtype=np.float64)
+            self._values['sample_sum'] = data.sum(axis=1, dtype=np.float64)
+            present = np.sum(data >= PREVALENCE_CUTOFF, axis=0)
+        num_samples = max(self.num_samples, 1)
+        self._values['prevalence'] = present / num_samples
+        self._values['mean'] = self._values['sum'] / num_samples
+        total = self._values['sum'].sum()
+        self._values['relative_mean'] = self._values['sum'] / total if total > 0 else np.zeros(self.num_features)
+        if '_calour_original_abundance' in exp.sample_metadata.columns:
+            self._values['original_reads'] = exp.sample_metadata['_calour_original_abundance'].values.astype(np.float64)
+        else:
+            logger.debug('no original reads field in sample metadata. using the sample sums')
+            self._values['original_reads'] = self._values['sample_sum']
+        self._sorted = {}
+
+    def is_valid(self, exp):
+        '''True if the stats were computed from the experiment data and sample metadata'''
+        return self.data is _data_token(exp) and self.sample_metadata is exp.sample_metadata
+
+    def values(self, stat):
+        '''Get the per feature / sample values of the statistic'''
+        if stat not in self._values:
+            raise ValueError('Unknown statistic %s. Available statistics are %s' % (stat, FEATURE_STATS + SAMPLE_STATS))
+        return self._values[stat]
+
+    def mask(self, stat, cutoff):
+        '''Get the features / samples with stat >= cutoff'''
+        return self.values(stat) >= cutoff
+
+    def count(self, stat, cutoff):
+        '''Get the number of features / samples with stat >= cutoff (O(log n) using the sorted values)'''
+        if stat not in self._sorted:
+            self._sorted[stat] = np.sort(self.values(stat))
+        csorted = self._sorted[stat]
+        return len(csorted) - np.searchsorted(csorted, cutoff, side='left')
+
+    def histogram(self, stat, cutoff=None, bins=HISTOGRAM_BINS):
+        '''Get a one line (unicode bars) histogram of the statistic as html. Bins below the cutoff are gray
+
+        Stats in LOG_STATS are binned by log10 (the zeros are in the first bin)
+        '''
+        values = self.values(stat)
+        if len(values) == 0:
+            return ''
+        log = stat in LOG_STATS
+        if log:
+            positive = values[values > 0]
+            low = np.log10(positive.min()) if len(positive) > 0 else 0
+            values = np.log10(np.maximum(values, 10 ** low))
+        edges = np.linspace(values.min(), values.max(), bins + 1)
+        if edges[-1] == edges[0]:
+            edges = np.linspace(edges[0] - 0.5, edges[0] + 0.5, bins + 1)
+        counts, edges = np.histogram(values, bins=edges)
+        # log count heights so small bins are visible
+        heights = np.ceil((len(_HISTOGRAM_BARS) - 1) * np.log1p(counts) / np.log1p(max(counts.max(), 1))).astype(int)
+        if cutoff is not None and log:
+            cutoff = np.log10(cutoff) if cutoff > 0 else -np.inf
+        html = []
+        for cheight, cright in zip(heights, edges[1:]):
+            color = 'lightgray' if cutoff is not None and cright <= cutoff else 'black'
+            html.append('<span style="color:%s">%s</span>' % (color, _HISTOGRAM_BARS[cheight]))
+        low, high = (10 ** edges[0], 10 ** edges[-1]) if log else (edges[0], edges[-1])
+        return '<tt>%s</tt><br>%g .. %g%s' % (''.join(html), low, high, ' (log scale)' if log else '')
+
+    def preview(self, stat, cutoff):
+        '''Get the html text for the filter dialog: the number of features / samples kept and the histogram'''
+        total = self.num_samples if stat in SAMPLE_STATS else self.num_features
+        what = 'samples' if stat in SAMPLE_STATS else 'features'
+        return '%d of %d %s kept<br>%s' % (self.count(stat, cutoff), total, what, self.histogram(stat, cutoff))
+
+
+def _data_token(exp):
+    '''Get the object identifying the experiment data (the data matrix, or the view token of an out of core experiment)'''
+    if getattr(exp, 'out_of_core', False):
+        return exp.view_token
+    return exp.data
+
+
+def get_stats(exp):
+    '''Get the summary statistics of the experiment (computed once and cached on the experiment)
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+
+    Returns
+    -------
+    ExperimentStats
+    '''
+    cached = getattr(exp, '_ezcalour_stats', None)
+    # derived experiments share the attribute but have a new data matrix, so check it is the same one
+    if cached is None or not cached.is_valid(exp):
+        cached = ExperimentStats(exp)
+        exp._ezcalour_stats = cached
+    return cached
+
+
+def filter_by_stat(exp, stat, cutoff, call):
+    '''Keep the features (for feature stats) or samples (for sample stats) with stat >= cutoff
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    stat : str
+        the statistic (see module documentation)
+    cutoff : float
+    call : str
+        the call history entry for the new experiment
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    pos = np.where(get_stats(exp).mask(stat, cutoff))[0]
+    if stat in SAMPLE_STATS:
+        return subset_experiment(exp, sample_pos=pos, call=call)
+    return subset_experiment(exp, feature_pos=pos, call=call)
+
+
+def feature_means(exp, sample_mask):
+    '''Get the mean of each feature in the selected samples
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    sample_mask : numpy.ndarray of bool
+
+    Returns
+    -------
+    numpy.ndarray
+    '''
+    weights = sample_mask.astype(np.float64) / max(np.sum(sample_mask), 1)
+    if getattr(exp, 'out_of_core', False):
+        return exp.feature_dot(weights)
+    if scipy.sparse.issparse(exp.data):
+        return np.asarray(exp.data.T.dot(weights)).ravel()
+    return weights.dot(exp.data)
+
+
+def sort_by_mean(exp, sample_mask=None, call=None):
+    '''Sort the features by their mean (ascending, as calour sort_abundance), in all samples or the selected samples
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    sample_mask : numpy.ndarray of bool or None, optional
+        the samples to compute the means on. None to use all samples (the cached means)
+    call : str or None, optional
+        the call history entry for the new experiment
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    if sample_mask is None:
+        means = get_stats(exp).values('mean')
+    else:
+        means = feature_means(exp, sample_mask)
+    order = np.argsort(means, kind='mergesort')
+    return subset_experiment(exp, feature_pos=order, call=call)
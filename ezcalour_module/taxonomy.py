@@ -0,0 +1,310 @@
+'''Taxonomy index for fast taxonomy filtering
+
+The feature taxonomy strings (i.e. 'k__Bacteria;p__Firmicutes;c__Clostridia;...') are
+parsed once per experiment into a rank-aware trie. Each trie node (a lineage prefix)
+holds the positions of the features below it, and each (rank, taxon name) pair holds
+the positions of all features with this name at this rank. Queries are then answered
+using set operations on the position arrays, instead of rescanning all the taxonomy strings.
+
+Without a rank, the values are matched against the full taxonomy strings (each unique
+string checked once), with the same result as calour filter_by_taxonomy. The rank-aware
+matching (taxon names without the rank prefix, lineage prefixes) is used only when a rank is given.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import re
+from logging import getLogger
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from ezcalour_module.experiment import subset_experiment, format_call
+
+logger = getLogger(__name__)
+
+RANKS = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+
+_RANK_PREFIX_RE = re.compile(r'^[a-z]__', re.IGNORECASE)
+
+
+def split_lineage(taxonomy):
+    '''Split a taxonomy string into the taxon names (without the rank prefix, i.e. 'g__')
+
+    Parameters
+    ----------
+    taxonomy : str
+
+    Returns
+    -------
+    list of str
+        the name at each rank. Trailing empty names are removed
+    '''
+    names = [_RANK_PREFIX_RE.sub('', x.strip()) for x in str(taxonomy).split(';')]
+    while len(names) > 0 and names[-1] == '':
+        names.pop()
+    return names
+
+
+class TaxonomyIndex:
+    '''A rank-aware trie of the feature lineages'''
+    def __init__(self, taxonomy):
+        '''
+        Parameters
+        ----------
+        taxonomy : pandas.Series or list of str
+            the taxonomy string of each feature
+        '''
+        taxonomy = pd.Series(taxonomy).fillna('').astype(str)
+        self.size = len(taxonomy)
+        # parse each unique taxonomy string once
+        self.codes, uniques = pd.factorize(taxonomy)
+        self.lineages = [split_lineage(x) for x in uniques]
+        self._uniques_lower = [x.lower() for x in uniques]
+        # feature positions for each unique taxonomy string
+        order = np.argsort(self.codes, kind='mergesort')
+        bounds = np.searchsorted(self.codes[order], np.arange(len(uniques) + 1))
+        unique_positions = [order[bounds[i]:bounds[i + 1]] for i in range(len(uniques))]
+
+        # the trie nodes - lineage prefix (tuple) -> list of unique taxonomy indices below it
+        nodes = defaultdict(list)
+        # (rank, lower case name) -> list of unique taxonomy indices
+        names = defaultdict(list)
+        # lower case taxonomy string -> list of unique taxonomy indices
+        lowers = defaultdict(list)
+        for uidx, clower in enumerate(self._uniques_lower):
+            lowers[clower].append(uidx)
+        for uidx, clineage in enumerate(self.lineages):
+            for rank in range(len(clineage)):
+                nodes[tuple(clineage[:rank + 1])].append(uidx)
+                if clineage[rank] != '':
+                    names[(rank, clineage[rank].lower())].append(uidx)
+
+        def _positions(uidxs):
+            if len(uidxs) == 1:
+                return unique_positions[uidxs[0]]
+            return np.sort(np.concatenate([unique_positions[x] for x in uidxs]))
+
+        self._nodes = {k: _positions(v) for k, v in nodes.items()}
+        self._names = {k: _positions(v) for k, v in names.items()}
+        self._lowers = {k: _positions(v) for k, v in lowers.items()}
+        # the display name of each taxon (for autocomplete)
+        self._display = {}
+        for clineage in self.lineages:
+            for rank, cname in enumerate(clineage):
+                if cname != '':
+                    self._display.setdefault((rank, cname.lower()), cname)
+        logger.debug('taxonomy index for %d features (%d unique lineages, %d taxa)' % (self.size, len(uniques), len(self._names)))
+
+    def _mask(self, positions):
+        mask = np.zeros(self.size, dtype=bool)
+        mask[positions] = True
+        return mask
+
+    def exact(self, name, rank=None):
+        '''Get the features with the taxon name (case insensitive) at the rank
+
+        Parameters
+        ----------
+        name : str
+            the taxon name (rank prefix i.e. 'g__' is ignored)
+        rank : str or int or None, optional
+            the rank name (from RANKS) or number. None to match at any rank
+
+        Returns
+        -------
+        numpy.ndarray of bool
+        '''
+        name = _RANK_PREFIX_RE.sub('', name.strip()).lower()
+        if rank is None:
+            ranks = range(len(RANKS) + 1)
+        else:
+            ranks = [_rank_num(rank)]
+        mask = np.zeros(self.size, dtype=bool)
+        for crank in ranks:
+            cpos = self._names.get((crank, name))
+            if cpos is not None:
+                mask[cpos] = True
+        return mask
+
+    def prefix(self, lineage):
+        '''Get the features whose lineage starts with the given lineage
+
+        Parameters
+        ----------
+        lineage : str or list of str
+            i.e. 'Bacteria;Firmicutes' (rank prefixes are ignored)
+
+        Returns
+        -------
+        numpy.ndarray of bool
+        '''
+        if isinstance(lineage, str):
+            lineage = split_lineage(lineage)
+        cpos = self._nodes.get(tuple(lineage))
+        if cpos is None:
+            # the trie keys are case sensitive, so fall back to a case insensitive lookup
+            lower = tuple([x.lower() for x in lineage])
+            matches = [v for k, v in self._nodes.items() if len(k) == len(lower) and tuple([x.lower() for x in k]) == lower]
+            if len(matches) == 0:
+                return np.zeros(self.size, dtype=bool)
+            cpos = np.concatenate(matches)
+        return self._mask(cpos)
+
+    def lineage(self, taxonomy):
+        '''Get the features with the taxonomy string (case insensitive, as calour filter_by_taxonomy with substring=False)
+
+        Parameters
+        ----------
+        taxonomy : str
+            the full taxonomy string (including the rank prefixes)
+
+        Returns
+        -------
+        numpy.ndarray of bool
+        '''
+        cpos = self._lowers.get(taxonomy.lower())
+        if cpos is None:
+            return np.zeros(self.size, dtype=bool)
+        return self._mask(cpos)
+
+    def substring(self, text, rank=None):
+        '''Get the features with a taxonomy containing text (case insensitive)
+
+        Parameters
+        ----------
+        text : str
+            the text to look for
+        rank : str or int or None, optional
+            None to look in the full taxonomy string (including the rank prefixes, as calour filter_by_taxonomy).
+            Otherwise the rank name (from RANKS) or number of the taxon names to look in (rank prefix i.e. 'g__' is ignored)
+
+        Returns
+        -------
+        numpy.ndarray of bool
+        '''
+        if rank is None:
+            text = text.lower()
+            # check each unique taxonomy string once
+            matched = [idx for idx, x in enumerate(self._uniques_lower) if text in x]
+            return np.isin(self.codes, matched)
+        text = _RANK_PREFIX_RE.sub('', text.strip()).lower()
+        crank = _rank_num(rank)
+        mask = np.zeros(self.size, dtype=bool)
+        # check each unique taxon name once
+        for (nrank, cname), cpos in self._names.items():
+            if nrank == crank and text in cname:
+                mask[cpos] = True
+        return mask
+
+    def names(self, rank=None):
+        '''Get the sorted list of taxon names (for autocomplete)
+
+        Parameters
+        ----------
+        rank : str or int or None, optional
+            the rank to get the names for. None for all ranks
+
+        Returns
+        -------
+        list of str
+        '''
+        crank = None if rank is None else _rank_num(rank)
+        return sorted(set([v for (nrank, cname), v in self._display.items() if crank is None or nrank == crank]))
+
+    def query(self, values, exact=False, rank=None):
+        '''Get the features matching any of the values
+
+        Without a rank, the values are matched against the full taxonomy strings (as calour
+        filter_by_taxonomy). With a rank, they are matched against the taxon names at this rank.
+
+        Parameters
+        ----------
+        values : str or list of str
+            the taxonomy strings / substrings, or the taxon names / lineage prefixes if rank is given
+        exact : bool, optional
+            False to match substrings. True to match the full taxonomy string (or, if rank is given,
+            the taxon name at the rank, or the lineage prefix if the value contains ';')
+        rank : str or int or None, optional
+            the rank to look at. None for the full taxonomy string
+
+        Returns
+        -------
+        numpy.ndarray of bool
+        '''
+        if isinstance(values, str):
+            values = [values]
+        mask = np.zeros(self.size, dtype=bool)
+        for cval in values:
+            if not exact:
+                mask |= self.substring(cval, rank=rank)
+            elif rank is None:
+                mask |= self.lineage(cval)
+            elif ';' in cval:
+                mask |= self.prefix(cval)
+            else:
+                mask |= self.exact(cval, rank=rank)
+        return mask
+
+
+def _rank_num(rank):
+    if isinstance(rank, str):
+        if rank not in RANKS:
+            raise ValueError('Unknown rank %s. Available ranks are %s' % (rank, RANKS))
+        return RANKS.index(rank)
+    return rank
+
+
+def get_index(exp):
+    '''Get the taxonomy index of the experiment (built once and cached on the experiment)
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+
+    Returns
+    -------
+    TaxonomyIndex
+    '''
+    if 'taxonomy' not in exp.feature_metadata.columns:
+        raise ValueError('Experiment does not contain taxonomy')
+    cached = getattr(exp, '_ezcalour_tax_index', None)
+    # derived experiments share the attribute but have a new feature metadata, so check it is the same table
+    if cached is None or cached[0] is not exp.feature_metadata:
+        cached = (exp.feature_metadata, TaxonomyIndex(exp.feature_metadata['taxonomy']))
+        exp._ezcalour_tax_index = cached
+    return cached[1]
+
+
+def filter_taxonomy(exp, values, negate=False, substring=True, rank=None):
+    '''Keep only the features matching the taxonomy values
+
+    Parameters
+    ----------
+    exp : calour.Experiment
+    values : str or list of str
+        the taxonomy to match
+    negate : bool, optional
+        True to keep the features not matching
+    substring : bool, optional
+        True to match substrings, False to match the full taxonomy string
+        (or, if rank is given, the exact taxon name / lineage prefix if the value contains ';')
+    rank : str or None, optional
+        the rank to match the taxon names at (from RANKS). None to match the full taxonomy string (as calour filter_by_taxonomy)
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    mask = get_index(exp).query(values, exact=not substring, rank=rank)
+    if negate:
+        mask = ~mask
+    return subset_experiment(exp, feature_pos=np.where(mask)[0],
+                             call=format_call('filter_taxonomy', values=values, negate=negate, substring=substring, rank=rank))
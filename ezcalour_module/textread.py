@@ -0,0 +1,346 @@
+'''Streaming reader for text (MZMine2 csv / generic tsv) tables
+
+The calour text readers load the whole table into a pandas DataFrame (using the python
+engine), and then copy it to a float matrix, so the peak memory is several times the table
+size. Here the table is read in chunks of rows (using the pandas c engine, reading only the
+needed columns with a fixed dtype), and each chunk is written directly into a preallocated
+(dense) matrix or converted to a sparse block, so the peak memory is the result matrix plus
+one chunk.
+
+In the tables features are rows and samples are columns. The first column is the feature id.
+For MZMine2 tables, the 'row m/z' and 'row retention time' columns are stored as the MZ and RT
+feature metadata, the other 'row ...' columns are skipped and the remaining columns are samples.
+
+Run as a module (python -m ezcalour_module.textread) to benchmark against the in-memory read.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import csv
+import gzip
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from ezcalour_module import metadata
+from ezcalour_module.experiment import format_call
+
+logger = getLogger(__name__)
+
+# number of table rows (features) parsed in each chunk
+CHUNK_ROWS = 20000
+# the MZMine2 feature columns stored as feature metadata (table column: feature metadata field)
+MZMINE2_FEATURE_COLUMNS = {'row m/z': 'MZ', 'row retention time': 'RT'}
+# prefix of the MZMine2 non-sample columns (the columns not in MZMINE2_FEATURE_COLUMNS are skipped)
+MZMINE2_ROW_PREFIX = 'row '
+
+
+def _open_binary(fname):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    return open(fname, 'rb')
+
+
+def count_lines(fname, block_size=2 ** 24):
+    '''Count the lines in a (possibly gzipped) text file, reading it in blocks
+
+    Parameters
+    ----------
+    fname : str
+    block_size : int, optional
+        the read block size (bytes)
+
+    Returns
+    -------
+    int
+        the number of newline characters (+1 if the last line does not end with a newline)
+    '''
+    num_lines = 0
+    last = b'\n'
+    with _open_binary(fname) as fl:
+        while True:
+            block = fl.read(block_size)
+            if not block:
+                break
+            num_lines += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        num_lines += 1
+    return num_lines
+
+
+def read_header(fname, sep='\t'):
+    '''Get the column names of a text table
+
+    Parameters
+    ----------
+    fname : str
+    sep : str, optional
+        the column separator
+
+    Returns
+    -------
+    list of str
+    '''
+    with _open_binary(fname) as fl:
+        line = fl.readline().decode('utf-8-sig').rstrip('\r\n')
+    return next(csv.reader([line], delimiter=sep))
+
+
+def parse_table(table_file, sep='\t', sample_columns=None, feature_columns=None, sparse=False, dtype=np.float64, chunk_rows=CHUNK_ROWS):
+    '''Read a text table (features are rows, samples are columns) in chunks
+
+    Parameters
+    ----------
+    table_file : str
+        the table file (can be gzipped)
+    sep : str, optional
+        the column separator
+    sample_columns : list of str or None, optional
+        the columns to read as samples. None to use all the (non empty named) columns except the first
+    feature_columns : list of str or None, optional
+        additional columns to read as numeric feature metadata
+    sparse : bool, optional
+        True to return a scipy.sparse.csr_matrix, False for a dense numpy array
+    dtype : numpy.dtype, optional
+        the data type (i.e. np.float32 to halve the memory)
+    chunk_rows : int, optional
+        number of rows to parse in each chunk
+
+    Returns
+    -------
+    sample_ids : list of str
+    feature_ids : list of str
+    data : numpy.ndarray or scipy.sparse.csr_matrix
+        samples in rows, features in columns. Empty (NA) values are 0
+    feature_md : pandas.DataFrame
+        the feature_columns values (index is the feature ids)
+    '''
+    columns = read_header(table_file, sep=sep)
+    id_column = columns[0]
+    if feature_columns is None:
+        feature_columns = []
+    if sample_columns is None:
+        # a separator at the end of each line gives an empty named column
+        sample_columns = [x for x in columns[1:] if x != '' and x not in feature_columns]
+    missing = set(sample_columns + list(feature_columns)).difference(columns)
+    if missing:
+        raise ValueError('Columns %s not found in table %s' % (sorted(missing), table_file))
+    num_samples = len(sample_columns)
+    # the lines include the header, so this is never smaller than the number of rows (unless lines end with \r only)
+    num_rows = max(count_lines(table_file) - 1, 0)
+    logger.debug('reading table %s: %d samples, up to %d features, sparse=%s, dtype=%s' % (table_file, num_samples, num_rows, sparse, np.dtype(dtype).name))
+
+    usecols = [id_column] + list(feature_columns) + sample_columns
+    dtypes = {id_column: str}
+    dtypes.update({x: dtype for x in sample_columns})
+    dtypes.update({x: np.float64 for x in feature_columns})
+    reader = pd.read_csv(table_file, sep=sep, usecols=usecols, dtype=dtypes, chunksize=chunk_rows, engine='c',
+                         na_filter=True, keep_default_na=True, encoding='utf-8-sig')
+    if sparse:
+        blocks = []
+    else:
+        data = np.zeros((num_samples, num_rows), dtype=dtype)
+    feature_ids = []
+    feature_mds = []
+    pos = 0
+    for chunk in reader:
+        cvalues = chunk[sample_columns].to_numpy(dtype=dtype, na_value=0)
+        num_chunk = len(cvalues)
+        if sparse:
+            blocks.append(scipy.sparse.csr_matrix(cvalues))
+        else:
+            if pos + num_chunk > data.shape[1]:
+                # the line count was wrong (i.e. \r line endings), so grow the matrix
+                data = np.hstack([data, np.zeros((num_samples, max(num_chunk, data.shape[1])), dtype=dtype)])
+            data[:, pos:pos + num_chunk] = cvalues.T
+        feature_ids.extend(chunk[id_column].astype(str).tolist())
+        if feature_columns:
+            feature_mds.append(chunk[list(feature_columns)])
+        pos += num_chunk
+    if sparse:
+        if blocks:
+            data = scipy.sparse.vstack(blocks, format='csr').T.tocsr()
+        else:
+            data = scipy.sparse.csr_matrix((num_samples, 0), dtype=dtype)
+    elif pos < data.shape[1]:
+        data = data[:, :pos].copy()
+    if feature_mds:
+        feature_md = pd.concat(feature_mds, axis=0)
+    else:
+        feature_md = pd.DataFrame(index=np.arange(pos))
+    feature_md.index = feature_ids
+    logger.info('read %d samples, %d features from %s' % (num_samples, pos, table_file))
+    return list(sample_columns), feature_ids, data, feature_md
+
+
+def _build_experiment(cls, data, sample_ids, feature_ids, feature_md, table_file, map_file, sparse, normalize, call):
+    '''Create the calour experiment with the same metadata fields the calour readers add'''
+    from calour.util import get_data_md5, get_file_md5
+
+    sample_md = metadata.read_mapping(sample_ids, map_file)
+    sample_md['_sample_id'] = sample_md.index.values
+    sample_md['_calour_original_abundance'] = np.asarray(data.sum(axis=1)).ravel()
+    feature_md['_feature_id'] = feature_md.index.values
+    info = {'data_file': table_file,
+            'data_md5': get_data_md5(data),
+            'sample_metadata_file': map_file,
+            'sample_metadata_md5': get_file_md5(map_file)}
+    exp = cls(data, sample_md, feature_md, info=info, description=os.path.basename(table_file), sparse=sparse)
+    if normalize is not None:
+        exp.normalize(total=normalize, inplace=True)
+    exp._call_history = [call]
+    return exp
+
+
+def read_ms(table_file, map_file=None, gnps_file=None, normalize=None, sparse=False, dtype=np.float64, chunk_rows=CHUNK_ROWS):
+    '''Read an MZMine2 csv table into a calour MS1Experiment (streaming)
+
+    Parameters
+    ----------
+    table_file : str
+        the MZMine2 csv output table
+    map_file : str or None, optional
+        the mapping file
+    gnps_file : str or None, optional
+        the gnps clusterinfo tsv file (linked to the features by the row ID)
+    normalize : int or None, optional
+        number of reads to normalize each sample to. None to skip normalization
+    sparse : bool, optional
+        True to store the data as a sparse matrix
+    dtype : numpy.dtype, optional
+        the data type (i.e. np.float32 to halve the memory)
+    chunk_rows : int, optional
+        number of rows to parse in each chunk
+
+    Returns
+    -------
+    calour.MS1Experiment
+    '''
+    import calour as ca
+
+    columns = read_header(table_file, sep=',')
+    missing = set(MZMINE2_FEATURE_COLUMNS).difference(columns)
+    if missing:
+        raise ValueError('Table file %s does not contain %s columns. Is it an mzmine2 data table?' % (table_file, sorted(missing)))
+    sample_columns = [x for x in columns[1:] if x != '' and not x.startswith(MZMINE2_ROW_PREFIX)]
+    sample_ids, feature_ids, data, feature_md = parse_table(table_file, sep=',', sample_columns=sample_columns,
+                                                            feature_columns=list(MZMINE2_FEATURE_COLUMNS), sparse=sparse,
+                                                            dtype=dtype, chunk_rows=chunk_rows)
+    feature_md.rename(columns=MZMINE2_FEATURE_COLUMNS, inplace=True)
+    feature_md['mz_rt'] = ['%08.4f_%05.2f' % (cmz, crt) for cmz, crt in zip(feature_md['MZ'], feature_md['RT'])]
+    exp = _build_experiment(ca.MS1Experiment, data, sample_ids, feature_ids, feature_md, table_file, map_file, sparse, normalize,
+                            format_call('read_ms_streaming', table_file=table_file, map_file=map_file, gnps_file=gnps_file,
+                                        normalize=normalize, sparse=sparse, dtype=np.dtype(dtype).name))
+    if gnps_file:
+        # same as calour.read_ms: link the features to the gnps file using the gnps-calour database interface
+        from calour.database import _get_database_class
+
+        exp.info['_calour_metabolomics_gnps_table'] = pd.read_csv(gnps_file, sep='\t')
+        gnps_db = _get_database_class('gnps', exp=exp)
+        gnps_db._prepare_gnps_ids(direct_ids=True, mz_thresh=0.02, use_gnps_id_from_AllFiles=True)
+        gnps_db._prepare_gnps_names()
+    return exp
+
+
+def read_generic(table_file, map_file=None, normalize=None, sparse=False, dtype=np.float64, chunk_rows=CHUNK_ROWS):
+    '''Read a generic tab separated table (features are rows, samples are columns) into a calour Experiment (streaming)
+
+    Parameters
+    ----------
+    table_file : str
+        the table. First column is the feature id
+    map_file : str or None, optional
+        the mapping file
+    normalize : int or None, optional
+        number of reads to normalize each sample to. None to skip normalization
+    sparse : bool, optional
+        True to store the data as a sparse matrix
+    dtype : numpy.dtype, optional
+        the data type (i.e. np.float32 to halve the memory)
+    chunk_rows : int, optional
+        number of rows to parse in each chunk
+
+    Returns
+    -------
+    calour.Experiment
+    '''
+    import calour as ca
+
+    sample_ids, feature_ids, data, feature_md = parse_table(table_file, sep='\t', sparse=sparse, dtype=dtype, chunk_rows=chunk_rows)
+    return _build_experiment(ca.Experiment, data, sample_ids, feature_ids, feature_md, table_file, map_file, sparse, normalize,
+                             format_call('read_generic_streaming', table_file=table_file, map_file=map_file,
+                                         normalize=normalize, sparse=sparse, dtype=np.dtype(dtype).name))
+
+
+def _read_in_memory(table_file, sep):
+    '''The calour text table read (whole table as a DataFrame using the python engine), used as the benchmark baseline'''
+    table = pd.read_csv(table_file, header=0, engine='python', sep=sep)
+    table.dropna(axis='columns', how='all', inplace=True)
+    table.set_index(table.columns[0], drop=True, inplace=True)
+    return table.values.astype(float).transpose()
+
+
+def benchmark(num_features=100000, num_samples=100, density=0.2, random_seed=2020, dirname=None):
+    '''Benchmark the streaming read against the in-memory read on a random MZMine2 like csv table
+
+    Parameters
+    ----------
+    num_features, num_samples : int, optional
+        the size of the benchmark table
+    density : float, optional
+        the fraction of non-zero values
+    random_seed : int, optional
+    dirname : str or None, optional
+        where to write the table. None to use a temporary directory
+
+    Returns
+    -------
+    dict
+        the time (seconds) and peak traced memory (MB) of each read
+    '''
+    import time
+    import tempfile
+    import tracemalloc
+
+    rand = np.random.RandomState(random_seed)
+    values = rand.exponential(10000, size=(num_features, num_samples)) * (rand.random_sample((num_features, num_samples)) < density)
+    table = pd.DataFrame(np.round(values, 2), columns=['s%d.mzXML Peak area' % x for x in range(num_samples)])
+    table.insert(0, 'row retention time', rand.uniform(0, 20, num_features))
+    table.insert(0, 'row m/z', rand.uniform(50, 1500, num_features))
+    table.insert(0, 'row ID', np.arange(num_features))
+    del values
+    results = {}
+    with tempfile.TemporaryDirectory(dir=dirname) as tmpdir:
+        fname = os.path.join(tmpdir, 'table.csv')
+        table.to_csv(fname, index=False)
+        del table
+        results['file_mb'] = os.path.getsize(fname) / 2 ** 20
+        sample_columns = [x for x in read_header(fname, sep=',') if not x.startswith(MZMINE2_ROW_PREFIX)]
+        runs = {'in_memory': lambda: _read_in_memory(fname, ','),
+                'streaming': lambda: parse_table(fname, sep=',', sample_columns=sample_columns),
+                'streaming_float32': lambda: parse_table(fname, sep=',', sample_columns=sample_columns, dtype=np.float32),
+                'streaming_sparse': lambda: parse_table(fname, sep=',', sample_columns=sample_columns, sparse=True)}
+        for cname, cfunc in runs.items():
+            tracemalloc.start()
+            start = time.time()
+            res = cfunc()
+            results['%s_seconds' % cname] = time.time() - start
+            results['%s_peak_mb' % cname] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+            del res
+    return results
+
+
+if __name__ == '__main__':
+    for k, v in benchmark().items():
+        print('%s: %f' % (k, v))
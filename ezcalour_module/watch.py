@@ -0,0 +1,162 @@
+'''Watch a folder for new or changed tables
+
+The FolderWatcher does not depend on Qt. It is polled (by the GUI timer or by the
+command line loop) and returns the tables that are ready to be read. The poll only
+checks the file sizes and modification times; the content hash (used to skip tables
+already read with the same content) is computed by table_hash in a background job,
+and checked using FolderWatcher.is_new.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--,  Calour development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import time
+import hashlib
+from logging import getLogger
+
+from ezcalour_module import loaders
+
+logger = getLogger(__name__)
+
+
+def file_hash(filename, block_size=1 << 20):
+    '''Get the sha1 hash of the file content
+
+    Parameters
+    ----------
+    filename : str or None
+        the file to hash. None returns ''
+    block_size : int, optional
+        read the file in blocks of this size
+
+    Returns
+    -------
+    str
+        the hex digest of the file content
+    '''
+    if filename is None:
+        return ''
+    chash = hashlib.sha1()
+    with open(filename, 'rb') as fl:
+        while True:
+            block = fl.read(block_size)
+            if not block:
+                break
+            chash.update(block)
+    return chash.hexdigest()
+
+
+def table_hash(table_file, map_file=None):
+    '''Get the content hash of a table and its mapping file
+
+    Parameters
+    ----------
+    table_file : str
+    map_file : str or None, optional
+
+    Returns
+    -------
+    str
+        the table and mapping file hex digests
+    '''
+    return file_hash(table_file) + file_hash(map_file)
+
+
+class FolderWatcher:
+    '''Detect new or changed tables (and their mapping files) in a folder
+
+    A table is reported only after its size and modification time did not change for
+    debounce seconds (so we don't read half written files), and only once for each
+    size and modification time. The caller should compute the table_hash of the reported
+    tables (i.e. in a background job) and read only the tables for which is_new is True.
+    '''
+    def __init__(self, folder, map_file=None, debounce=5.0, extensions=None):
+        '''
+        Parameters
+        ----------
+        folder : str
+            the folder to watch
+        map_file : str or None, optional
+            the mapping file to use for tables without a matching mapping file (see loaders.find_mapping_file)
+        debounce : float, optional
+            number of seconds a file should not change before it is reported
+        extensions : list of str or None, optional
+            the table file extensions to watch. None to use all extensions in loaders.TABLE_EXTENSIONS
+        '''
+        self.folder = folder
+        self.map_file = map_file
+        self.debounce = debounce
+        self.extensions = extensions
+        # the last (size, mtime) seen for each file, and the time it was first seen with this state
+        self._state = {}
+        # the (table state, mapping file state) last reported for each (table, mapping file)
+        self._reported = {}
+        # the content hashes already read
+        self._seen = set()
+
+    def _file_state(self, filename):
+        if filename is None:
+            return None
+        try:
+            cstat = os.stat(filename)
+        except OSError:
+            return None
+        return (cstat.st_size, cstat.st_mtime)
+
+    def _is_stable(self, filename, now):
+        '''Check if the file did not change in the last debounce seconds'''
+        cstate = self._file_state(filename)
+        prev = self._state.get(filename)
+        if prev is None or prev[0] != cstate:
+            self._state[filename] = (cstate, now)
+            return False
+        return now - prev[1] >= self.debounce
+
+    def poll(self):
+        '''Get the new or changed tables that are ready to be read
+
+        Returns
+        -------
+        list of (str, str or None)
+            the new or changed (table file, mapping file). Their content was not compared to the tables already read (see is_new)
+        '''
+        now = time.time()
+        ready = []
+        for ctable in loaders.find_tables(self.folder, extensions=self.extensions):
+            cmap = loaders.find_mapping_file(ctable, default=self.map_file)
+            # check both so the debounce of the table and the mapping file start together
+            table_stable = self._is_stable(ctable, now)
+            map_stable = cmap is None or self._is_stable(cmap, now)
+            if not (table_stable and map_stable):
+                continue
+            cstate = (self._file_state(ctable), self._file_state(cmap))
+            if self._reported.get((ctable, cmap)) == cstate:
+                continue
+            self._reported[(ctable, cmap)] = cstate
+            logger.debug('new or changed table %s (map %s) in watched folder' % (ctable, cmap))
+            ready.append((ctable, cmap))
+        return ready
+
+    def is_new(self, chash):
+        '''Check if a table content was not read before (and mark it as read)
+
+        Parameters
+        ----------
+        chash : str
+            the table_hash of the table and its mapping file
+
+        Returns
+        -------
+        bool
+            True if the content was not read before
+        '''
+        if chash in self._seen:
+            return False
+        self._seen.add(chash)
+        return True